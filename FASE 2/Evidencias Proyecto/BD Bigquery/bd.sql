@@ -44,11 +44,24 @@ CREATE TABLE `nombre_proyecto.dataset.CROPS` (
 CREATE TABLE `nombre_proyecto.dataset.DEVICES` (
   device_id STRING NOT NULL,
   crop_id STRING,
+  -- Thing y propiedad de Arduino Cloud del relé; si son nulos se usan
+  -- ARDUINO_THING_ID / ARDUINO_PROPERTY_ID de la configuración.
+  arduino_thing_id STRING,
+  arduino_property_id STRING,
+  -- Estado del relé y modo de control fusionados desde DEVICE_STATE_LOG.
+  state BOOLEAN,
+  control_mode STRING,
   CONSTRAINT pk_devices PRIMARY KEY (device_id),
   CONSTRAINT fk_devices_crop FOREIGN KEY (crop_id) REFERENCES `nombre_proyecto.dataset.CROPS` (crop_id)
 );
 
 -- Tabla SENSOR_READINGS
+-- Particionada por día y agrupada por dispositivo y métrica: las consultas que
+-- filtran por device_id, metric_type y un rango constante de timestamp solo leen
+-- los bloques de esos días y dispositivos. metric_type se guarda normalizado
+-- (minúsculas, ver sensor_normalization.normalize_metric_name) y se compara sin
+-- LOWER(), que impediría la poda por clustering.
+-- Una tabla existente sin particiones se migra con migrate_sensor_readings.py.
 CREATE TABLE `nombre_proyecto.dataset.SENSOR_READINGS` (
   sensor_reading_id STRING NOT NULL,
   metric_type STRING,
@@ -57,6 +70,51 @@ CREATE TABLE `nombre_proyecto.dataset.SENSOR_READINGS` (
   device_id STRING,
   CONSTRAINT pk_sensor_readings PRIMARY KEY (sensor_reading_id),
   CONSTRAINT fk_sensor_device FOREIGN KEY (device_id) REFERENCES `nombre_proyecto.dataset.DEVICES` (device_id)
+)
+PARTITION BY DATE(timestamp)
+CLUSTER BY device_id, metric_type;
+
+-- Tablas de agregados de SENSOR_READINGS (por minuto y por hora).
+-- Se escriben por streaming al ingerir (una fila parcial por lote, cubeta, dispositivo
+-- y métrica) y el trabajo compact_sensor_readings las reescribe desde los crudos.
+-- Los promedios se calculan como SUM(sum) / SUM(count).
+-- inserted_at es la hora de inserción por streaming de cada fila parcial (NULL en las
+-- filas que escribe la compactación): la compactación no toca las cubetas con filas
+-- que aún pueden estar en el buffer de streaming. En tablas ya creadas:
+--   ALTER TABLE ... ADD COLUMN inserted_at TIMESTAMP;
+CREATE TABLE `nombre_proyecto.dataset.SENSOR_READINGS_1M` (
+  device_id STRING NOT NULL,
+  metric_type STRING NOT NULL,
+  bucket_start TIMESTAMP NOT NULL,
+  count INT64,
+  sum FLOAT64,
+  min FLOAT64,
+  max FLOAT64,
+  inserted_at TIMESTAMP
+)
+PARTITION BY DATE(bucket_start)
+CLUSTER BY device_id, metric_type;
+
+CREATE TABLE `nombre_proyecto.dataset.SENSOR_READINGS_1H` (
+  device_id STRING NOT NULL,
+  metric_type STRING NOT NULL,
+  bucket_start TIMESTAMP NOT NULL,
+  count INT64,
+  sum FLOAT64,
+  min FLOAT64,
+  max FLOAT64,
+  inserted_at TIMESTAMP
+)
+PARTITION BY DATE(bucket_start)
+CLUSTER BY device_id, metric_type;
+
+-- Cobertura de los agregados: compact_sensor_readings añade una fila por nivel cada
+-- vez que reconstruye un rango contiguo a lo ya cubierto. Desde MIN(covered_from)
+-- el nivel está completo; antes, los gráficos leen los crudos.
+CREATE TABLE `nombre_proyecto.dataset.SENSOR_ROLLUP_COVERAGE` (
+  level STRING NOT NULL,
+  covered_from TIMESTAMP NOT NULL,
+  recorded_at TIMESTAMP NOT NULL
 );
 
 -- Tabla ACTUATOR_ACTIONS
@@ -67,7 +125,24 @@ CREATE TABLE `nombre_proyecto.dataset.ACTUATOR_ACTIONS` (
   device_id STRING,
   CONSTRAINT pk_actuator_actions PRIMARY KEY (actuator_action_id),
   CONSTRAINT fk_actuator_device FOREIGN KEY (device_id) REFERENCES `nombre_proyecto.dataset.DEVICES` (device_id)
-);
+)
+PARTITION BY DATE(timestamp)
+CLUSTER BY device_id;
+
+-- Registro de cambios de relé y modo de control (solo se añaden filas por streaming).
+-- Cada fila trae el relé, el modo o ambos; una columna nula significa "sin cambio".
+-- El trabajo compact_device_state_log los fusiona en DEVICES con un MERGE.
+CREATE TABLE `nombre_proyecto.dataset.DEVICE_STATE_LOG` (
+  change_id STRING NOT NULL,
+  device_id STRING NOT NULL,
+  relay_state BOOLEAN,
+  control_mode STRING,
+  changed_at TIMESTAMP NOT NULL,
+  CONSTRAINT pk_device_state_log PRIMARY KEY (change_id),
+  CONSTRAINT fk_state_log_device FOREIGN KEY (device_id) REFERENCES `nombre_proyecto.dataset.DEVICES` (device_id)
+)
+PARTITION BY DATE(changed_at)
+CLUSTER BY device_id;
 
 -- Tabla AI_RECOMMENDATIONS
 CREATE TABLE `nombre_proyecto.dataset.AI_RECOMMENDATIONS` (
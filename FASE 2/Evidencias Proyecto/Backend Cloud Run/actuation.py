@@ -0,0 +1,97 @@
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from backend_core import insert_rows, load_config
+from ingest_buffer import get_buffer
+
+# --- Configuración ---
+# Tiempo mínimo (segundos) que un relé se mantiene en un estado antes de que el
+# control automático lo vuelva a cambiar; evita ciclos cortos del actuador.
+ACTUATION_MIN_DWELL_S = float(os.environ.get("ACTUATION_MIN_DWELL_S", "300"))
+# Las acciones se insertan en ACTUATOR_ACTIONS en lotes (ver ingest_buffer).
+ACTIONS_BATCH_SIZE = int(os.environ.get("ACTIONS_BATCH_SIZE", "200"))
+ACTIONS_MAX_LINGER_MS = int(os.environ.get("ACTIONS_MAX_LINGER_MS", "2000"))
+
+
+def _insert_action_rows(rows):
+    return insert_rows(load_config().actuator_actions_table, rows)
+
+
+def log_actuator_actions(actions, at=None):
+    """
+    Encola eventos del actuador [(device_id, action), ...] para ACTUATOR_ACTIONS y
+    devuelve el Future del lote. No espera a BigQuery: las filas se insertan junto
+    con las de otras peticiones.
+    """
+    timestamp = (at or datetime.now(timezone.utc)).isoformat()
+    rows = [
+        {
+            "actuator_action_id": str(uuid.uuid4()),
+            "action": bool(action),
+            "timestamp": timestamp,
+            "device_id": device_id,
+        }
+        for device_id, action in actions
+    ]
+    buffer = get_buffer(
+        "actuator_actions", _insert_action_rows,
+        batch_size=ACTIONS_BATCH_SIZE, max_linger_s=ACTIONS_MAX_LINGER_MS / 1000.0,
+    )
+    return buffer.add(rows)
+
+
+def log_actuator_action(device_id, action, at=None):
+    """Encola un evento del actuador (ver log_actuator_actions)."""
+    return log_actuator_actions([(device_id, action)], at)
+
+
+class ActuationStateMachine:
+    """
+    Último estado ordenado y hora del último cambio de cada relé.
+
+    Un comando solo se envía en una transición real (encendido -> apagado o al revés)
+    y si el relé lleva al menos `min_dwell_s` en su estado actual. El estado guardado
+    en la tabla devices y la última fila de ACTUATOR_ACTIONS sirven de punto de
+    partida cuando este proceso aún no ha ordenado nada a ese dispositivo.
+    """
+
+    def __init__(self, min_dwell_s=ACTUATION_MIN_DWELL_S):
+        self.min_dwell_s = min_dwell_s
+        self._lock = threading.Lock()
+        # device_id -> (estado, datetime UTC del cambio)
+        self._last = {}
+
+    def current(self, device_id, stored_state, last_action_at=None):
+        """
+        Devuelve (estado, hora del último cambio) del relé. Lo recordado aquí vale
+        salvo que otra instancia (o un comando manual) haya registrado una acción posterior.
+        """
+        with self._lock:
+            entry = self._last.get(device_id)
+        if entry is not None and (last_action_at is None or entry[1] >= last_action_at):
+            return entry
+        return bool(stored_state), last_action_at
+
+    def decide(self, device_id, desired, stored_state, last_action_at=None, now=None):
+        """
+        Devuelve "send" si hay que enviar `desired`, "hold" si es una transición
+        que aún no cumple el tiempo mínimo, o None si el relé ya está en ese estado.
+        """
+        now = now or datetime.now(timezone.utc)
+        current, changed_at = self.current(device_id, stored_state, last_action_at)
+        if desired == current:
+            return None
+        if changed_at is not None and now - changed_at < timedelta(seconds=self.min_dwell_s):
+            return "hold"
+        return "send"
+
+    def record(self, device_id, state, at=None):
+        """
+        Registra en memoria un comando enviado con éxito. La fila de ACTUATOR_ACTIONS
+        la escribe el endpoint del relé (send_bool_acloud) al confirmar el cambio.
+        """
+        at = at or datetime.now(timezone.utc)
+        with self._lock:
+            self._last[device_id] = (bool(state), at)
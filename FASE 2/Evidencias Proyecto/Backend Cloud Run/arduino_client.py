@@ -0,0 +1,280 @@
+import os
+import threading
+import time
+
+import instrumentation as log
+from backend_core import load_config
+from instrumentation import register_stats
+
+# --- Configuración ---
+ARDUINO_TOKEN_URL = "https://api2.arduino.cc/iot/v1/clients/token"
+ARDUINO_API_BASE_URL = "https://api2.arduino.cc/iot/v2/things"
+# (conexión, lectura) en segundos para cada llamada a Arduino Cloud.
+ARDUINO_CONNECT_TIMEOUT_S = float(os.environ.get("ARDUINO_CONNECT_TIMEOUT_S", "3.05"))
+ARDUINO_READ_TIMEOUT_S = float(os.environ.get("ARDUINO_READ_TIMEOUT_S", "10"))
+# Reintentos ante errores de red, 429 y 5xx, con espera exponencial.
+ARDUINO_MAX_RETRIES = int(os.environ.get("ARDUINO_MAX_RETRIES", "3"))
+ARDUINO_RETRY_BACKOFF_S = float(os.environ.get("ARDUINO_RETRY_BACKOFF_S", "0.3"))
+ARDUINO_POOL_MAXSIZE = int(os.environ.get("ARDUINO_POOL_MAXSIZE", "16"))
+# Segundos antes del vencimiento en que el token se renueva en segundo plano.
+ARDUINO_TOKEN_REFRESH_MARGIN_S = float(os.environ.get("ARDUINO_TOKEN_REFRESH_MARGIN_S", "120"))
+# Duración supuesta del token si la respuesta no trae expires_in.
+ARDUINO_TOKEN_DEFAULT_TTL_S = float(os.environ.get("ARDUINO_TOKEN_DEFAULT_TTL_S", "300"))
+# Límite de llamadas por segundo a la API de Arduino Cloud compartido por todas las
+# peticiones del proceso (la API admite unas 10/s por cuenta), y ráfaga permitida.
+ARDUINO_RATE_LIMIT_PER_S = float(os.environ.get("ARDUINO_RATE_LIMIT_PER_S", "10"))
+ARDUINO_RATE_LIMIT_BURST = int(os.environ.get("ARDUINO_RATE_LIMIT_BURST", "10"))
+# Cada cuántas publicaciones se escriben las métricas en el log (0 = nunca).
+ARDUINO_METRICS_LOG_EVERY = int(os.environ.get("ARDUINO_METRICS_LOG_EVERY", "100"))
+
+
+class RateLimiter:
+    """Cubeta de fichas (token bucket) segura entre hilos."""
+
+    def __init__(self, rate_per_s, burst):
+        self.rate_per_s = rate_per_s
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Bloquea hasta que haya una ficha y devuelve los segundos esperados."""
+        if self.rate_per_s <= 0:
+            return 0.0
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate_per_s)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate_per_s
+            time.sleep(delay)
+            waited += delay
+
+
+class ArduinoCloudClient:
+    """
+    Cliente de la API de Arduino Cloud compartido por el proceso.
+
+    - El token OAuth2 se guarda hasta su vencimiento (expires_in). Cerca del
+      vencimiento se sigue usando mientras un único hilo lo renueva en segundo plano;
+      si ya venció, la primera petición lo pide y las demás esperan ese mismo resultado.
+    - Las llamadas usan una requests.Session con pool de conexiones keep-alive,
+      timeouts y reintentos acotados, y pasan por un limitador de tasa común.
+    """
+
+    def __init__(self, client_id, client_secret, rate_limiter=None):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.rate_limiter = rate_limiter or RateLimiter(ARDUINO_RATE_LIMIT_PER_S, ARDUINO_RATE_LIMIT_BURST)
+        self._lock = threading.Lock()
+        self._token_lock = threading.Lock()
+        self._session = None
+        self._adapter = None
+        self._token = None
+        self._token_expires_at = 0.0
+        self._refreshing = False
+        self._counters = {
+            "token_refreshes": 0, "token_background_refreshes": 0, "token_errors": 0,
+            "publishes": 0, "publish_errors": 0,
+        }
+        self._rate_limited_s = 0.0
+
+    # --- Sesión HTTP ---
+
+    def session(self):
+        """Sesión con pool y reintentos, creada en el primer uso (requests se importa aquí)."""
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    from urllib3.util.retry import Retry
+
+                    retry = Retry(
+                        total=ARDUINO_MAX_RETRIES,
+                        backoff_factor=ARDUINO_RETRY_BACKOFF_S,
+                        status_forcelist=(429, 500, 502, 503, 504),
+                        allowed_methods=frozenset(["GET", "POST", "PUT"]),
+                        respect_retry_after_header=True,
+                        raise_on_status=False,
+                    )
+                    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=ARDUINO_POOL_MAXSIZE, max_retries=retry)
+                    session = requests.Session()
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._adapter = adapter
+                    self._session = session
+        return self._session
+
+    def _timeout(self):
+        return (ARDUINO_CONNECT_TIMEOUT_S, ARDUINO_READ_TIMEOUT_S)
+
+    # --- Token ---
+
+    def get_token(self):
+        """Devuelve un token válido o None si no se pudo obtener."""
+        now = time.monotonic()
+        token, expires_at = self._token, self._token_expires_at
+        if token and now < expires_at:
+            if now >= expires_at - ARDUINO_TOKEN_REFRESH_MARGIN_S:
+                self._refresh_in_background()
+            return token
+
+        with self._token_lock:
+            # Otra petición pudo renovarlo mientras se esperaba el lock.
+            if self._token and time.monotonic() < self._token_expires_at:
+                return self._token
+            return self._fetch_token()
+
+    def invalidate_token(self, token):
+        """Descarta `token` (p. ej. tras un 401) si sigue siendo el vigente."""
+        with self._token_lock:
+            if self._token == token:
+                self._token = None
+                self._token_expires_at = 0.0
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def refresh():
+            try:
+                with self._token_lock:
+                    if self._fetch_token() is not None:
+                        self._count("token_background_refreshes")
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=refresh, name="arduino-token-refresh", daemon=True).start()
+
+    def _fetch_token(self):
+        # Se llama con _token_lock tomado.
+        import requests
+        headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+        data = {
+            'grant_type': 'client_credentials',
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'audience': 'https://api2.arduino.cc/iot'
+        }
+        try:
+            self._throttle()
+            response = self.session().post(ARDUINO_TOKEN_URL, headers=headers, data=data, timeout=self._timeout())
+            response.raise_for_status()
+            body = response.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            log.error("Error al obtener el token de Arduino Cloud.", error=str(e))
+            self._count("token_errors")
+            return None
+
+        token = body.get('access_token')
+        if not token:
+            self._count("token_errors")
+            return None
+        ttl_s = float(body.get('expires_in') or ARDUINO_TOKEN_DEFAULT_TTL_S)
+        self._token = token
+        self._token_expires_at = time.monotonic() + ttl_s
+        self._count("token_refreshes")
+        return token
+
+    # --- Propiedades ---
+
+    def publish_property(self, thing_id, property_id, new_value, access_token=None):
+        """
+        Publica el valor de una propiedad de un Thing. Devuelve (éxito, mensaje).
+        Ante un 401 se descarta el token y se reintenta una vez con uno nuevo.
+        """
+        import requests
+        access_token = access_token or self.get_token()
+        if not access_token:
+            return False, "No se pudo obtener el token de acceso."
+
+        url = f"{ARDUINO_API_BASE_URL}/{thing_id}/properties/{property_id}/publish"
+        payload = {"value": new_value}
+        self._count("publishes")
+        try:
+            for attempt in range(2):
+                headers = {
+                    'Authorization': f'Bearer {access_token}',
+                    'Content-Type': 'application/json'
+                }
+                self._throttle()
+                response = self.session().put(url, headers=headers, json=payload, timeout=self._timeout())
+                if response.status_code == 401 and attempt == 0:
+                    self.invalidate_token(access_token)
+                    access_token = self.get_token()
+                    if not access_token:
+                        self._count("publish_errors")
+                        return False, "No se pudo obtener el token de acceso."
+                    continue
+                response.raise_for_status()
+                break
+            log.info("Propiedad actualizada.", sampled=True, thing_id=thing_id, property_id=property_id, value=new_value)
+            return True, "Propiedad actualizada exitosamente."
+        except requests.exceptions.RequestException as e:
+            self._count("publish_errors")
+            status = e.response.status_code if e.response is not None else 'N/A'
+            detail = e.response.text if e.response is not None else str(e)
+            log.error("Error de API al actualizar la propiedad.", thing_id=thing_id, status=status, detail=detail)
+            return False, f"Error en API Arduino ({status}): {detail}"
+        finally:
+            if ARDUINO_METRICS_LOG_EVERY and self._counters["publishes"] % ARDUINO_METRICS_LOG_EVERY == 0:
+                log.info("Métricas del cliente de Arduino Cloud.", **self.metrics())
+
+    # --- Métricas ---
+
+    def _throttle(self):
+        waited = self.rate_limiter.acquire()
+        if waited:
+            with self._lock:
+                self._rate_limited_s += waited
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def metrics(self):
+        """Contadores de tokens y publicaciones, y uso del pool de conexiones."""
+        with self._lock:
+            metrics = dict(self._counters)
+            metrics["rate_limited_s"] = round(self._rate_limited_s, 3)
+        connections = requests_sent = 0
+        if self._adapter is not None:
+            for key in list(self._adapter.poolmanager.pools.keys()):
+                pool = self._adapter.poolmanager.pools.get(key)
+                if pool is not None:
+                    connections += pool.num_connections
+                    requests_sent += pool.num_requests
+        metrics["connections_opened"] = connections
+        metrics["http_requests"] = requests_sent
+        metrics["connections_reused"] = max(0, requests_sent - connections)
+        remaining = self._token_expires_at - time.monotonic()
+        metrics["token_ttl_s"] = round(remaining, 1) if self._token and remaining > 0 else 0.0
+        return metrics
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_arduino_client():
+    """Cliente de Arduino Cloud compartido por todo el proceso."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                config = load_config()
+                _client = ArduinoCloudClient(config.arduino_client_id, config.arduino_client_secret)
+    return _client
+
+
+register_stats("arduino", "Contadores del cliente de Arduino Cloud (ver ArduinoCloudClient.metrics).",
+               lambda: _client.metrics() if _client is not None else {})
@@ -0,0 +1,203 @@
+import os
+import sys
+import threading
+import time
+from dataclasses import dataclass
+
+import instrumentation as log
+
+# google.cloud.bigquery, google.auth y requests se importan en el primer uso
+# (o en el hilo de warm_up) para no alargar el arranque en frío: importar
+# bigquery cuesta más de medio segundo y la mayoría de consultas son mínimas.
+
+# --- Configuración del pool HTTP del cliente de BigQuery ---
+# Un solo cliente por proceso reutiliza conexiones TLS entre peticiones; el
+# tamaño del pool debe cubrir la concurrencia de la instancia de Cloud Run.
+BQ_POOL_CONNECTIONS = int(os.environ.get("BQ_POOL_CONNECTIONS", "4"))
+BQ_POOL_MAXSIZE = int(os.environ.get("BQ_POOL_MAXSIZE", "32"))
+
+# Si es verdadero, al importar una función se prepara el cliente en segundo plano.
+WARMUP_ON_IMPORT = os.environ.get("WARMUP_ON_IMPORT", "true").lower() == "true"
+# Si es verdadero, se informa cuánto tarda cada paso del arranque.
+STARTUP_PROFILE = os.environ.get("STARTUP_PROFILE", "false").lower() == "true"
+
+
+def _env(*names, default=None):
+    """Devuelve la primera variable de entorno definida entre `names`."""
+    for name in names:
+        value = os.environ.get(name)
+        if value:
+            return value
+    return default
+
+
+@dataclass(frozen=True)
+class BackendConfig:
+    project_id: str
+    dataset_id: str
+    sensors_table: str
+    devices_table: str
+    crops_table: str
+    farms_table: str
+    actuator_actions_table: str
+    device_state_log_table: str
+    rollup_minute_table: str
+    rollup_hour_table: str
+    rollup_coverage_table: str
+    device_login_name: str
+    arduino_client_id: str
+    arduino_client_secret: str
+    arduino_thing_id: str
+    arduino_property_id: str
+    relay_control_url: str
+
+
+_config = None
+_client = None
+_lock = threading.Lock()
+_warmup_thread = None
+
+
+def _profile_step(label, start):
+    if STARTUP_PROFILE:
+        print(f"[startup] {label}: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+
+def bigquery_module():
+    """Importa google.cloud.bigquery en el primer uso."""
+    if "google.cloud.bigquery" not in sys.modules:
+        start = time.perf_counter()
+        from google.cloud import bigquery
+        _profile_step("import google.cloud.bigquery", start)
+    from google.cloud import bigquery
+    return bigquery
+
+
+def load_config():
+    """
+    Lee la configuración del backend una sola vez por proceso.
+
+    Acepta los nombres de variables usados históricamente por cada función
+    (BIGQUERY_PROJECT_ID / GCP_PROJECT, BIGQUERY_DATASET_ID / GCP_DATASET).
+    """
+    global _config
+    if _config is None:
+        _config = BackendConfig(
+            project_id=_env("BIGQUERY_PROJECT_ID", "GCP_PROJECT", "GOOGLE_CLOUD_PROJECT", default="iot-growing-app"),
+            dataset_id=_env("BIGQUERY_DATASET_ID", "GCP_DATASET", default="growing_app_bd"),
+            sensors_table=_env("BIGQUERY_TABLE_ID", default="sensor_readings"),
+            devices_table=_env("BIGQUERY_DEVICES_TABLE_ID", default="devices"),
+            crops_table=_env("BIGQUERY_CROPS_TABLE_ID", default="crops"),
+            farms_table=_env("BIGQUERY_FARMS_TABLE_ID", default="farms"),
+            actuator_actions_table=_env("BIGQUERY_ACTUATOR_ACTIONS_TABLE_ID", default="actuator_actions"),
+            device_state_log_table=_env("BIGQUERY_DEVICE_STATE_LOG_TABLE_ID", default="device_state_log"),
+            rollup_minute_table=_env("BIGQUERY_ROLLUP_MINUTE_TABLE_ID", default="sensor_readings_1m"),
+            rollup_hour_table=_env("BIGQUERY_ROLLUP_HOUR_TABLE_ID", default="sensor_readings_1h"),
+            rollup_coverage_table=_env("BIGQUERY_ROLLUP_COVERAGE_TABLE_ID", default="sensor_rollup_coverage"),
+            device_login_name=_env("DEVICE_LOGIN_NAME"),
+            arduino_client_id=_env("ARDUINO_CLIENT_ID", default="xD2qyoOLqut2tRG8tuwOIYdeVJb3uJsS"),
+            arduino_client_secret=_env("ARDUINO_CLIENT_SECRET", default="l7tvmbeBBjHYrusPpCUf6sa3RKlaauWoSmpW4HofGlvO4E5gx2OORfIWE83BEHuO"),
+            arduino_thing_id=_env("ARDUINO_THING_ID", default="5be76a70-5435-4f31-94c4-62a8d73c75f2"),
+            arduino_property_id=_env("ARDUINO_PROPERTY_ID", default="relay_Control"),
+            relay_control_url=_env("RELAY_CONTROL_URL", default="https://send-bool-acloud-712174296076.europe-west1.run.app"),
+        )
+    return _config
+
+
+def get_bq_client():
+    """
+    Devuelve el cliente de BigQuery del proceso, creándolo en el primer uso.
+
+    El cliente usa una sesión HTTP autorizada con un pool de conexiones
+    ajustado, así que las credenciales y el handshake TLS se hacen una vez
+    por instancia y no en cada petición. Es seguro entre hilos.
+    """
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                bigquery = bigquery_module()
+                import google.auth
+                from google.auth.transport.requests import AuthorizedSession
+                from requests.adapters import HTTPAdapter
+
+                start = time.perf_counter()
+                config = load_config()
+                credentials, _ = google.auth.default(scopes=bigquery.Client.SCOPE)
+                session = AuthorizedSession(credentials)
+                adapter = HTTPAdapter(pool_connections=BQ_POOL_CONNECTIONS, pool_maxsize=BQ_POOL_MAXSIZE)
+                session.mount("https://", adapter)
+                _client = bigquery.Client(project=config.project_id, credentials=credentials, _http=session)
+                _profile_step("creación del cliente de BigQuery", start)
+                log.info("BigQuery Client inicializado.", project_id=config.project_id, dataset_id=config.dataset_id)
+    return _client
+
+
+def _storage():
+    # Import diferido: storage importa este módulo.
+    from storage import get_storage
+    return get_storage()
+
+
+def run_query(sql, params=None, bytes_budget=None):
+    """
+    Lanza una consulta con parámetros en el backend de almacenamiento
+    (STORAGE_BACKEND, ver storage.py) y devuelve el QueryJob.
+    `params` es una lista de tuplas (nombre, tipo, valor), p. ej. [("device_id", "STRING", device_id)].
+    Si el valor es una lista o tupla se envía como parámetro ARRAY del tipo indicado.
+    `bytes_budget` reemplaza el máximo de bytes facturados de la consulta
+    (QUERY_BYTES_BUDGET); 0 la deja sin límite, para los trabajos de mantenimiento.
+    """
+    return _storage().query(sql, params, bytes_budget=bytes_budget)
+
+
+def insert_rows(table_name, rows, row_ids=None):
+    """
+    Inserta filas (dicts) en la tabla y devuelve la lista de errores con el
+    formato de insert_rows_json (vacía si todo se insertó). Con `row_ids` (IDs de
+    inserción estables) las filas repetidas se descartan y los errores transitorios
+    se reintentan (ver storage.insert_rows).
+    """
+    # Import diferido, como en _storage().
+    import storage
+    return storage.insert_rows(table_name, rows, row_ids=row_ids)
+
+
+def warm_up(*preload, client=True, then=None):
+    """
+    Prepara en un hilo de fondo los módulos de `preload`, (si `client`) el
+    backend de almacenamiento (cliente de BigQuery o base SQLite) y luego ejecuta `then()` si se indica, fuera del camino
+    crítico de la primera petición. Solo la primera llamada del proceso tiene efecto.
+    """
+    global _warmup_thread
+
+    def _run():
+        start = time.perf_counter()
+        for module in preload:
+            module_start = time.perf_counter()
+            __import__(module)
+            _profile_step(f"import {module}", module_start)
+        try:
+            if client:
+                _storage().warm_up()
+            if then is not None:
+                then()
+        except Exception as e:
+            # La primera petición volverá a intentarlo y devolverá el error.
+            log.warning("Warm-up falló.", error=str(e))
+        _profile_step("warm-up completo", start)
+
+    with _lock:
+        if _warmup_thread is None and WARMUP_ON_IMPORT:
+            _warmup_thread = threading.Thread(target=_run, name="warm-up", daemon=True)
+            _warmup_thread.start()
+
+
+def table_id(table_name):
+    """Identificador de la tabla en el backend: 'proyecto.dataset.tabla' en BigQuery."""
+    return _storage().table_id(table_name)
+
+
+def table_ref(table_name):
+    """Referencia a la tabla lista para usar dentro de una consulta SQL."""
+    return _storage().table_ref(table_name)
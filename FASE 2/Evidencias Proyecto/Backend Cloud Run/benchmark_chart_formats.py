@@ -0,0 +1,105 @@
+"""
+Compara los formatos de respuesta de list_sensor_readings: bytes enviados (sin y
+con gzip) y CPU del servidor por petición para armar el cuerpo a partir del
+resultado de BigQuery.
+
+El resultado de BigQuery se simula: filas tipo dict para el formato por filas
+(como las entrega el RowIterator) y una tabla Arrow para los formatos por columnas.
+
+Uso:
+    python benchmark_chart_formats.py                 # 1000 y 5000 puntos por métrica
+    python benchmark_chart_formats.py --points 1000 --repeat 50
+"""
+import argparse
+import gzip
+import json
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+from chart_columnar import arrow_ipc, columnar_json, fetch_columns
+
+HEAD = {"displayDate": "2024-01-01", "bucketSeconds": 60, "source": "raw"}
+
+
+def make_rows(points, seed=42):
+    """Filas como las de _raw_query: dos métricas, una lectura por minuto cada una."""
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    rows = []
+    for i in range(points):
+        ts = start + timedelta(seconds=60 * i)
+        for sensor, low, high in (("temperature", 5.0, 35.0), ("humidity", 30.0, 90.0)):
+            rows.append({
+                "sensor": sensor,
+                "value": round(rng.uniform(low, high), 1),
+                "timestamp": ts.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "cursor_us": int(ts.timestamp()) * 1_000_000,
+                "cursor_id": f"{sensor[0]}{i:08d}",
+            })
+    return rows
+
+
+class FakeRowIterator:
+    """Lo mínimo del RowIterator de BigQuery que usa chart_columnar.fetch_columns."""
+
+    def __init__(self, rows):
+        import pyarrow as pa
+        self._table = pa.Table.from_pylist(rows)
+
+    def to_arrow(self, create_bqstorage_client=True):
+        return self._table
+
+
+def encode_rows(rows):
+    # Igual que la respuesta por filas: se quitan las columnas de cursor y se serializa.
+    readings = []
+    for row in rows:
+        reading = dict(row)
+        reading.pop("cursor_us")
+        reading.pop("cursor_id")
+        readings.append(reading)
+    return json.dumps({**HEAD, "readings": readings}).encode()
+
+
+def encode_columnar(result):
+    return columnar_json(HEAD, fetch_columns(result)).encode()
+
+
+def encode_arrow(result):
+    return arrow_ipc(HEAD, fetch_columns(result))
+
+
+def measure(encode, source, repeat):
+    body = encode(source)
+    start = time.process_time()
+    for _ in range(repeat):
+        encode(source)
+    cpu_ms = (time.process_time() - start) * 1000 / repeat
+    return len(body), len(gzip.compress(body)), cpu_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--points", type=int, nargs="+", default=[1000, 5000], help="Puntos por métrica.")
+    parser.add_argument("--repeat", type=int, default=20, help="Repeticiones para medir la CPU.")
+    args = parser.parse_args()
+
+    for points in args.points:
+        rows = make_rows(points)
+        result = FakeRowIterator(rows)
+        print(f"\n{points} puntos por métrica ({len(rows)} filas)")
+        print(f"  {'formato':<10} {'bytes':>10} {'gzip':>10} {'CPU/petición':>14}")
+        baseline = None
+        for name, encode, source in (
+            ("json", encode_rows, rows),
+            ("columnar", encode_columnar, result),
+            ("arrow", encode_arrow, result),
+        ):
+            size, gz_size, cpu_ms = measure(encode, source, args.repeat)
+            baseline = baseline or size
+            print(f"  {name:<10} {size:>10,} {gz_size:>10,} {cpu_ms:>11.2f} ms   ({size / baseline:.0%} de json)")
+
+
+if __name__ == "__main__":
+    main()
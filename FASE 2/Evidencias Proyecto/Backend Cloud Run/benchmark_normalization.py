@@ -0,0 +1,73 @@
+"""
+Compara filas por segundo del camino por item y del camino por columnas de
+sensor_normalization, y verifica que ambos producen las mismas filas.
+
+Uso:
+    python benchmark_normalization.py                # 10k y 1M items
+    python benchmark_normalization.py --sizes 10000
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+from sensor_columnar import ReadingColumns
+from sensor_normalization import normalize_items
+
+
+def make_payload(n, seed=42):
+    """Genera un documento {device_id, values} de n items parecido a los del firmware."""
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    names = ["dht22_temperatura", "dht22_humedad", "soil_moisture"]
+    items = []
+    for i in range(n):
+        ts = start + timedelta(seconds=15 * i)
+        if i % 5 == 0:
+            stamp = ts.astimezone(timezone(timedelta(hours=-4))).isoformat()
+        else:
+            stamp = ts.strftime("%Y-%m-%dT%H:%M:%SZ")
+        items.append({
+            "name": names[i % len(names)],
+            "value": round(rng.uniform(-5.0, 45.0), 3) if i % 97 else rng.randint(0, 100),
+            "updated_at": stamp,
+        })
+    return {"device_id": "AA:BB:CC:DD:EE:FF", "values": items}
+
+
+def run_scalar(payload):
+    return normalize_items(payload["device_id"], payload["values"], None)
+
+
+def run_columnar(payload):
+    columns = ReadingColumns()
+    columns.add_items(payload["device_id"], payload["values"], None)
+    return columns.normalize()
+
+
+def bench(fn, payload):
+    start = time.perf_counter()
+    rows = fn(payload)
+    return rows, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,1000000", help="Tamaños de payload separados por comas.")
+    args = parser.parse_args()
+
+    print(f"{'items':>10} {'por item (filas/s)':>20} {'columnas (filas/s)':>20} {'speedup':>8}")
+    for n in [int(x) for x in args.sizes.split(",")]:
+        payload = make_payload(n)
+        scalar_rows, scalar_s = bench(run_scalar, payload)
+        columnar_rows, columnar_s = bench(run_columnar, payload)
+
+        # Los IDs se derivan de la lectura, así que también deben coincidir.
+        if scalar_rows != columnar_rows:
+            raise SystemExit(f"Los caminos difieren para {n} items.")
+
+        print(f"{n:>10} {len(scalar_rows) / scalar_s:>20,.0f} {len(columnar_rows) / columnar_s:>20,.0f} {scalar_s / columnar_s:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Formato compacto por columnas para los datos de gráfico de list_sensor_readings.
+
+En lugar de un objeto {sensor, value, timestamp} por punto, cada métrica trae
+arreglos paralelos: timestamps epoch (segundos) codificados como delta respecto
+del anterior y los valores como float. Se arma directamente desde el resultado de
+BigQuery en Arrow (sin objetos fila de Python) cuando pyarrow está instalado.
+
+Vive en su propio módulo para que el formato por filas no pague la importación de NumPy.
+"""
+import json
+
+import numpy as np
+
+# Columnas numéricas opcionales (solo las trae la consulta de agregados).
+_STAT_COLUMNS = ("min", "max", "count")
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        return pyarrow
+    except ImportError:
+        return None
+
+
+def fetch_columns(rows):
+    """
+    Convierte el RowIterator de BigQuery en columnas NumPy {nombre: arreglo}.
+    Con pyarrow usa la ruta Arrow del cliente (to_arrow); sin él, recorre las filas.
+    """
+    if _pyarrow() is not None:
+        table = rows.to_arrow(create_bqstorage_client=False)
+        return {name: table.column(name).to_numpy(zero_copy_only=False) for name in table.column_names}
+
+    records = [dict(row) for row in rows]
+    names = records[0].keys() if records else ("sensor", "value", "cursor_us")
+    return {name: np.array([r[name] for r in records]) for name in names}
+
+
+def _float_list(values):
+    # JSON no admite NaN: los nulos de BigQuery se envían como null.
+    values = values.astype(np.float64)
+    if np.isnan(values).any():
+        return [None if np.isnan(v) else v for v in values.tolist()]
+    return values.tolist()
+
+
+def columnar_series(columns):
+    """
+    Agrupa las columnas por métrica: {sensor: {"t0", "dt", "value", ["min", "max", "count"]}}.
+    `t0` es el primer timestamp (segundos epoch) y `dt` las diferencias sucesivas,
+    de modo que timestamp[i] = t0 + dt[0] + ... + dt[i-1].
+    """
+    sensors = columns["sensor"].astype(str)
+    epoch_s = columns["cursor_us"].astype(np.int64) // 1_000_000
+    series = {}
+    for sensor in np.unique(sensors):
+        mask = sensors == sensor
+        times = epoch_s[mask]
+        entry = {
+            "t0": int(times[0]),
+            "dt": np.diff(times).tolist(),
+            "value": _float_list(columns["value"][mask]),
+        }
+        for name in _STAT_COLUMNS:
+            if name in columns:
+                column = columns[name][mask]
+                entry[name] = column.astype(np.int64).tolist() if name == "count" else _float_list(column)
+        series[str(sensor)] = entry
+    return series
+
+
+def latest_timestamp(columns):
+    """Segundos epoch de la lectura más reciente, o None si no hay filas."""
+    if not len(columns["cursor_us"]):
+        return None
+    return int(columns["cursor_us"].max()) // 1_000_000
+
+
+def columnar_json(head, columns):
+    """Cuerpo JSON del formato por columnas: los campos de `head` más 'series'."""
+    return json.dumps({**head, "series": columnar_series(columns)}, separators=(",", ":"))
+
+
+def arrow_ipc(head, columns):
+    """
+    Cuerpo Arrow IPC (formato stream): columnas sensor (diccionario), timestamp
+    (segundos), value y, si existen, min, max y count. Los campos de `head` van
+    en los metadatos del esquema. Requiere pyarrow.
+    """
+    pa = _pyarrow()
+    if pa is None:
+        raise RuntimeError("El formato Arrow requiere pyarrow.")
+    arrays = {
+        "sensor": pa.array(columns["sensor"].astype(str)).dictionary_encode(),
+        "timestamp": pa.array(columns["cursor_us"].astype(np.int64) // 1_000_000, pa.int64()).cast(pa.timestamp("s", tz="UTC")),
+        "value": pa.array(columns["value"].astype(np.float64), from_pandas=True),
+    }
+    for name in _STAT_COLUMNS:
+        if name in columns:
+            arrays[name] = pa.array(columns[name], from_pandas=True)
+    table = pa.table(arrays).replace_schema_metadata({k: json.dumps(v) for k, v in head.items()})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
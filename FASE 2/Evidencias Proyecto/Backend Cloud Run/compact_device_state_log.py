@@ -0,0 +1,78 @@
+"""
+Trabajo que fusiona DEVICE_STATE_LOG en la tabla devices (para Cloud Scheduler,
+p. ej. cada 10 minutos).
+
+Los cambios de relé y modo se añaden al registro por streaming y se leen
+superpuestos a devices (ver device_state_store.current_devices_sql). Este trabajo
+los lleva a devices con un único MERGE (un UPDATE ... FROM en SQLite): por
+dispositivo, el último relé y el último modo registrados en la ventana DEVICE_STATE_LOG_WINDOW_S. Es idempotente, así que
+no necesita guardar hasta dónde llegó; basta con ejecutarlo bastante más seguido
+que esa ventana.
+
+Por consola:
+    python compact_device_state_log.py
+"""
+import json
+
+import functions_framework
+import instrumentation as log
+from backend_core import load_config, run_query, table_ref
+from device_state_store import DEVICE_STATE_LOG_WINDOW_S, latest_changes_sql
+from instrumentation import instrumented
+from storage import get_storage
+
+
+def build_merge_query():
+    """MERGE sobre devices de los últimos cambios registrados en los últimos @window_s segundos."""
+    latest = latest_changes_sql("TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL @window_s SECOND)")
+    changed = """(
+            p.relay_state IS NOT NULL AND d.state IS DISTINCT FROM p.relay_state
+            OR p.control_mode IS NOT NULL AND d.control_mode IS DISTINCT FROM p.control_mode
+        )"""
+    if get_storage().dialect == "sqlite":
+        # SQLite no tiene MERGE; UPDATE ... FROM hace lo mismo para filas existentes.
+        return f"""
+            UPDATE {table_ref(load_config().devices_table)} AS d SET
+                state = IFNULL(p.relay_state, d.state),
+                control_mode = IFNULL(p.control_mode, d.control_mode)
+            FROM {latest} p
+            WHERE d.device_id = p.device_id AND {changed}
+        """
+    return f"""
+        MERGE {table_ref(load_config().devices_table)} d
+        USING {latest} p
+        ON d.device_id = p.device_id
+        WHEN MATCHED AND {changed} THEN UPDATE SET
+            state = IFNULL(p.relay_state, d.state),
+            control_mode = IFNULL(p.control_mode, d.control_mode)
+    """
+
+
+def run_state_log_compaction():
+    """Ejecuta el MERGE y devuelve un resumen."""
+    query_job = run_query(build_merge_query(), [("window_s", "INT64", DEVICE_STATE_LOG_WINDOW_S)])
+    query_job.result()
+    summary = {
+        "devices_updated": query_job.num_dml_affected_rows or 0,
+        "bytes_processed": query_job.total_bytes_processed,
+    }
+    log.info("Registro de estados fusionado en devices.", **summary)
+    return summary
+
+
+@functions_framework.http
+@instrumented("compact_device_state_log")
+def compact_device_state_log(request):
+    """Función HTTP para Cloud Scheduler que fusiona DEVICE_STATE_LOG en devices."""
+    headers = {'Content-Type': 'application/json'}
+    try:
+        summary = run_state_log_compaction()
+        return (json.dumps({'status': 'success', **summary}), 200, headers)
+    except Exception as e:
+        log.error("Error al fusionar el registro de estados.", error=str(e))
+        response_data = {'status': 'error', 'message': 'Error al fusionar el registro de estados.', 'details': str(e)}
+        return (json.dumps(response_data), 500, headers)
+
+
+if __name__ == "__main__":
+    run_state_log_compaction()
@@ -0,0 +1,186 @@
+"""
+Trabajo de compactación de lecturas (para Cloud Scheduler, p. ej. una vez al día).
+
+1. Reescribe desde los crudos los agregados por minuto y hora de las horas ya
+   asentadas (SENSOR_ROLLUP_SETTLE_HOURS atrás, SENSOR_ROLLUP_LOOKBACK_HOURS hacia
+   atrás): las filas parciales de cada lote quedan en una sola fila exacta por cubeta.
+   Las cubetas con alguna fila parcial insertada hace menos de SENSOR_ROLLUP_SETTLE_HOURS
+   (lecturas atrasadas, p. ej. reenviadas desde el spool) se dejan para una próxima
+   ejecución: esas filas pueden seguir en el buffer de streaming y un DELETE que las
+   alcance haría fallar toda la transacción.
+2. Envejece las lecturas crudas más antiguas que SENSOR_RAW_RETENTION_DAYS: sus
+   agregados se reconstruyen desde los crudos y luego los crudos se borran.
+3. Registra la cobertura de los agregados (rollups.record_coverage): hasta que un
+   rango está reconstruido, los gráficos de ese rango leen los crudos.
+
+También sirve para poblar los agregados de datos históricos:
+    ?backfill_from=2024-01-01&backfill_to=2024-06-01
+o por consola:
+    python compact_sensor_readings.py --backfill-from 2024-01-01 --backfill-to 2024-06-01
+
+Solo para BigQuery: con STORAGE_BACKEND=sqlite los agregados parciales se suman
+al leer y el handler responde 501.
+"""
+import argparse
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+import functions_framework
+import instrumentation as log
+from backend_core import load_config, run_query, table_ref
+from instrumentation import instrumented
+from rollups import ROLLUP_LEVELS, SENSOR_RAW_RETENTION_DAYS, level_table, record_coverage
+from storage import get_storage
+from time_windows import parse_instant
+
+# --- Configuración ---
+# Horas que se espera antes de compactar (las filas recién insertadas por streaming
+# no se pueden modificar con DML) y cuántas horas hacia atrás se recompactan.
+SENSOR_ROLLUP_SETTLE_HOURS = int(os.environ.get("SENSOR_ROLLUP_SETTLE_HOURS", "3"))
+SENSOR_ROLLUP_LOOKBACK_HOURS = int(os.environ.get("SENSOR_ROLLUP_LOOKBACK_HOURS", "24"))
+
+_TRUNC_PART = {60: "MINUTE", 3600: "HOUR"}
+
+
+def _truncate_hour(dt):
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+def _unsettled_bucket_sql(rollup_ref, alias):
+    """Condición: la cubeta de `alias` tiene filas parciales insertadas después de @settled_before."""
+    return f"""EXISTS (
+                SELECT 1 FROM {rollup_ref} u
+                WHERE u.device_id = {alias}.device_id AND u.metric_type = {alias}.metric_type
+                  AND u.bucket_start = {alias}.bucket_start AND u.inserted_at >= @settled_before
+            )"""
+
+
+def _rebuild_statements(raw_ref, start_expr, end_expr):
+    """
+    Sentencias que reemplazan los agregados de [start, end) por los calculados desde
+    los crudos, salvo en las cubetas con filas parciales aún sin asentar.
+    """
+    statements = []
+    for level in ROLLUP_LEVELS:
+        rollup_ref = table_ref(level_table(level))
+        statements.append(f"""
+            DELETE FROM {rollup_ref} r
+            WHERE r.bucket_start >= {start_expr} AND r.bucket_start < {end_expr}
+              AND NOT {_unsettled_bucket_sql(rollup_ref, "r")};
+            INSERT INTO {rollup_ref} (device_id, metric_type, bucket_start, count, sum, min, max)
+            SELECT b.device_id, b.metric_type, b.bucket_start, b.count, b.sum, b.min, b.max
+            FROM (
+                SELECT
+                    device_id,
+                    metric_type,
+                    TIMESTAMP_TRUNC(timestamp, {_TRUNC_PART[level.seconds]}) AS bucket_start,
+                    COUNT(*) AS count, SUM(value) AS sum, MIN(value) AS min, MAX(value) AS max
+                FROM {raw_ref}
+                WHERE timestamp >= {start_expr} AND timestamp < {end_expr} AND value IS NOT NULL
+                GROUP BY device_id, metric_type, bucket_start
+            ) b
+            WHERE NOT {_unsettled_bucket_sql(rollup_ref, "b")};""")
+    return statements
+
+
+def build_compaction_script(age_raw=True):
+    """
+    Script de BigQuery (una transacción) con los parámetros @rebuild_start,
+    @rebuild_end, @settled_before y, si `age_raw`, @raw_cutoff.
+    """
+    raw_ref = table_ref(load_config().sensors_table)
+    declarations = []
+    statements = _rebuild_statements(raw_ref, "@rebuild_start", "@rebuild_end")
+    if age_raw:
+        declarations.append(f"""
+            DECLARE aging_start TIMESTAMP DEFAULT (
+                SELECT TIMESTAMP_TRUNC(MIN(timestamp), HOUR) FROM {raw_ref} WHERE timestamp < @raw_cutoff
+            );""")
+        statements.extend(_rebuild_statements(raw_ref, "aging_start", "@raw_cutoff"))
+        statements.append(f"""
+            DELETE FROM {raw_ref} WHERE timestamp < @raw_cutoff;""")
+    return "\n".join(declarations + ["BEGIN TRANSACTION;"] + statements + ["COMMIT TRANSACTION;"])
+
+
+def run_compaction(now=None, backfill_from=None, backfill_to=None):
+    """
+    Ejecuta la compactación y devuelve un resumen. Con backfill_from/backfill_to solo
+    reconstruye los agregados de ese rango (sin borrar crudos).
+    """
+    now = now or datetime.now(timezone.utc)
+    # Las filas parciales insertadas después de este instante pueden seguir en el buffer de streaming.
+    settled_before = now - timedelta(hours=SENSOR_ROLLUP_SETTLE_HOURS)
+    if backfill_from is not None:
+        rebuild_start = _truncate_hour(backfill_from)
+        rebuild_end = _truncate_hour(backfill_to or now - timedelta(hours=SENSOR_ROLLUP_SETTLE_HOURS))
+        raw_cutoff = None
+    else:
+        rebuild_end = _truncate_hour(now - timedelta(hours=SENSOR_ROLLUP_SETTLE_HOURS))
+        rebuild_start = rebuild_end - timedelta(hours=SENSOR_ROLLUP_LOOKBACK_HOURS)
+        raw_cutoff = _truncate_hour(now - timedelta(days=SENSOR_RAW_RETENTION_DAYS))
+        # La recompactación no necesita volver a tocar lo que ya se envejeció.
+        rebuild_start = max(rebuild_start, raw_cutoff)
+
+    params = [
+        ("rebuild_start", "TIMESTAMP", rebuild_start),
+        ("rebuild_end", "TIMESTAMP", rebuild_end),
+        ("settled_before", "TIMESTAMP", settled_before),
+    ]
+    if raw_cutoff is not None:
+        params.append(("raw_cutoff", "TIMESTAMP", raw_cutoff))
+
+    # Un backfill puede leer más que el presupuesto por consulta de los handlers.
+    query_job = run_query(build_compaction_script(age_raw=raw_cutoff is not None), params, bytes_budget=0)
+    query_job.result()
+
+    summary = {
+        "rebuild_start": rebuild_start.isoformat(),
+        "rebuild_end": rebuild_end.isoformat(),
+        "raw_cutoff": raw_cutoff.isoformat() if raw_cutoff is not None else None,
+        "bytes_processed": query_job.total_bytes_processed,
+        # Los gráficos usan un agregado solo desde el inicio de su cobertura.
+        "coverage": record_coverage(rebuild_start, rebuild_end),
+    }
+    log.info("Compactación de lecturas terminada.", **summary)
+    return summary
+
+
+@functions_framework.http
+@instrumented("compact_sensor_readings")
+def compact_sensor_readings(request):
+    """
+    Función HTTP para Cloud Scheduler que compacta agregados y envejece lecturas crudas.
+    Acepta 'backfill_from' y 'backfill_to' para reconstruir agregados de un rango.
+    """
+    headers = {'Content-Type': 'application/json'}
+    if get_storage().dialect != "bigquery":
+        response_data = {'status': 'error', 'message': 'La compactación de lecturas solo está disponible con BigQuery.'}
+        return (json.dumps(response_data), 501, headers)
+    try:
+        backfill_from = request.args.get('backfill_from')
+        backfill_to = request.args.get('backfill_to')
+        backfill_from = parse_instant(backfill_from) if backfill_from else None
+        backfill_to = parse_instant(backfill_to) if backfill_to else None
+    except ValueError:
+        response_data = {'status': 'error', 'message': "'backfill_from' y 'backfill_to' deben ser fechas ISO 8601."}
+        return (json.dumps(response_data), 400, headers)
+    if backfill_to is not None and backfill_from is None:
+        response_data = {'status': 'error', 'message': "'backfill_to' requiere 'backfill_from'."}
+        return (json.dumps(response_data), 400, headers)
+
+    try:
+        summary = run_compaction(backfill_from=backfill_from, backfill_to=backfill_to)
+        return (json.dumps({'status': 'success', **summary}), 200, headers)
+    except Exception as e:
+        log.error("Error en la compactación de lecturas.", error=str(e))
+        response_data = {'status': 'error', 'message': 'Error al compactar las lecturas.', 'details': str(e)}
+        return (json.dumps(response_data), 500, headers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backfill-from", type=parse_instant, default=None)
+    parser.add_argument("--backfill-to", type=parse_instant, default=None)
+    args = parser.parse_args()
+    run_compaction(backfill_from=args.backfill_from, backfill_to=args.backfill_to)
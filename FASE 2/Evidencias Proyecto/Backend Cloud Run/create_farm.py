@@ -1,22 +1,15 @@
 import functions_framework
 import json
-from google.cloud import bigquery
-import os
 import uuid
+from backend_core import insert_rows, load_config, warm_up
+import instrumentation as log
+from instrumentation import instrumented, stage
+import query_cache
 
-try:
-    PROJECT_ID = os.environ['BIGQUERY_PROJECT_ID'] 
-    DATASET_ID = os.environ['BIGQUERY_DATASET_ID'] 
-    BQ_CLIENT = bigquery.Client(project=PROJECT_ID) 
-    print(f"BigQuery Client inicializado para proyecto {PROJECT_ID} y dataset {DATASET_ID}")
-except KeyError as e:
-    print(f"CRITICAL: Variable de entorno {e} no encontrada.")
-    raise RuntimeError(f"Configuración de entorno incompleta: falta {e}") from e
-except Exception as e:
-    print(f"CRITICAL: Error inicializando BigQuery Client globalmente: {e}")
-    raise RuntimeError(f"No se pudo inicializar BigQuery Client: {e}") from e
+warm_up()
 
 @functions_framework.http
+@instrumented("create_farm_http")
 def create_farm_http(request):
     """HTTP Cloud Function para crear una nueva granja.
     Args:
@@ -41,7 +34,6 @@ def create_farm_http(request):
     if not user_uid_param: 
         return (json.dumps({"error": "Falta el parámetro 'user_uid' en la URL o token de autorización"}), 400, headers)
     user_uid_to_create_for = user_uid_param
-    print(f"Usando user_uid del parámetro de URL: {user_uid_to_create_for}")
 
     try:
         data = request.get_json(silent=True) 
@@ -50,7 +42,7 @@ def create_farm_http(request):
         if 'farm_name' not in data or not data['farm_name'].strip(): 
             return (json.dumps({"error": "Falta 'farm_name' o está vacío en el cuerpo JSON de la solicitud"}), 400, headers)
     except Exception as e: 
-        print(f"Error parseando JSON en create_farm: {e}")
+        log.warning("Error parseando JSON en create_farm.", error=str(e))
         return (json.dumps({"error": "Cuerpo JSON inválido", "details": str(e)}), 400, headers)
         
     db_farm_name = data['farm_name'].strip()
@@ -70,9 +62,9 @@ def create_farm_http(request):
             elif status_from_request.lower() in ['false', 'inactive', '0']:
                 status_boolean = False
             else:
-                print(f"Valor de status no reconocido '{status_from_request}', usando default True.")
+                log.warning("Valor de status no reconocido, usando default True.", status=status_from_request)
         else:
-            print(f"Tipo de status no esperado '{type(status_from_request)}', usando default True.")
+            log.warning("Tipo de status no esperado, usando default True.", status_type=type(status_from_request).__name__)
     
     new_farm_id = str(uuid.uuid4())
 
@@ -86,12 +78,14 @@ def create_farm_http(request):
         "status": status_boolean,
     }]
     
-    table_ref = BQ_CLIENT.dataset(DATASET_ID).table('farms') 
     try:
-        print(f"Intentando insertar nueva granja: ID={new_farm_id}, Usuario={user_uid_to_create_for}, Nombre='{db_farm_name}', Status={status_boolean}")
-        errors = BQ_CLIENT.insert_rows_json(table_ref, rows_to_insert) 
+        with stage("storage"):
+            errors = insert_rows(load_config().farms_table, rows_to_insert)
         
         if not errors:
+            # El listado de granjas de este usuario ya no es válido en esta instancia; en
+            # list_user_farms caduca por TTL o se salta con ?fresh=true (ver query_cache).
+            query_cache.invalidate(("farms", user_uid_to_create_for))
             response_data = {
                 "farm_id": new_farm_id,            
                 "farm_name": db_farm_name,         
@@ -101,10 +95,10 @@ def create_farm_http(request):
                 "status": status_boolean,
                 "user_uid": user_uid_to_create_for 
             }
-            print(f"Nueva granja creada exitosamente: {new_farm_id}. Respuesta: {response_data}")
+            log.info("Nueva granja creada.", farm_id=new_farm_id, user_uid=user_uid_to_create_for)
             return (json.dumps(response_data), 201, headers)
         else:
-            print(f"Errores al insertar nueva granja {new_farm_id} en BigQuery: {errors}")
+            log.error("Errores al insertar nueva granja en BigQuery.", farm_id=new_farm_id, errors=errors)
             error_details_str = str(errors)
             if len(error_details_str) > 500:
                  error_details_str = error_details_str[:500] + "..."
@@ -114,7 +108,7 @@ def create_farm_http(request):
             }), 500, headers)
             
     except Exception as e:
-        print(f"Excepción crítica al insertar en BigQuery para granja {new_farm_id}: {e}")
+        log.error("Excepción crítica al insertar en BigQuery.", farm_id=new_farm_id, error=str(e))
         return (json.dumps({
             "error": "Error interno del servidor al intentar crear la granja.",
             "details": "Se ha producido un error inesperado."
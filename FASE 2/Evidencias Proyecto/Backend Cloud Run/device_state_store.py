@@ -0,0 +1,432 @@
+import os
+import threading
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+
+import instrumentation as log
+from backend_core import insert_rows, load_config, run_query, table_ref
+from ingest_buffer import get_buffer
+from storage import get_storage
+
+# --- Configuración ---
+# Antigüedad (segundos) a partir de la cual una lectura del almacén pide, en segundo
+# plano, los cambios registrados desde otras instancias en DEVICE_STATE_LOG. Las
+# escrituras de esta instancia se ven al instante.
+STATE_STORE_REFRESH_S = float(os.environ.get("STATE_STORE_REFRESH_S", "30"))
+# Mientras haya clientes esperando cambios (long-poll), los cambios de los dispositivos
+# observados se piden a DEVICE_STATE_LOG en una sola consulta cada STATE_WATCH_POLL_S
+# segundos; si no llega ninguno, el intervalo se duplica hasta STATE_WATCH_MAX_POLL_S.
+STATE_WATCH_POLL_S = float(os.environ.get("STATE_WATCH_POLL_S", "2"))
+STATE_WATCH_MAX_POLL_S = float(os.environ.get("STATE_WATCH_MAX_POLL_S", "16"))
+
+# Los cambios de relé y modo se añaden a DEVICE_STATE_LOG en lotes (ver ingest_buffer).
+STATE_LOG_BATCH_SIZE = int(os.environ.get("STATE_LOG_BATCH_SIZE", "500"))
+STATE_LOG_MAX_LINGER_MS = int(os.environ.get("STATE_LOG_MAX_LINGER_MS", "500"))
+# Margen (segundos) para que una fila insertada por streaming aparezca en las consultas.
+STATE_LOG_VISIBILITY_S = float(os.environ.get("STATE_LOG_VISIBILITY_S", "5"))
+# Ventana del registro que se superpone a devices al leer. compact_device_state_log
+# debe ejecutarse con una frecuencia bastante mayor (p. ej. cada 10 minutos).
+DEVICE_STATE_LOG_WINDOW_S = int(os.environ.get("DEVICE_STATE_LOG_WINDOW_S", "86400"))
+
+DEFAULT_RELAY_STATE = False
+DEFAULT_CONTROL_MODE = 'MANUAL'
+
+
+def _insert_log_rows(rows):
+    return insert_rows(load_config().device_state_log_table, rows)
+
+
+def latest_changes_sql(since_expr):
+    """Último relé y último modo registrados por dispositivo en DEVICE_STATE_LOG desde `since_expr`."""
+    return f"""(
+        SELECT
+            device_id,
+            ARRAY_AGG(relay_state IGNORE NULLS ORDER BY changed_at DESC LIMIT 1)[SAFE_OFFSET(0)] AS relay_state,
+            ARRAY_AGG(control_mode IGNORE NULLS ORDER BY changed_at DESC LIMIT 1)[SAFE_OFFSET(0)] AS control_mode
+        FROM {table_ref(load_config().device_state_log_table)}
+        WHERE changed_at >= {since_expr}
+        GROUP BY device_id
+    )"""
+
+
+def current_devices_sql():
+    """
+    Subconsulta con las filas de devices y su estado vigente: lo fusionado en devices
+    más los cambios del registro que aún no se fusionaron.
+    """
+    since_expr = f"TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL {DEVICE_STATE_LOG_WINDOW_S} SECOND)"
+    if get_storage().dialect == "sqlite":
+        # SQLite no tiene SELECT * REPLACE: se listan las columnas de sqlite_schema.sql.
+        columns = """
+            d.device_id, d.crop_id, d.device_name, d.arduino_thing_id, d.arduino_property_id,
+            IFNULL(p.relay_state, d.state) AS state,
+            IFNULL(p.control_mode, d.control_mode) AS control_mode
+        """
+    else:
+        columns = """d.* REPLACE (
+            IFNULL(p.relay_state, d.state) AS state,
+            IFNULL(p.control_mode, d.control_mode) AS control_mode
+        )"""
+    return f"""(
+        SELECT {columns}
+        FROM {table_ref(load_config().devices_table)} d
+        LEFT JOIN {latest_changes_sql(since_expr)} p ON p.device_id = d.device_id
+    )"""
+
+
+class DeviceState(namedtuple("DeviceState", ["relay_state", "control_mode", "version"])):
+    """Estado de un dispositivo. `version` aumenta en cada cambio dentro del proceso."""
+
+    @property
+    def etag(self):
+        # Depende solo del contenido, así coincide entre instancias distintas.
+        return f'"{int(bool(self.relay_state))}-{self.control_mode}"'
+
+    def to_dict(self):
+        return {
+            'relay_state': self.relay_state,
+            'control_mode': self.control_mode,
+            'version': self.version,
+        }
+
+
+class DeviceStateStore:
+    """
+    Almacén clave-valor en memoria del estado (relé y modo) de cada dispositivo.
+
+    Se carga en bloque desde BigQuery con una sola consulta en la primera lectura.
+    Después, una lectura que encuentra los datos con más de STATE_STORE_REFRESH_S
+    segundos lanza en segundo plano una consulta incremental a DEVICE_STATE_LOG
+    (solo los cambios desde la anterior) y responde con lo que hay. Un proceso que
+    no lee no consulta nada; las lecturas solo esperan la carga inicial y los
+    dispositivos aún desconocidos.
+    Las escrituras se añaden a DEVICE_STATE_LOG (sin esperar un UPDATE) y se
+    reflejan en memoria al instante; BigQuery sigue siendo la fuente para recuperarse.
+    """
+
+    def __init__(self, refresh_s=STATE_STORE_REFRESH_S, watch_poll_s=STATE_WATCH_POLL_S,
+                 watch_max_poll_s=STATE_WATCH_MAX_POLL_S):
+        self.refresh_s = refresh_s
+        self.watch_poll_s = watch_poll_s
+        self.watch_max_poll_s = max(watch_poll_s, watch_max_poll_s)
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._states = {}
+        self._missing = set()
+        self._written_at = {}
+        self._loaded_at = None
+        # Desde qué instante (UTC) pedir cambios a DEVICE_STATE_LOG en la próxima recarga.
+        self._changes_since = None
+        self._version = 0
+        # device_id -> conjunto de threading.Event de los clientes que esperan un cambio.
+        self._waiters = {}
+        self._watch_thread = None
+        self._refresh_thread = None
+
+    # --- Lectura ---
+
+    def get(self, device_id):
+        """Devuelve el DeviceState del dispositivo o None si no existe."""
+        self._ensure_fresh()
+        with self._lock:
+            state = self._states.get(device_id)
+            if state is not None or device_id in self._missing:
+                return state
+        # Dispositivo creado después de la última carga en bloque.
+        return self._load_one(device_id)
+
+    def ensure_loaded(self):
+        """Hace la carga inicial en bloque si aún no se hizo."""
+        with self._refresh_lock:
+            if self._loaded_at is None:
+                self.load_all()
+
+    def _ensure_fresh(self):
+        loaded_at = self._loaded_at
+        if loaded_at is None:
+            # Primera carga: todos esperan a que termine.
+            self.ensure_loaded()
+            return
+        if time.monotonic() - loaded_at < self.refresh_s:
+            return
+        # Recarga incremental en un hilo de una sola pasada; la lectura no la espera.
+        with self._lock:
+            if self._refresh_thread is not None and self._refresh_thread.is_alive():
+                return
+            self._refresh_thread = threading.Thread(target=self._refresh_once, name="device-state-refresh", daemon=True)
+            self._refresh_thread.start()
+
+    def _refresh_once(self):
+        try:
+            with self._refresh_lock:
+                self.refresh_changes()
+        except Exception as e:
+            log.warning("No se pudo recargar el estado de los dispositivos.", error=str(e))
+
+    def _next_changes_since(self, started):
+        # Una fila del registro puede hacerse visible hasta el linger del buffer más
+        # el margen de streaming después de su changed_at: la ventana se solapa.
+        return started - timedelta(seconds=STATE_LOG_MAX_LINGER_MS / 1000.0 + STATE_LOG_VISIBILITY_S)
+
+    def refresh_changes(self):
+        """Aplica los cambios registrados en DEVICE_STATE_LOG desde la recarga anterior."""
+        query = f"""
+            SELECT device_id, relay_state, control_mode
+            FROM {latest_changes_sql("@since")}
+        """
+        started = datetime.now(timezone.utc)
+        if self._changes_since is None or started - self._changes_since >= timedelta(seconds=DEVICE_STATE_LOG_WINDOW_S):
+            # Sin lecturas durante más de la ventana del registro: hace falta la tabla completa.
+            self.load_all()
+            return
+        started_at = time.monotonic()
+        rows = list(run_query(query, [("since", "TIMESTAMP", self._changes_since)]).result())
+        with self._lock:
+            self._apply_changes(rows, started_at)
+            self._changes_since = self._next_changes_since(started)
+            self._loaded_at = time.monotonic()
+
+    def load_all(self):
+        """Reconstruye el almacén completo con una sola consulta a la tabla devices."""
+        query = f"""
+            SELECT device_id, state, control_mode
+            FROM {current_devices_sql()}
+        """
+        started = datetime.now(timezone.utc)
+        started_at = time.monotonic()
+        rows = list(run_query(query).result())
+        with self._lock:
+            self._changes_since = self._next_changes_since(started)
+            previous = self._states
+            self._states = {}
+            for row in rows:
+                current = previous.get(row.device_id)
+                if current is not None and self._written_at.get(row.device_id, 0) > started_at:
+                    # Escritura local posterior al inicio de la consulta: se conserva.
+                    self._states[row.device_id] = current
+                else:
+                    self._states[row.device_id] = self._merge(current, row.state, row.control_mode)
+            self._missing = set()
+            self._written_at = {k: v for k, v in self._written_at.items() if v > started_at}
+            self._loaded_at = time.monotonic()
+            self._notify_changed(previous)
+        log.info("Estado de los dispositivos cargado.", devices=len(rows))
+
+    def _load_one(self, device_id):
+        query = f"""
+            SELECT state, control_mode
+            FROM {current_devices_sql()}
+            WHERE device_id = @device_id
+            LIMIT 1
+        """
+        rows = list(run_query(query, [("device_id", "STRING", device_id)]).result())
+        with self._lock:
+            if not rows:
+                self._missing.add(device_id)
+                return None
+            previous = {device_id: self._states.get(device_id)}
+            state = self._store(device_id, rows[0].state, rows[0].control_mode)
+            self._notify_changed(previous)
+            return state
+
+    # --- Espera de cambios (long-poll) ---
+
+    def wait_for_change(self, device_id, since_version=None, since_etag=None, timeout_s=25.0):
+        """
+        Bloquea hasta que el estado del dispositivo difiera de lo que el cliente
+        ya conoce (`since_etag` o `since_version`) o hasta `timeout_s`.
+        Devuelve (estado, cambió). El estado es None si el dispositivo no existe.
+
+        Cada espera es un threading.Event registrado por dispositivo: un cambio
+        despierta solo a quienes observan ese dispositivo.
+        """
+        state = self.get(device_id)
+        if state is None or _is_newer(state, since_version, since_etag):
+            return state, state is not None
+
+        event = threading.Event()
+        with self._lock:
+            self._waiters.setdefault(device_id, set()).add(event)
+            state = self._states.get(device_id, state)
+            self._start_watch_thread()
+        try:
+            if not _is_newer(state, since_version, since_etag):
+                event.wait(timeout_s)
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(device_id)
+                if waiters is not None:
+                    waiters.discard(event)
+                    if not waiters:
+                        del self._waiters[device_id]
+                state = self._states.get(device_id, state)
+        return state, _is_newer(state, since_version, since_etag)
+
+    def watcher_count(self):
+        with self._lock:
+            return sum(len(w) for w in self._waiters.values())
+
+    def _start_watch_thread(self):
+        if self._watch_thread is None or not self._watch_thread.is_alive():
+            self._watch_thread = threading.Thread(target=self._watch_loop, name="device-state-watch", daemon=True)
+            self._watch_thread.start()
+
+    def _watch_loop(self):
+        # Recoge los cambios hechos desde otras instancias para los dispositivos
+        # observados. Sin cambios, cada consulta espera el doble que la anterior
+        # (hasta watch_max_poll_s); un cambio vuelve al intervalo inicial.
+        # Termina cuando ya no queda nadie esperando.
+        interval = self.watch_poll_s
+        since = self._changes_since
+        while True:
+            time.sleep(interval)
+            with self._lock:
+                device_ids = list(self._waiters)
+                if not device_ids:
+                    self._watch_thread = None
+                    return
+            started = datetime.now(timezone.utc)
+            changed = 0
+            try:
+                changed = self._reload_devices(device_ids, since)
+                since = self._next_changes_since(started)
+            except Exception as e:
+                log.warning("No se pudo consultar el estado de los dispositivos observados.", error=str(e))
+            interval = self.watch_poll_s if changed else min(interval * 2, self.watch_max_poll_s)
+
+    def _reload_devices(self, device_ids, since):
+        """Aplica los cambios de DEVICE_STATE_LOG desde `since` para `device_ids`. Devuelve cuántos cambiaron."""
+        query = f"""
+            SELECT device_id, relay_state, control_mode
+            FROM {latest_changes_sql("@since")}
+            WHERE device_id IN UNNEST(@device_ids)
+        """
+        started_at = time.monotonic()
+        params = [("since", "TIMESTAMP", since), ("device_ids", "STRING", device_ids)]
+        rows = list(run_query(query, params).result())
+        with self._lock:
+            return self._apply_changes(rows, started_at)
+
+    # --- Escritura (registro de cambios) ---
+
+    def set_control_mode(self, device_id, mode):
+        """Registra el cambio de modo y lo refleja en memoria. Devuelve None si el dispositivo no existe."""
+        return self.set_control_modes({device_id: mode})[device_id]
+
+    def set_relay_state(self, device_id, relay_state):
+        """Registra el cambio de relé y lo refleja en memoria. Devuelve None si el dispositivo no existe."""
+        return self.set_relay_states({device_id: relay_state})[device_id]
+
+    def set_control_modes(self, modes):
+        """Cambia el modo de varios dispositivos ({device_id: modo}) en un solo lote del registro."""
+        return self._append_changes({device_id: (None, mode) for device_id, mode in modes.items()})
+
+    def set_relay_states(self, relay_states):
+        """Cambia el relé de varios dispositivos ({device_id: bool}) en un solo lote del registro."""
+        return self._append_changes({device_id: (bool(state), None) for device_id, state in relay_states.items()})
+
+    def _append_changes(self, changes):
+        """
+        Añade los cambios {device_id: (relay_state, control_mode)} a DEVICE_STATE_LOG por
+        streaming (sin DML) y los aplica en memoria de inmediato; compact_device_state_log
+        los fusiona después en devices con un MERGE. Devuelve {device_id: DeviceState o None}.
+        """
+        results = {}
+        for device_id in changes:
+            if self.get(device_id) is None:
+                results[device_id] = None
+
+        changed_at = datetime.now(timezone.utc).isoformat()
+        rows = [
+            {
+                "change_id": str(uuid.uuid4()),
+                "device_id": device_id,
+                "relay_state": relay_state,
+                "control_mode": control_mode,
+                "changed_at": changed_at,
+            }
+            for device_id, (relay_state, control_mode) in changes.items()
+            if device_id not in results
+        ]
+        if rows:
+            get_buffer(
+                "device_state_log", _insert_log_rows,
+                batch_size=STATE_LOG_BATCH_SIZE, max_linger_s=STATE_LOG_MAX_LINGER_MS / 1000.0,
+            ).add(rows)
+
+        with self._lock:
+            # Las recargas que empiecen antes de que el cambio sea visible en BigQuery
+            # no deben pisarlo: se protege durante el linger del buffer más un margen.
+            protected_until = time.monotonic() + STATE_LOG_MAX_LINGER_MS / 1000.0 + STATE_LOG_VISIBILITY_S
+            previous = {}
+            for row in rows:
+                device_id = row["device_id"]
+                current = self._states.get(device_id)
+                previous[device_id] = current
+                relay_state = current.relay_state if row["relay_state"] is None else row["relay_state"]
+                control_mode = current.control_mode if row["control_mode"] is None else row["control_mode"]
+                self._written_at[device_id] = protected_until
+                results[device_id] = self._store(device_id, relay_state, control_mode)
+            self._notify_changed(previous)
+        return results
+
+    # --- Internos (se llaman con el lock tomado) ---
+
+    def _merge(self, current, relay_state, control_mode):
+        # bool(): SQLite devuelve los BOOLEAN como 0/1.
+        relay_state = bool(relay_state) if relay_state is not None else DEFAULT_RELAY_STATE
+        control_mode = control_mode if control_mode is not None else DEFAULT_CONTROL_MODE
+        if current is not None and current.relay_state == relay_state and current.control_mode == control_mode:
+            return current
+        self._version += 1
+        return DeviceState(relay_state, control_mode, self._version)
+
+    def _store(self, device_id, relay_state, control_mode):
+        state = self._merge(self._states.get(device_id), relay_state, control_mode)
+        self._states[device_id] = state
+        return state
+
+    def _apply_changes(self, rows, started_at):
+        # Aplica filas de latest_changes_sql (None = sin cambio en ese campo) salvo a los
+        # dispositivos escritos aquí después de `started_at`. Devuelve cuántos cambiaron.
+        previous = {}
+        for row in rows:
+            current = self._states.get(row.device_id)
+            if current is None:
+                # Dispositivo aún no cargado: se consulta completo al leerlo.
+                self._missing.discard(row.device_id)
+                continue
+            if self._written_at.get(row.device_id, 0) > started_at:
+                continue
+            previous[row.device_id] = current
+            relay_state = current.relay_state if row.relay_state is None else row.relay_state
+            control_mode = current.control_mode if row.control_mode is None else row.control_mode
+            self._store(row.device_id, relay_state, control_mode)
+        self._notify_changed(previous)
+        return sum(1 for device_id, state in previous.items() if self._states[device_id] is not state)
+
+    def _notify_changed(self, previous):
+        # Despierta a quienes esperan un dispositivo cuyo estado cambió respecto de `previous`.
+        for device_id, waiters in self._waiters.items():
+            if device_id in previous and self._states.get(device_id) is not previous[device_id]:
+                for event in waiters:
+                    event.set()
+
+
+def _is_newer(state, since_version, since_etag):
+    """Indica si `state` es distinto de lo que el cliente ya conoce."""
+    if since_etag:
+        return state.etag != since_etag
+    if since_version is not None:
+        return state.version > since_version
+    return True
+
+
+_store = DeviceStateStore()
+
+
+def get_device_state_store():
+    """Almacén de estado de dispositivos compartido por todo el proceso."""
+    return _store
@@ -0,0 +1,52 @@
+import math
+import os
+import re
+
+# --- Configuración ---
+# Puntos máximos por métrica que devuelve una consulta de gráfico, y tope que puede pedir el cliente.
+DEFAULT_MAX_POINTS = int(os.environ.get("SENSOR_MAX_POINTS", "1000"))
+MAX_POINTS_LIMIT = int(os.environ.get("SENSOR_MAX_POINTS_LIMIT", "10000"))
+MIN_POINTS = 4
+
+_RESOLUTION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+_RESOLUTION_RE = re.compile(r"^(\d+)([smhd]?)$")
+
+
+def parse_max_points(value):
+    """Valida el parámetro 'max_points'. Lanza ValueError con un mensaje para el cliente."""
+    if value in (None, ''):
+        return DEFAULT_MAX_POINTS
+    try:
+        max_points = int(value)
+    except ValueError:
+        raise ValueError("El parámetro 'max_points' debe ser un entero.")
+    if not MIN_POINTS <= max_points <= MAX_POINTS_LIMIT:
+        raise ValueError(f"El parámetro 'max_points' debe estar entre {MIN_POINTS} y {MAX_POINTS_LIMIT}.")
+    return max_points
+
+
+def parse_resolution(value):
+    """
+    Convierte 'resolution' (p. ej. '30s', '5m', '1h', '1d' o segundos) en segundos, o None.
+    Lanza ValueError con un mensaje para el cliente.
+    """
+    if value in (None, ''):
+        return None
+    match = _RESOLUTION_RE.match(value.strip().lower())
+    if not match or int(match.group(1)) == 0:
+        raise ValueError("El parámetro 'resolution' debe ser una duración como '30s', '5m', '1h' o '1d'.")
+    return int(match.group(1)) * _RESOLUTION_UNITS[match.group(2) or "s"]
+
+
+def bucket_seconds(range_s, max_points, resolution_s=None):
+    """
+    Tamaño de cubeta (segundos) para reducir `range_s` segundos a lo más `max_points`
+    puntos por métrica con cubetas min/max (dos puntos por cubeta) más la última lectura.
+
+    Las cubetas se alinean a la época Unix, así que un rango puede tocar una cubeta
+    más de las que caben exactas; por eso se reserva una.
+    La resolución pedida se respeta salvo que supere el tope de puntos.
+    """
+    buckets = max(1, (max_points - 1) // 2 - 1)
+    minimum_s = max(1, math.ceil(range_s / buckets))
+    return max(minimum_s, resolution_s or 0)
@@ -1,150 +1,285 @@
 import functions_framework
 import os
-import uuid
-from google.cloud import bigquery
-from datetime import datetime, timezone
 import json 
-from pytz import timezone as pytz_timezone
+import time
 
-DEVICE_LOGIN_NAME = os.environ.get("DEVICE_LOGIN_NAME") 
-BIGQUERY_PROJECT_ID = os.environ.get("BIGQUERY_PROJECT_ID")
-BIGQUERY_DATASET_ID = os.environ.get("BIGQUERY_DATASET_ID")
-BIGQUERY_TABLE_ID = os.environ.get("BIGQUERY_TABLE_ID") 
+import instrumentation as log
+from backend_core import insert_rows, load_config, warm_up
+from ingest_buffer import INGEST_BATCH_SIZE, get_buffer
+from ingest_dedup import fresh_indices, remember
+from ingest_envelope import EnvelopeError, is_envelope_request, iter_envelope_objects
+from ingest_spool import INGEST_SPOOL_ENABLED, Spool, get_spool
+from instrumentation import instrumented, observe_stage, stage
+from rollups import record_rollups
+from sensor_normalization import VECTORIZE_MIN_ITEMS, extract_items, normalize_items
 
-bq_client = bigquery.Client(project=BIGQUERY_PROJECT_ID)
+DEVICE_LOGIN_NAME = load_config().device_login_name
 
-SANTIAGO_TZ = pytz_timezone('America/Santiago')
+# El camino por columnas (NumPy) se precarga en segundo plano junto con el cliente.
+warm_up("sensor_columnar")
 
-@functions_framework.http
-def handle_incoming_sensor_data(request):
-    print("--- Inicio de petición ---")
-    
+# Si es verdadero, toda petición espera a que BigQuery confirme la inserción.
+# Cada petición puede activarlo con ?wait_for_commit=true o "wait_for_commit": true.
+INGEST_WAIT_FOR_COMMIT = os.environ.get("INGEST_WAIT_FOR_COMMIT", "false").lower() == "true"
+INGEST_COMMIT_TIMEOUT_S = float(os.environ.get("INGEST_COMMIT_TIMEOUT_S", "30"))
+
+
+def _insert_sensor_rows(rows):
+    # Segundo filtro, al vaciar: quita las repeticiones que entraron al buffer antes de
+    # que se confirmara la primera copia, para no contarlas dos veces en los agregados.
+    keep = fresh_indices(rows, "flush")
+    batch = [rows[i] for i in keep]
+    # sensor_reading_id es determinista: sirve de ID de inserción en BigQuery.
+    errors = insert_rows(load_config().sensors_table, batch, row_ids=[row["sensor_reading_id"] for row in batch])
+    failed = {error["index"] for error in errors}
+    inserted = [row for i, row in enumerate(batch) if i not in failed]
+    remember(inserted)
+    # Los agregados por minuto y hora se actualizan con cada lote ya guardado.
+    record_rollups(inserted)
+    # Si este proceso mantiene la capa caliente (hot_tier), se alimenta con lo ya guardado.
+    from hot_tier import get_hot_tier
+    get_hot_tier().ingest(inserted)
+    # El buffer espera los índices relativos a las filas que recibió.
+    return [dict(error, index=keep[error["index"]]) for error in errors]
+
+
+def _ingest_queue():
+    """
+    Cola de las lecturas aceptadas: el spool en disco si INGEST_SPOOL_ENABLED (y este
+    proceso lo pudo tomar), si no el buffer en memoria. Ambos: add(rows) -> Future.
+    """
+    if INGEST_SPOOL_ENABLED:
+        spool = get_spool("sensor_readings", _insert_sensor_rows)
+        if spool is not None:
+            return spool
+    return get_buffer("sensor_readings", _insert_sensor_rows)
+
+
+def _drop_duplicates(rows):
+    """Quita las lecturas ya insertadas hace poco (reintentos); devuelve (filas, repetidas)."""
+    keep = fresh_indices(rows, "request")
+    if len(keep) == len(rows):
+        return rows, 0
+    return [rows[i] for i in keep], len(rows) - len(keep)
+
+
+def _duplicates_response(duplicates):
+    return {
+        "status": "success",
+        "message": "Las lecturas ya se habían recibido.",
+        "committed": True,
+        "duplicates": duplicates
+    }, 200
+
+
+def _wants_commit(request, data):
+    param = request.args.get("wait_for_commit")
+    if param is not None:
+        return param.lower() in ("true", "1")
+    if isinstance(data, dict) and "wait_for_commit" in data:
+        return bool(data["wait_for_commit"])
+    return INGEST_WAIT_FOR_COMMIT
+
+
+def build_sensor_rows(data):
+    """
+    Construye las filas a insertar a partir de un documento de un dispositivo.
+    Devuelve None si el documento no tiene un formato reconocido.
+    Los documentos con muchos items (cargas masivas) se normalizan por columnas.
+    """
+    extracted = extract_items(data, DEVICE_LOGIN_NAME)
+    if extracted is None:
+        return None
+    device_id, items, event_timestamp_str = extracted
+    if len(items) >= VECTORIZE_MIN_ITEMS:
+        from sensor_columnar import ReadingColumns
+        columns = ReadingColumns(DEVICE_LOGIN_NAME)
+        columns.add_items(device_id, items, event_timestamp_str)
+        return columns.normalize()
+    return normalize_items(device_id, items, event_timestamp_str)
+
+
+def _ingest_response(pending, row_count, wait_for_commit):
+    """Responde tras encolar; si se pidió, espera antes la confirmación de BigQuery."""
+    if not wait_for_commit:
+        return {
+            "status": "success",
+            "message": f"{row_count} datos recibidos, se guardarán en BigQuery.",
+            "committed": False
+        }, 200
+
+    insertion_errors = []
     try:
-        if not all([BIGQUERY_PROJECT_ID, BIGQUERY_DATASET_ID, BIGQUERY_TABLE_ID]):
-            print("Error: Faltan variables de entorno requeridas para BigQuery.")
+        for future in pending:
+            insertion_errors.extend(future.result(timeout=INGEST_COMMIT_TIMEOUT_S))
+    except TimeoutError:
+        if isinstance(_ingest_queue(), Spool):
+            # Las filas ya están en el spool en disco: se enviarán cuando BigQuery responda.
+            log.warning("Sin confirmación de BigQuery a tiempo; las lecturas quedan en el spool.", rows=row_count)
             return {
-                "status": "error",
-                "message": "Configuración incompleta en el servidor (faltan variables de entorno de BigQuery)."
-            }, 500
+                "status": "success",
+                "message": f"{row_count} datos guardados en el spool local, se enviarán a BigQuery.",
+                "committed": False
+            }, 202
+        raise
+
+    if insertion_errors == []:
+        log.info("Datos insertados en BigQuery.", sampled=True, rows=row_count)
+        return {
+            "status": "success",
+            "message": f"{row_count} datos guardados en BigQuery.",
+            "committed": True
+        }, 200
+    else:
+        log.error("Errores al insertar en BigQuery.", errors=insertion_errors)
+        return {
+            "status": "error",
+            "message": "Ocurrieron errores al insertar datos en BigQuery.",
+            "bigquery_errors": insertion_errors
+        }, 500
+
 
-        if request.method != 'POST':
-            print(f"Método no permitido: {request.method}. Se esperaba POST.")
-            return {"status": "error", "message": "Método no permitido. Usar POST."}, 405
+def _handle_envelope(request):
+    """
+    Procesa un sobre con lecturas de varios dispositivos (NDJSON o array JSON,
+    opcionalmente con Content-Encoding gzip/deflate). El cuerpo se lee como
+    flujo y las filas se encolan por trozos de INGEST_BATCH_SIZE.
+    """
+    from sensor_columnar import ReadingColumns
+    buffer = _ingest_queue()
+    columns = ReadingColumns(DEVICE_LOGIN_NAME)
+    pending = []
+    row_count, document_count, skipped_documents, duplicates = 0, 0, 0, 0
+    # La lectura del sobre intercala las tres etapas; se mide cada una por separado.
+    started_at = time.perf_counter()
+    normalize_s = storage_s = 0.0
 
-        data = None
+    def flush():
+        nonlocal row_count, duplicates, normalize_s, storage_s
+        t0 = time.perf_counter()
+        rows, dropped = _drop_duplicates(columns.normalize())
+        columns.clear()
+        duplicates += dropped
+        t1 = time.perf_counter()
+        if rows:
+            pending.append(buffer.add(rows))
+            row_count += len(rows)
+        normalize_s += t1 - t0
+        storage_s += time.perf_counter() - t1
+
+    try:
+        try:
+            for document in iter_envelope_objects(request):
+                document_count += 1
+                if not columns.add_document(document):
+                    skipped_documents += 1
+                    continue
+                if len(columns) >= INGEST_BATCH_SIZE:
+                    flush()
+            flush()
+        finally:
+            observe_stage("parse", time.perf_counter() - started_at - normalize_s - storage_s)
+            observe_stage("normalize", normalize_s)
+    except EnvelopeError as e:
+        # Las filas ya encoladas se conservan; se informa cuántas se aceptaron.
+        observe_stage("storage", storage_s)
+        log.warning("Sobre inválido.", documents=document_count, accepted_rows=row_count, error=str(e))
+        return {
+            "status": "error",
+            "message": f"Sobre de lecturas inválido: {e}",
+            "accepted_rows": row_count
+        }, 400
+
+    log.info("Sobre procesado.", sampled=True, documents=document_count, rows=row_count,
+             skipped_documents=skipped_documents, duplicates=duplicates)
+    if not row_count and duplicates:
+        observe_stage("storage", storage_s)
+        return _duplicates_response(duplicates)
+    if not row_count:
+        observe_stage("storage", storage_s)
+        return {"status": "warning", "message": "No se encontraron datos válidos en el payload para insertar en BigQuery."}, 200
+
+    try:
+        t0 = time.perf_counter()
+        try:
+            body, status = _ingest_response(pending, row_count, _wants_commit(request, None))
+            if duplicates:
+                body["duplicates"] = duplicates
+            return body, status
+        finally:
+            observe_stage("storage", storage_s + time.perf_counter() - t0)
+    except Exception as e:
+        log.error("Error general al interactuar con BigQuery.", error=str(e))
+        return {
+            "status": "error",
+            "message": f"Error interno al guardar datos en BigQuery: {str(e)}"
+        }, 500
+
+@functions_framework.http
+@instrumented("handle_incoming_sensor_data")
+def handle_incoming_sensor_data(request):
+    if request.method != 'POST':
+        log.warning("Método no permitido, se esperaba POST.", method=request.method)
+        return {"status": "error", "message": "Método no permitido. Usar POST."}, 405
+
+    if is_envelope_request(request):
+        return _handle_envelope(request)
+
+    data = None
+    with stage("parse"):
         try:
             data = request.get_json(silent=False)
-            print(f"Cuerpo de la petición parseado por get_json(): {data}")
         except Exception as e:
-            print(f"Error al parsear el cuerpo de la petición como JSON con get_json(): {e}")
+            log.warning("El cuerpo no se pudo parsear con get_json(); se intenta como texto.", error=str(e))
             try:
                 raw_data = request.get_data(as_text=True)
-                print(f"Cuerpo RAW de la petición recibido: {raw_data}")
+                log.debug("Cuerpo RAW de la petición recibido.", body=raw_data)
                 if raw_data:
                     data = json.loads(raw_data)
-                    print(f"Cuerpo RAW parseado manualmente como JSON: {data}")
-                else:
-                    print("Cuerpo de la petición RAW está vacío.")
             except json.JSONDecodeError as e_json:
-                print(f"Cuerpo RAW no es un JSON válido: {e_json}")
+                log.warning("Cuerpo RAW no es un JSON válido.", error=str(e_json))
                 return {"status": "error", "message": f"Cuerpo de la petición no es JSON válido: {e_json}"}, 400
             except Exception as e_raw:
-                print(f"Error inesperado al leer cuerpo RAW: {e_raw}")
+                log.error("Error inesperado al leer cuerpo RAW.", error=str(e_raw))
                 return {"status": "error", "message": f"Error interno al procesar el cuerpo de la petición: {e_raw}"}, 500
+    log.debug("Cuerpo de la petición parseado.", body=data)
 
-        if data is None:
-            print("Error: El cuerpo de la petición es nulo después de todos los intentos de parsing.")
-            return {"status": "error", "message": "Cuerpo de la petición vacío o no es JSON válido."}, 400
-
-        device_id = data.get("device_id") or data.get("thing_id", DEVICE_LOGIN_NAME) 
-        event_timestamp_str = data.get("timestamp") or data.get("event_timestamp") 
-
-        rows_to_insert = []
-        insertion_errors = []
-
-        if "values" in data and isinstance(data["values"], list):
-            for item in data["values"]:
-                metric_type = item.get("name")
-                metric_value = item.get("value")
-                
-                item_timestamp_str = item.get("updated_at") or event_timestamp_str 
-                
-                final_timestamp_for_bq = None
-                if item_timestamp_str:
-                    try:
-                        dt_utc = datetime.fromisoformat(item_timestamp_str.replace('Z', '+00:00'))
-                        
-                        dt_santiago = dt_utc.astimezone(SANTIAGO_TZ)
-                        
-                        final_timestamp_for_bq = dt_santiago.isoformat() 
-                        
-                    except ValueError:
-                        print(f"Advertencia: Formato de timestamp '{item_timestamp_str}' no es ISO 8601 válido. Usando tiempo actual de Santiago.")
-                        final_timestamp_for_bq = datetime.now(SANTIAGO_TZ).isoformat()
-                else:
-                    print("Advertencia: No se encontró timestamp en el payload. Usando tiempo actual de Santiago.")
-                    final_timestamp_for_bq = datetime.now(SANTIAGO_TZ).isoformat()
-
-                print(f"Procesando item: name={metric_type}, value={metric_value}, timestamp={final_timestamp_for_bq}")
-
-                if metric_type is None or metric_value is None or not isinstance(metric_value, (int, float)):
-                    print(f"Advertencia: Item incompleto o inválido, omitiendo: {item}")
-                    continue 
-
-                bq_metric_type = metric_type 
-                if metric_type == "dht22_temperatura":
-                    bq_metric_type = "temperature"
-                elif metric_type == "dht22_humedad":
-                    bq_metric_type = "humidity"
-
-                formatted_value = round(float(metric_value), 1)
-
-                row_to_insert = {
-                    "sensor_reading_id": str(uuid.uuid4()), 
-                    "device_id": device_id, 
-                    "timestamp": final_timestamp_for_bq, # Usar el timestamp de Santiago
-                    "metric_type": bq_metric_type, 
-                    "value": formatted_value 
-                }
-                rows_to_insert.append(row_to_insert)
-
-        else:
-            print("Error: El payload no contiene un array 'values' válido. No hay datos para insertar.")
-            return {"status": "error", "message": "Formato de payload inesperado. Falta el array 'values'."}, 400
+    if data is None:
+        log.warning("El cuerpo de la petición es nulo después de todos los intentos de parsing.")
+        return {"status": "error", "message": "Cuerpo de la petición vacío o no es JSON válido."}, 400
 
+    if not isinstance(data, dict):
+        log.warning("El cuerpo JSON no es un objeto. Para varios dispositivos usar un sobre NDJSON.")
+        return {"status": "error", "message": "Se esperaba un objeto JSON. Para varios dispositivos usar application/x-ndjson."}, 400
+
+    duplicates = 0
+    with stage("normalize"):
+        rows_to_insert = build_sensor_rows(data)
         if rows_to_insert:
-            try:
-                table_ref = bq_client.dataset(BIGQUERY_DATASET_ID).table(BIGQUERY_TABLE_ID)
-                print(f"Intentando insertar {len(rows_to_insert)} filas en BigQuery...")
-                for row in rows_to_insert: 
-                    print(f"  - Fila a insertar: {row}")
-                
-                bq_errors = bq_client.insert_rows_json(table_ref, rows_to_insert)
-
-                if bq_errors == []:
-                    print(f"{len(rows_to_insert)} datos insertados correctamente en BigQuery.")
-                    return {
-                        "status": "success",
-                        "message": f"{len(rows_to_insert)} datos guardados en BigQuery."
-                    }, 200
-                else:
-                    print(f"Errores al insertar en BigQuery: {bq_errors}")
-                    insertion_errors.extend(bq_errors)
-                    return {
-                        "status": "error",
-                        "message": "Ocurrieron errores al insertar datos en BigQuery.",
-                        "bigquery_errors": insertion_errors
-                    }, 500
-
-            except Exception as e:
-                print(f"Error general al interactuar con BigQuery: {e}")
-                return {
-                    "status": "error",
-                    "message": f"Error interno al guardar datos en BigQuery: {str(e)}"
-                }, 500
-        else:
-            print("No hay filas válidas para insertar en BigQuery.")
-            return {"status": "warning", "message": "No se encontraron datos válidos en el payload para insertar en BigQuery."}, 200
-
-    finally:
-        print("--- Fin de petición ---")
\ No newline at end of file
+            rows_to_insert, duplicates = _drop_duplicates(rows_to_insert)
+    if rows_to_insert is None:
+        log.warning("El payload no contiene un array 'values' ni una lectura individual válida.", sampled=True)
+        return {"status": "error", "message": "Formato de payload inesperado. Falta el array 'values'."}, 400
+
+    if not rows_to_insert and duplicates:
+        log.info("Lecturas repetidas descartadas.", sampled=True, duplicates=duplicates)
+        return _duplicates_response(duplicates)
+
+    if not rows_to_insert:
+        log.warning("No hay filas válidas para insertar.", sampled=True)
+        return {"status": "warning", "message": "No se encontraron datos válidos en el payload para insertar en BigQuery."}, 200
+
+    try:
+        with stage("storage"):
+            pending = _ingest_queue().add(rows_to_insert)
+            body, status = _ingest_response([pending], len(rows_to_insert), _wants_commit(request, data))
+        if duplicates:
+            body["duplicates"] = duplicates
+        log.info("Lecturas encoladas.", sampled=True, rows=len(rows_to_insert), duplicates=duplicates)
+        return body, status
+    except Exception as e:
+        log.error("Error general al interactuar con BigQuery.", error=str(e))
+        return {
+            "status": "error",
+            "message": f"Error interno al guardar datos en BigQuery: {str(e)}"
+        }, 500
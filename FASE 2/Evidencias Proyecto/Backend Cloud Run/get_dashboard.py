@@ -0,0 +1,262 @@
+"""
+Pantalla de inicio en una sola petición: las granjas del usuario con sus cultivos,
+los dispositivos de cada cultivo, su estado (relé y modo) y su última temperatura
+y humedad, armados desde una sola consulta con JOIN. Reemplaza la cadena
+list_user_farms -> get_farm_crops -> get_device_crops -> get_device_state.
+
+Cada nivel usa las mismas claves que el endpoint que reemplaza, para que la app
+reutilice sus modelos. Con 'fields' se recorta la respuesta (los IDs siempre van):
+    ?user_uid=...&fields=farm_name,crops.crop_name,crops.devices.readings
+Pedir un contenedor sin subcampos ('crops', 'crops.devices') lo incluye completo.
+Los niveles que no se piden tampoco se consultan: sin 'readings' la consulta no
+lee sensor_readings.
+
+El estado y las lecturas se consultan en cada petición. Solo el árbol sin datos
+en vivo (sin 'state', 'control_mode' ni 'readings') se guarda en caché; con datos
+en vivo el cliente puede aceptar hasta DASHBOARD_CACHE_TTL_S de retraso con ?cache=true.
+"""
+import json
+import os
+from collections import namedtuple
+
+import functions_framework
+import instrumentation as log
+from backend_core import load_config, run_query, table_ref, warm_up
+from device_state_store import DEFAULT_CONTROL_MODE, DEFAULT_RELAY_STATE, current_devices_sql
+from instrumentation import instrumented, stage
+from query_cache import cached_query, wants_fresh
+
+# --- Configuración ---
+# Hasta cuántos días atrás se busca la última lectura de cada dispositivo.
+DASHBOARD_LOOKBACK_DAYS = int(os.environ.get("DASHBOARD_LOOKBACK_DAYS", "7"))
+# Tiempo en caché del árbol (y, con ?cache=true, del estado y las lecturas).
+DASHBOARD_CACHE_TTL_S = float(os.environ.get("DASHBOARD_CACHE_TTL_S", "15"))
+
+DEFAULT_IMAGE_URL = 'assets/images/farm_default.png'
+
+# Campos seleccionables por nivel (granja, cultivo, dispositivo); el último de los
+# dos primeros niveles es el contenedor del nivel siguiente.
+FARM_FIELDS = ("farm_name", "imageUrl", "crops")
+CROP_FIELDS = ("crop_name", "image_url", "status", "devices")
+DEVICE_FIELDS = ("device_name", "state", "control_mode", "readings")
+# Campos del dispositivo que cambian sin pasar por una invalidación de la caché.
+LIVE_FIELDS = frozenset(("state", "control_mode", "readings"))
+_LEVELS = (FARM_FIELDS, CROP_FIELDS, DEVICE_FIELDS)
+_CHILDREN = ("crops", "devices", None)
+
+# Campos pedidos por nivel (conjuntos); None si el nivel no se incluye.
+DashboardFields = namedtuple("DashboardFields", ["farm", "crop", "device"])
+ALL_FIELDS = DashboardFields(frozenset(FARM_FIELDS), frozenset(CROP_FIELDS), frozenset(DEVICE_FIELDS))
+
+warm_up()
+
+
+def parse_fields(value):
+    """Convierte 'fields' (rutas con punto separadas por comas) en DashboardFields."""
+    if not value or not value.strip():
+        return ALL_FIELDS
+    selected = [set(), None, None]
+    for path in value.split(','):
+        parts = [part.strip() for part in path.split('.')]
+        depth = 0
+        for i, part in enumerate(parts):
+            if depth >= len(_LEVELS) or part not in _LEVELS[depth]:
+                valid = ", ".join(_LEVELS[min(depth, len(_LEVELS) - 1)])
+                raise ValueError(f"Campo desconocido en 'fields': '{path.strip()}'. Campos válidos en ese nivel: {valid}.")
+            selected[depth] = (selected[depth] or set()) | {part}
+            last = i == len(parts) - 1
+            if part != _CHILDREN[depth]:
+                if not last:
+                    raise ValueError(f"'{part}' no tiene subcampos (en '{path.strip()}').")
+                break
+            depth += 1
+            if last:
+                # Contenedor sin subcampos: el subárbol completo.
+                for level in range(depth, len(_LEVELS)):
+                    selected[level] = (selected[level] or set()) | set(_LEVELS[level])
+    return DashboardFields(*(frozenset(level) if level is not None else None for level in selected))
+
+
+def includes_live_data(fields):
+    """Indica si la respuesta lleva estado o lecturas de los dispositivos."""
+    return (
+        "crops" in fields.farm and fields.crop is not None
+        and "devices" in fields.crop and fields.device is not None
+        and bool(fields.device & LIVE_FIELDS)
+    )
+
+
+def build_dashboard_query(fields):
+    """Consulta del árbol del usuario (@user_uid); solo une los niveles pedidos."""
+    config = load_config()
+    with_crops = fields.crop is not None and "crops" in fields.farm
+    with_devices = with_crops and fields.device is not None and "devices" in fields.crop
+    with_readings = with_devices and "readings" in fields.device
+
+    ctes = [f"""
+        user_farms AS (
+            SELECT farm_id, farm_name, image_url
+            FROM {table_ref(config.farms_table)}
+            WHERE user_uid = @user_uid
+        )"""]
+    columns = [
+        "f.farm_id",
+        "f.farm_name",
+        f"IFNULL(f.image_url, '{DEFAULT_IMAGE_URL}') AS farm_image_url",
+    ]
+    joins = []
+    order = ["f.farm_name", "f.farm_id"]
+    if with_crops:
+        columns += [
+            "c.crop_id",
+            "c.crop_name",
+            f"IFNULL(c.image_url, '{DEFAULT_IMAGE_URL}') AS crop_image_url",
+            "c.status AS crop_status",
+        ]
+        joins.append(f"LEFT JOIN {table_ref(config.crops_table)} c ON c.farm_id = f.farm_id")
+        order += ["c.crop_name", "c.crop_id"]
+    if with_devices:
+        columns += ["d.device_id", "d.device_name", "d.state", "d.control_mode"]
+        joins.append(f"LEFT JOIN {current_devices_sql()} d ON d.crop_id = c.crop_id")
+        order += ["d.device_name", "d.device_id"]
+    if with_readings:
+        # Solo los dispositivos del usuario y un rango constante: poda por partición y clustering.
+        ctes.append(f"""
+        latest AS (
+            SELECT
+                r.device_id,
+                ARRAY_AGG(IF(r.metric_type = 'temperature', r.value, NULL) IGNORE NULLS ORDER BY r.timestamp DESC LIMIT 1)[SAFE_OFFSET(0)] AS temperature,
+                MAX(IF(r.metric_type = 'temperature', r.timestamp, NULL)) AS temperature_at,
+                ARRAY_AGG(IF(r.metric_type = 'humidity', r.value, NULL) IGNORE NULLS ORDER BY r.timestamp DESC LIMIT 1)[SAFE_OFFSET(0)] AS humidity,
+                MAX(IF(r.metric_type = 'humidity', r.timestamp, NULL)) AS humidity_at
+            FROM {table_ref(config.sensors_table)} r
+            WHERE
+                r.timestamp >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL @lookback_days DAY)
+                AND r.metric_type IN ('temperature', 'humidity')
+                AND r.value IS NOT NULL
+                AND r.device_id IN (
+                    SELECT ud.device_id
+                    FROM {table_ref(config.devices_table)} ud
+                    JOIN {table_ref(config.crops_table)} uc ON uc.crop_id = ud.crop_id
+                    JOIN user_farms uf ON uf.farm_id = uc.farm_id
+                )
+            GROUP BY r.device_id
+        )""")
+        columns += ["l.temperature", "l.temperature_at", "l.humidity", "l.humidity_at"]
+        joins.append("LEFT JOIN latest l ON l.device_id = d.device_id")
+
+    newline = "\n        "
+    return f"""
+        WITH{",".join(ctes)}
+        SELECT
+            {("," + newline + "    ").join(columns)}
+        FROM user_farms f
+        {newline.join(joins)}
+        ORDER BY {", ".join(order)}
+    """
+
+
+def _format_timestamp(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _pick(data, fields):
+    return {key: value for key, value in data.items() if key in fields}
+
+
+def _device_readings(row):
+    readings = {}
+    for metric in ("temperature", "humidity"):
+        value = row.get(metric)
+        if value is not None:
+            readings[metric] = {"value": value, "timestamp": _format_timestamp(row[f"{metric}_at"])}
+    return readings
+
+
+def build_tree(rows, fields):
+    """Arma granjas -> cultivos -> dispositivos desde las filas del JOIN (ya ordenadas)."""
+    farms, crops = {}, {}
+    for row in rows:
+        row = dict(row)
+        farm = farms.get(row["farm_id"])
+        if farm is None:
+            farm = farms[row["farm_id"]] = {"farm_id": row["farm_id"], **_pick({
+                "farm_name": row["farm_name"],
+                "imageUrl": row["farm_image_url"],
+            }, fields.farm)}
+            if "crops" in fields.farm and fields.crop is not None:
+                farm["crops"] = []
+        if row.get("crop_id") is None:
+            continue
+        crop = crops.get(row["crop_id"])
+        if crop is None:
+            crop = crops[row["crop_id"]] = {"crop_id": str(row["crop_id"]), "farm_id": row["farm_id"], **_pick({
+                "crop_name": str(row["crop_name"]) if row["crop_name"] is not None else "Cultivo sin Nombre",
+                "image_url": str(row["crop_image_url"]),
+                "status": str(row["crop_status"]) if row["crop_status"] is not None else None,
+            }, fields.crop)}
+            if "devices" in fields.crop and fields.device is not None:
+                crop["devices"] = []
+            farm["crops"].append(crop)
+        if row.get("device_id") is None:
+            continue
+        device = {"device_id": str(row["device_id"]), **_pick({
+            "device_name": str(row["device_name"]) if row["device_name"] is not None else "Dispositivo sin Nombre",
+            "state": bool(row["state"]) if row["state"] is not None else DEFAULT_RELAY_STATE,
+            "control_mode": row["control_mode"] or DEFAULT_CONTROL_MODE,
+        }, fields.device)}
+        if "readings" in fields.device:
+            device["readings"] = _device_readings(row)
+        crop["devices"].append(device)
+    return list(farms.values())
+
+
+@functions_framework.http
+@instrumented("get_user_dashboard_http")
+def get_user_dashboard_http(request):
+    """
+    Función HTTP con el árbol granjas -> cultivos -> dispositivos del usuario
+    ('user_uid'), con estado y últimas lecturas. Acepta 'fields' para recortarlo.
+    """
+    headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type, Authorization',
+        'Access-Control-Max-Age': '3600'
+    }
+    if request.method == 'OPTIONS':
+        return ('', 204, headers)
+
+    user_uid = request.args.get('user_uid')
+    if not user_uid:
+        return (json.dumps({"error": "Falta el parámetro 'user_uid' en la URL"}), 400, headers)
+    try:
+        with stage("parse"):
+            fields = parse_fields(request.args.get('fields'))
+    except ValueError as e:
+        return (json.dumps({"error": str(e)}), 400, headers)
+
+    query = build_dashboard_query(fields)
+    params = [("user_uid", "STRING", user_uid)]
+    if "@lookback_days" in query:
+        params.append(("lookback_days", "INT64", DASHBOARD_LOOKBACK_DAYS))
+    use_cache = not includes_live_data(fields) or request.args.get('cache', '').lower() in ('true', '1')
+    try:
+        with stage("storage"):
+            if use_cache:
+                rows, cache_hit = cached_query(
+                    query, params,
+                    tags=[("farms", user_uid)],
+                    ttl_s=DASHBOARD_CACHE_TTL_S,
+                    refresh=wants_fresh(request),
+                )
+            else:
+                rows, cache_hit = list(run_query(query, params).result()), False
+        headers['X-Cache'] = ('HIT' if cache_hit else 'MISS') if use_cache else 'BYPASS'
+        with stage("serialize"):
+            farms = build_tree(rows, fields)
+            log.info("Panel armado.", sampled=True, user_uid=user_uid, farms=len(farms), rows=len(rows), cache_hit=cache_hit)
+            return (json.dumps({"status": "success", "farms": farms}), 200, headers)
+    except Exception as e:
+        log.error("Error al armar el panel.", user_uid=user_uid, error=str(e))
+        return (json.dumps({"error": "Error interno al obtener el panel", "details": str(e)}), 500, headers)
@@ -1,9 +1,15 @@
 import functions_framework
 import json
-from google.cloud import bigquery
-import os
+import instrumentation as log
+from backend_core import load_config, table_ref, warm_up
+from device_state_store import get_device_state_store
+from instrumentation import instrumented, stage
+from query_cache import cached_query, wants_fresh
+
+warm_up()
 
 @functions_framework.http
+@instrumented("get_crop_devices_http")
 def get_crop_devices_http(request):
     """HTTP Cloud Function para obtener los dispositivos de un cultivo."""
     headers = {
@@ -17,54 +23,53 @@ def get_crop_devices_http(request):
         return ('', 204, headers)
 
     try:
-        current_bq_client = bigquery.Client()
-        current_project_id = os.environ.get('BIGQUERY_PROJECT_ID')
-        current_dataset_id = os.environ.get('BIGQUERY_DATASET_ID')
-        if not current_project_id or not current_dataset_id:
-            raise ValueError("Configuración de BigQuery incompleta (PROJECT_ID o DATASET_ID no encontrados en el entorno).")
+        devices_table = table_ref(load_config().devices_table)
     except Exception as e:
-        print(f"ERROR: Error de configuración de BigQuery en get_crop_devices_http: {e}")
+        log.error("Error de configuración de BigQuery en get_crop_devices_http.", error=str(e))
         return (json.dumps({"error": "Error de configuración del servidor", "details": str(e)}), 500, headers)
 
     crop_id = request.args.get('crop_id')
     if not crop_id:
         return (json.dumps({"error": "Falta el parámetro 'crop_id' en la URL"}), 400, headers)
 
+    # Solo la lista de dispositivos va en caché; el estado del relé cambia sin
+    # invalidarla y se toma del almacén de estados (ver device_state_store).
     query = f"""
     SELECT
         device_id AS id,
         crop_id,
-        device_name AS name,
-        state
+        device_name AS name
     FROM
-        `{current_project_id}.{current_dataset_id}.devices`
+        {devices_table}
     WHERE
         crop_id = @crop_id
     ORDER BY
         name;
     """
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("crop_id", "STRING", crop_id)
-        ]
-    )
-
     try:
-        print(f"Ejecutando consulta de dispositivos para crop_id: {crop_id}")
-        query_job = current_bq_client.query(query, job_config=job_config)
-        results = query_job.result()
+        with stage("storage"):
+            results, cache_hit = cached_query(
+                query,
+                [("crop_id", "STRING", crop_id)],
+                tags=[("devices", crop_id)],
+                refresh=wants_fresh(request),
+            )
+        headers['X-Cache'] = 'HIT' if cache_hit else 'MISS'
 
+        store = get_device_state_store()
         processed_devices = []
         for row in results:
+            device_state = store.get(row.id) if row.id is not None else None
             processed_devices.append({
             "device_id": str(row.id) if row.id is not None else None,
             "crop_id": str(row.crop_id) if row.crop_id is not None else None,
             "device_name": str(row.name) if row.name is not None else "Dispositivo sin Nombre",
-            "state": bool(row.state) if row.state is not None else None 
+            "state": device_state.relay_state if device_state is not None else None
         })
 
-        print(f"Dispositivos encontrados para crop_id {crop_id}: {len(processed_devices)}")
-        return (json.dumps(processed_devices), 200, headers)
+        log.info("Dispositivos encontrados.", sampled=True, crop_id=crop_id, devices=len(processed_devices), cache_hit=cache_hit)
+        with stage("serialize"):
+            return (json.dumps(processed_devices), 200, headers)
     except Exception as e:
-        print(f"Error al consultar o procesar dispositivos para crop_id {crop_id}: {e}")
+        log.error("Error al consultar o procesar dispositivos.", crop_id=crop_id, error=str(e))
         return (json.dumps({"error": "Error interno al obtener dispositivos", "details": str(e)}), 500, headers)
\ No newline at end of file
@@ -1,26 +1,28 @@
-import os
 import json
-from google.cloud import bigquery
 import functions_framework
+import instrumentation as log
+from backend_core import warm_up
+from device_state_store import get_device_state_store
+from instrumentation import instrumented, stage
 
-# --- Configuración ---
-PROJECT_ID = os.environ.get("GCP_PROJECT", "iot-growing-app")
-DATASET_ID = "growing_app_bd"
-DEVICES_TABLE_ID = "devices"
-
-client = bigquery.Client()
+# El almacén de estados se reconstruye en bloque al arrancar, en segundo plano.
+warm_up(then=get_device_state_store().ensure_loaded)
 
 @functions_framework.http
+@instrumented("get_device_state")
 def get_device_state(request):
     """
     Función HTTP que devuelve el estado actual (relay y modo) de un dispositivo.
     Espera un 'device_id' como parámetro en la URL (query string).
+    Las lecturas se responden desde el almacén en memoria; si el cliente envía
+    If-None-Match con el ETag vigente se responde 304 sin cuerpo.
     """
     # --- Manejo de CORS ---
     headers = {
         'Access-Control-Allow-Origin': '*',
         'Access-Control-Allow-Methods': 'GET, OPTIONS',
-        'Access-Control-Allow-Headers': 'Content-Type',
+        'Access-Control-Allow-Headers': 'Content-Type, If-None-Match',
+        'Access-Control-Expose-Headers': 'ETag',
     }
     if request.method == 'OPTIONS':
         return ('', 204, headers)
@@ -31,40 +33,25 @@ def get_device_state(request):
         response_data = {'status': 'error', 'message': 'El parámetro "device_id" es requerido en la URL.'}
         return (json.dumps(response_data), 400, headers)
 
-    print(f"Buscando estado para el dispositivo: {device_id}")
-
     try:
-        query = f"""
-            SELECT state, control_mode
-            FROM `{PROJECT_ID}.{DATASET_ID}.{DEVICES_TABLE_ID}`
-            WHERE device_id = @device_id
-            LIMIT 1
-        """
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("device_id", "STRING", device_id),
-            ]
-        )
-        query_job = client.query(query, job_config=job_config)
-        results = list(query_job)
+        # Los valores nulos ya vienen resueltos por el almacén (False / 'MANUAL').
+        with stage("storage"):
+            device_state = get_device_state_store().get(device_id)
 
-        if not results:
+        if device_state is None:
             response_data = {'status': 'error', 'message': 'Dispositivo no encontrado.'}
             return (json.dumps(response_data), 404, headers)
 
-        device_data = results[0]
-        # Asegurarse de que los valores nulos se manejen correctamente
-        relay_state = device_data.state if device_data.state is not None else False
-        control_mode = device_data.control_mode if device_data.control_mode is not None else 'MANUAL'
+        headers['ETag'] = device_state.etag
+        if_none_match = request.headers.get('If-None-Match', '')
+        if device_state.etag in [tag.strip() for tag in if_none_match.split(',')]:
+            return ('', 304, headers)
 
-        response_data = {
-            'status': 'success',
-            'relay_state': relay_state,
-            'control_mode': control_mode
-        }
+        response_data = {'status': 'success'}
+        response_data.update(device_state.to_dict())
         return (json.dumps(response_data), 200, headers)
 
     except Exception as e:
-        print(f"Error inesperado: {e}")
+        log.error("Error inesperado.", device_id=device_id, error=str(e))
         response_data = {'status': 'error', 'message': 'Error interno del servidor.'}
         return (json.dumps(response_data), 500, headers)
\ No newline at end of file
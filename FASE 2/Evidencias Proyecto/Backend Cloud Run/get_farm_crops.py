@@ -1,10 +1,14 @@
 import functions_framework
 import json
-from google.cloud import bigquery
-import os
-# import uuid # No se usa en esta función, puedes quitarlo si no es necesario globalmente
+import instrumentation as log
+from backend_core import load_config, table_ref, warm_up
+from instrumentation import instrumented, stage
+from query_cache import cached_query, wants_fresh
+
+warm_up()
 
 @functions_framework.http
+@instrumented("get_farm_crops_http")
 def get_farm_crops_http(request):
     headers = {
         'Access-Control-Allow-Origin': '*',
@@ -17,13 +21,9 @@ def get_farm_crops_http(request):
         return ('', 204, headers)
 
     try:
-        current_bq_client = bigquery.Client()
-        current_project_id = os.environ.get('BIGQUERY_PROJECT_ID')
-        current_dataset_id = os.environ.get('BIGQUERY_DATASET_ID')
-        if not current_project_id or not current_dataset_id: # Simplificada la comprobación del cliente
-            raise ValueError("Configuración de BigQuery incompleta (PROJECT_ID o DATASET_ID no encontrados en el entorno).")
+        crops_table = table_ref(load_config().crops_table)
     except Exception as e:
-        print(f"ERROR: Error de configuración de BigQuery en get_farm_crops_http: {e}")
+        log.error("Error de configuración de BigQuery en get_farm_crops_http.", error=str(e))
         return (json.dumps({"error": "Error de configuración del servidor", "details": str(e)}), 500, headers)
 
     farm_id = request.args.get('farm_id')
@@ -38,22 +38,21 @@ def get_farm_crops_http(request):
             IFNULL(image_url, 'assets/images/farm_default.png') AS imageUrl,
             status
         FROM
-            `{current_project_id}.{current_dataset_id}.crops`
+            {crops_table}
         WHERE
             farm_id = @farm_id
         ORDER BY
             name;
     """
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("farm_id", "STRING", farm_id)
-        ]
-    )
-
     try:
-        print(f"Ejecutando consulta de cultivos para farm_id: {farm_id}")
-        query_job = current_bq_client.query(query, job_config=job_config)
-        results = query_job.result()
+        with stage("storage"):
+            results, cache_hit = cached_query(
+                query,
+                [("farm_id", "STRING", farm_id)],
+                tags=[("crops", farm_id)],
+                refresh=wants_fresh(request),
+            )
+        headers['X-Cache'] = 'HIT' if cache_hit else 'MISS'
 
         processed_crops = []
         for row in results:
@@ -78,8 +77,9 @@ def get_farm_crops_http(request):
                 "status": str(row.status) if row.status is not None else None
             })
         
-        print(f"Cultivos encontrados para farm_id {farm_id}: {len(processed_crops)}")
-        return (json.dumps(processed_crops), 200, headers)
+        log.info("Cultivos encontrados.", sampled=True, farm_id=farm_id, crops=len(processed_crops), cache_hit=cache_hit)
+        with stage("serialize"):
+            return (json.dumps(processed_crops), 200, headers)
     except Exception as e:
-        print(f"Error al consultar o procesar cultivos para farm_id {farm_id}: {e}")
+        log.error("Error al consultar o procesar cultivos.", farm_id=farm_id, error=str(e))
         return (json.dumps({"error": "Error interno al obtener cultivos", "details": str(e)}), 500, headers)
\ No newline at end of file
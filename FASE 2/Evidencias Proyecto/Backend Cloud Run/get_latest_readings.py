@@ -0,0 +1,135 @@
+import json
+import os
+from datetime import datetime, timezone
+
+import functions_framework
+import instrumentation as log
+from backend_core import load_config, run_query, table_ref, warm_up
+from instrumentation import instrumented, stage
+
+# --- Configuración ---
+# Tope de dispositivos por petición y hasta cuántos días atrás se busca en
+# BigQuery la última lectura de los dispositivos que no están en la capa caliente.
+LATEST_MAX_DEVICES = int(os.environ.get("LATEST_MAX_DEVICES", "200"))
+LATEST_LOOKBACK_DAYS = int(os.environ.get("LATEST_LOOKBACK_DAYS", "7"))
+
+
+def _warm_hot_tier():
+    from hot_tier import warm_hot_tier
+    warm_hot_tier()
+
+
+# La capa caliente (NumPy) se importa y se carga desde BigQuery en segundo plano.
+warm_up("hot_tier", then=_warm_hot_tier)
+
+
+def _format_timestamp(epoch_s):
+    return datetime.fromtimestamp(epoch_s, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def latest_from_hot_tier(device_ids):
+    """
+    {device_id: {métrica: {value, timestamp}}} de los dispositivos que tienen en la
+    capa caliente todas sus métricas. Los demás se deben buscar en BigQuery.
+    """
+    from hot_tier import HOT_TIER_ENABLED, HOT_TIER_METRICS, get_hot_tier
+
+    tier = get_hot_tier()
+    if not HOT_TIER_ENABLED or not tier.loaded:
+        return {}
+    tier.ensure_fresh()
+    found = {}
+    for device_id in device_ids:
+        latest = tier.latest(device_id)
+        if len(latest) == len(HOT_TIER_METRICS):
+            found[device_id] = {
+                metric: {"value": value, "timestamp": _format_timestamp(ts)}
+                for metric, (ts, value) in latest.items()
+            }
+    return found
+
+
+def latest_from_bigquery(device_ids):
+    """Última lectura de temperatura y humedad de cada dispositivo en los últimos LATEST_LOOKBACK_DAYS."""
+    query = f"""
+        SELECT
+            device_id,
+            metric_type AS sensor,
+            ARRAY_AGG(value IGNORE NULLS ORDER BY timestamp DESC LIMIT 1)[SAFE_OFFSET(0)] AS value,
+            MAX(timestamp) AS timestamp
+        FROM {table_ref(load_config().sensors_table)}
+        WHERE
+            device_id IN UNNEST(@device_ids)
+            AND metric_type IN ('temperature', 'humidity')
+            AND value IS NOT NULL
+            AND timestamp >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL @lookback_days DAY)
+        GROUP BY device_id, sensor
+    """
+    rows = run_query(query, [
+        ("device_ids", "STRING", list(device_ids)),
+        ("lookback_days", "INT64", LATEST_LOOKBACK_DAYS),
+    ])
+    found = {}
+    for row in rows:
+        found.setdefault(row.device_id, {})[row.sensor] = {
+            "value": row.value,
+            "timestamp": row.timestamp.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        }
+    return found
+
+
+@functions_framework.http
+@instrumented("get_latest_readings")
+def get_latest_readings(request):
+    """
+    Función HTTP que devuelve la última temperatura y humedad de uno o varios
+    dispositivos ('device_id', separados por comas o repetidos en la URL).
+    Se responde desde la capa caliente en memoria (hot_tier) y solo los
+    dispositivos que no están en ella se consultan en BigQuery.
+    """
+    headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type',
+    }
+    if request.method == 'OPTIONS':
+        return ('', 204, headers)
+
+    device_ids = list(dict.fromkeys(
+        device_id.strip()
+        for value in request.args.getlist('device_id')
+        for device_id in value.split(',')
+        if device_id.strip()
+    ))
+    if not device_ids:
+        response_data = {'status': 'error', 'message': 'El parámetro "device_id" es requerido en la URL.'}
+        return (json.dumps(response_data), 400, headers)
+    if len(device_ids) > LATEST_MAX_DEVICES:
+        response_data = {'status': 'error', 'message': f'Se permiten a lo más {LATEST_MAX_DEVICES} dispositivos por petición.'}
+        return (json.dumps(response_data), 400, headers)
+
+    try:
+        try:
+            with stage("hot_tier"):
+                readings = latest_from_hot_tier(device_ids)
+        except Exception as e:
+            log.warning("No se pudo leer la capa caliente.", error=str(e))
+            readings = {}
+        from_hot_tier = len(readings)
+        missing = [device_id for device_id in device_ids if device_id not in readings]
+        if missing:
+            with stage("storage"):
+                readings.update(latest_from_bigquery(missing))
+
+        response_data = {
+            'status': 'success',
+            'readings': {device_id: readings.get(device_id, {}) for device_id in device_ids},
+            'source': {'hot': from_hot_tier, 'bigquery': len(missing)},
+        }
+        with stage("serialize"):
+            return (json.dumps(response_data), 200, headers)
+
+    except Exception as e:
+        log.error("Error inesperado.", error=str(e))
+        response_data = {'status': 'error', 'message': 'Error interno del servidor.'}
+        return (json.dumps(response_data), 500, headers)
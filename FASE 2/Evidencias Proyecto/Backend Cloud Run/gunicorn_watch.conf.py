@@ -0,0 +1,29 @@
+"""
+Configuración de gunicorn para desplegar watch_device_state en Cloud Run con un
+worker gevent (requiere el paquete gevent en la imagen).
+
+Cada long-poll o flujo SSE abierto espera en un threading.Event del almacén de
+estado. Con el worker gevent (que parchea threading al arrancar) esa espera es
+una greenlet de unos pocos KB y no un hilo del sistema, así que una instancia
+sostiene miles de conexiones sin reservar un hilo por cliente.
+
+Uso (comando del contenedor):
+    gunicorn --config gunicorn_watch.conf.py
+
+y en el servicio, la concurrencia de Cloud Run igual a WATCH_WORKER_CONNECTIONS
+(--concurrency 1000) y un timeout de petición mayor que WATCH_SSE_MAX_S.
+"""
+import os
+
+# --- Configuración ---
+# Conexiones simultáneas que atiende el worker (greenlets).
+WATCH_WORKER_CONNECTIONS = int(os.environ.get("WATCH_WORKER_CONNECTIONS", "1000"))
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+wsgi_app = "functions_framework:create_app(target='watch_device_state', source='watch_device_state.py')"
+# Un solo proceso: el almacén de estado y el sondeo de cambios se comparten entre todas las esperas.
+workers = 1
+worker_class = "gevent"
+worker_connections = WATCH_WORKER_CONNECTIONS
+# Cloud Run corta las peticiones por su cuenta; gunicorn no debe matar al worker por una espera larga.
+timeout = 0
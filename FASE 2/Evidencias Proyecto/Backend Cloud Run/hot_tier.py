@@ -0,0 +1,264 @@
+"""
+Capa caliente en memoria con las lecturas recientes de cada dispositivo.
+
+Cada (dispositivo, métrica) tiene un búfer circular de NumPy de capacidad fija
+HOT_TIER_CAPACITY: timestamps epoch (int64) y valores (float64), 16 bytes por
+punto. Con los valores por defecto (2 métricas x 3000 puntos, una lectura cada
+30 s durante 25 h) cada dispositivo ocupa 2 x 3000 x 16 B = 96 000 B (~94 KiB),
+más unos pocos cientos de bytes de objetos de Python, sin importar cuántas
+lecturas lleguen. BYTES_PER_DEVICE lo calcula para la configuración vigente.
+
+- Se llena al arrancar con una consulta de las últimas HOT_TIER_WINDOW_S (ensure_loaded).
+- handle_incoming_sensor_data le pasa las filas ya insertadas (ingest) cuando
+  corre en el mismo proceso; en los demás procesos se pone al día cada
+  HOT_TIER_REFRESH_S releyendo desde BigQuery la cola reciente (refresh).
+- Si un dispositivo recibe más lecturas de las que caben, los puntos más antiguos
+  se descartan y su cobertura se acorta: quien lee pregunta covers() y, si el
+  rango no está cubierto, consulta BigQuery.
+
+Vive en su propio módulo para que los handlers no paguen la importación de NumPy
+al arrancar; se importa en el warm-up.
+"""
+import os
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+import instrumentation as log
+from backend_core import load_config, run_query, table_ref
+
+# --- Configuración ---
+HOT_TIER_ENABLED = os.environ.get("HOT_TIER_ENABLED", "true").lower() == "true"
+# Puntos por (dispositivo, métrica) y ventana que se carga al arrancar.
+# La ventana por defecto es de 25 h: las 24 h hasta la última lectura ('latest') más margen.
+HOT_TIER_CAPACITY = int(os.environ.get("HOT_TIER_CAPACITY", "3000"))
+HOT_TIER_WINDOW_S = int(os.environ.get("HOT_TIER_WINDOW_S", "90000"))
+# Cada cuántos segundos se relee la cola reciente, y cuánto hacia atrás desde el
+# último timestamp visto (para recoger lecturas que llegaron tarde).
+HOT_TIER_REFRESH_S = float(os.environ.get("HOT_TIER_REFRESH_S", "60"))
+HOT_TIER_REFRESH_OVERLAP_S = int(os.environ.get("HOT_TIER_REFRESH_OVERLAP_S", "600"))
+HOT_TIER_METRICS = ("temperature", "humidity")
+
+BYTES_PER_DEVICE = len(HOT_TIER_METRICS) * HOT_TIER_CAPACITY * (8 + 8)
+
+
+class RingBuffer:
+    """Búfer circular de (timestamp epoch, valor) de capacidad fija."""
+
+    __slots__ = ("times", "values", "head", "count", "evicted_until", "last_time")
+
+    def __init__(self, capacity=HOT_TIER_CAPACITY):
+        self.times = np.zeros(capacity, dtype=np.int64)
+        self.values = np.zeros(capacity, dtype=np.float64)
+        self.head = 0
+        self.count = 0
+        # Timestamp más nuevo que se haya descartado por falta de espacio.
+        self.evicted_until = None
+        self.last_time = None
+
+    def append(self, timestamp, value):
+        capacity = len(self.times)
+        if self.count == capacity:
+            evicted = int(self.times[self.head])
+            self.evicted_until = evicted if self.evicted_until is None else max(self.evicted_until, evicted)
+        else:
+            self.count += 1
+        self.times[self.head] = timestamp
+        self.values[self.head] = value
+        self.head = (self.head + 1) % capacity
+        self.last_time = timestamp if self.last_time is None else max(self.last_time, timestamp)
+
+    def points(self):
+        """Copia de (timestamps, valores) ordenada por timestamp."""
+        times = self.times[:self.count]
+        values = self.values[:self.count]
+        order = np.argsort(times, kind="stable")
+        return times[order], values[order]
+
+    def drop_since(self, timestamp):
+        """Quita los puntos con timestamp >= `timestamp` (se volverán a leer de BigQuery)."""
+        if self.last_time is None or self.last_time < timestamp:
+            return
+        times, values = self.points()
+        keep = times < timestamp
+        times, values = times[keep], values[keep]
+        self.count = len(times)
+        self.times[:self.count] = times
+        self.values[:self.count] = values
+        self.head = self.count % len(self.times)
+        self.last_time = int(times[-1]) if self.count else None
+
+
+def _epoch_seconds(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return int(value.timestamp())
+
+
+class HotTier:
+    """Búferes circulares por (dispositivo, métrica) compartidos por el proceso."""
+
+    def __init__(self, capacity=HOT_TIER_CAPACITY, window_s=HOT_TIER_WINDOW_S, refresh_s=HOT_TIER_REFRESH_S):
+        self.capacity = capacity
+        self.window_s = window_s
+        self.refresh_s = refresh_s
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._rings = {}
+        # Desde cuándo (epoch) la capa tiene todas las lecturas, y el timestamp más nuevo leído de BigQuery.
+        self._loaded_since = None
+        self._watermark = None
+        self._refreshed_at = None
+
+    # --- Carga y actualización ---
+
+    def ensure_loaded(self):
+        """Carga las últimas `window_s` desde BigQuery si aún no se hizo."""
+        with self._refresh_lock:
+            if self._loaded_since is None:
+                self._load(int(time.time()) - self.window_s, initial=True)
+
+    def ensure_fresh(self):
+        """Relee la cola reciente si la última actualización tiene más de `refresh_s`."""
+        refreshed_at = self._refreshed_at
+        if refreshed_at is None or time.monotonic() - refreshed_at < self.refresh_s:
+            return
+        # La hace una sola petición; el resto responde con lo que hay.
+        if self._refresh_lock.acquire(blocking=False):
+            try:
+                self._load(self._watermark - HOT_TIER_REFRESH_OVERLAP_S)
+            except Exception as e:
+                log.warning("No se pudo actualizar la capa caliente.", error=str(e))
+            finally:
+                self._refresh_lock.release()
+
+    def _load(self, since, initial=False):
+        query = f"""
+            SELECT device_id, metric_type AS metric, UNIX_SECONDS(timestamp) AS ts, value
+            FROM {table_ref(load_config().sensors_table)}
+            WHERE
+                timestamp >= TIMESTAMP_SECONDS(@since)
+                AND metric_type IN UNNEST(@metrics)
+                AND value IS NOT NULL
+            ORDER BY ts
+        """
+        started_at = time.monotonic()
+        # Se descargan todas las filas antes de tomar el lock para no bloquear las lecturas.
+        rows = list(run_query(query, [("since", "INT64", since), ("metrics", "STRING", HOT_TIER_METRICS)]).result())
+        count = 0
+        with self._lock:
+            for ring in self._rings.values():
+                ring.drop_since(since)
+            for row in rows:
+                self._ring(row.device_id, row.metric).append(row.ts, row.value)
+                self._watermark = row.ts if self._watermark is None else max(self._watermark, row.ts)
+                count += 1
+            if self._watermark is None:
+                self._watermark = since
+            if initial:
+                self._loaded_since = since
+            self._refreshed_at = started_at
+        if initial:
+            devices = self.device_count()
+            log.info("Capa caliente cargada.", readings=count, devices=devices,
+                     approx_kib=round(devices * BYTES_PER_DEVICE / 1024))
+
+    def ingest(self, rows):
+        """Agrega filas de sensor_readings recién insertadas. No hace nada si la capa no se cargó."""
+        if self._loaded_since is None:
+            return
+        with self._lock:
+            for row in rows:
+                metric = row["metric_type"]
+                if metric in HOT_TIER_METRICS and row.get("value") is not None:
+                    self._ring(row["device_id"], metric).append(_epoch_seconds(row["timestamp"]), row["value"])
+
+    # --- Lectura ---
+
+    @property
+    def loaded(self):
+        return self._loaded_since is not None
+
+    def device_count(self):
+        with self._lock:
+            return len({device_id for device_id, _ in self._rings})
+
+    def covers(self, device_id, start):
+        """Indica si la capa tiene todas las lecturas del dispositivo desde `start` (epoch)."""
+        if self._loaded_since is None or start < self._loaded_since:
+            return False
+        with self._lock:
+            for metric in HOT_TIER_METRICS:
+                ring = self._rings.get((device_id, metric))
+                if ring is not None and ring.evicted_until is not None and start <= ring.evicted_until:
+                    return False
+        return True
+
+    def points(self, device_id):
+        """{métrica: (timestamps, valores)} ordenados, de las métricas con datos."""
+        with self._lock:
+            return {
+                metric: ring.points()
+                for metric in HOT_TIER_METRICS
+                if (ring := self._rings.get((device_id, metric))) is not None and ring.count
+            }
+
+    def latest(self, device_id):
+        """{métrica: (timestamp epoch, valor)} de la última lectura de cada métrica con datos."""
+        latest = {}
+        with self._lock:
+            for metric in HOT_TIER_METRICS:
+                ring = self._rings.get((device_id, metric))
+                if ring is not None and ring.count:
+                    i = int(np.argmax(ring.times[:ring.count]))
+                    latest[metric] = (int(ring.times[i]), float(ring.values[i]))
+        return latest
+
+    def _ring(self, device_id, metric):
+        # Se llama con el lock tomado.
+        ring = self._rings.get((device_id, metric))
+        if ring is None:
+            ring = self._rings[(device_id, metric)] = RingBuffer(self.capacity)
+        return ring
+
+
+def downsample(times, values, bucket_s, max_points, force_buckets=False):
+    """
+    Mismo criterio que la consulta de lecturas crudas de list_sensor_readings: si
+    la serie cabe en max_points (y no se fuerzan cubetas) se devuelve completa; si
+    no, el mínimo y el máximo de cada cubeta más la última lectura. Devuelve una máscara.
+    """
+    if not len(times):
+        return np.zeros(0, dtype=bool)
+    if not force_buckets and len(times) <= max_points:
+        return np.ones(len(times), dtype=bool)
+    buckets = times // bucket_s
+    keep = times == times.max()
+    for order in (np.lexsort((times, values, buckets)), np.lexsort((times, -values, buckets))):
+        ordered = buckets[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = ordered[1:] != ordered[:-1]
+        keep[order[first]] = True
+    return keep
+
+
+_tier = None
+_tier_lock = threading.Lock()
+
+
+def get_hot_tier():
+    """Capa caliente compartida por todo el proceso."""
+    global _tier
+    if _tier is None:
+        with _tier_lock:
+            if _tier is None:
+                _tier = HotTier()
+    return _tier
+
+
+def warm_hot_tier():
+    """Para warm_up(then=...): carga la capa si está habilitada."""
+    if HOT_TIER_ENABLED:
+        get_hot_tier().ensure_loaded()
@@ -0,0 +1,184 @@
+import atexit
+import os
+import threading
+import time
+from concurrent.futures import Future
+
+import instrumentation as log
+from instrumentation import counter, gauge, histogram
+
+# --- Configuración ---
+# Tamaño máximo de lote y tiempo máximo (en milisegundos) que una fila puede
+# esperar en el buffer antes de enviarse a BigQuery. En Cloud Run el servicio
+# debe tener la CPU siempre asignada para que el hilo de fondo avance entre
+# peticiones; si no, el vaciado ocurre en la siguiente petición o al apagar.
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", "500"))
+INGEST_MAX_LINGER_MS = int(os.environ.get("INGEST_MAX_LINGER_MS", "1000"))
+
+FLUSH_SECONDS = histogram("growingapp_buffer_flush_duration_seconds", "Duración de cada inserción en bloque de un buffer.", ("buffer",))
+PENDING_ROWS = gauge("growingapp_buffer_pending_rows", "Filas esperando en cada buffer.", ("buffer",))
+FLUSHED_ROWS = counter("growingapp_buffer_rows_total", "Filas enviadas por cada buffer, por resultado.", ("buffer", "result"))
+
+
+class BatchBuffer:
+    """
+    Buffer compartido por todo el proceso que agrupa filas de varias peticiones
+    y las inserta en bloque desde un hilo en segundo plano.
+
+    Se vacía cuando se alcanzan `batch_size` filas o cuando la fila más antigua
+    lleva `max_linger_s` segundos esperando, lo que ocurra primero.
+    `insert_fn(rows)` debe devolver la lista de errores con el mismo formato que
+    `bigquery.Client.insert_rows_json` (índices relativos al lote recibido).
+    """
+
+    def __init__(self, insert_fn, batch_size=INGEST_BATCH_SIZE, max_linger_s=INGEST_MAX_LINGER_MS / 1000.0, name="ingest"):
+        self._insert_fn = insert_fn
+        self.batch_size = max(1, batch_size)
+        self.max_linger_s = max(0.0, max_linger_s)
+        self.name = name
+
+        self._cond = threading.Condition()
+        self._rows = []
+        # Cada entrada: (future, posición inicial en self._rows, cantidad de filas)
+        self._spans = []
+        self._oldest = None
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._run, name=f"{name}-flusher", daemon=True)
+        self._thread.start()
+
+    def add(self, rows):
+        """
+        Encola filas y devuelve un Future que se resuelve con la lista de errores
+        de inserción (vacía si todo fue bien) una vez que el lote se confirma.
+        """
+        future = Future()
+        if not rows:
+            future.set_result([])
+            return future
+
+        with self._cond:
+            if self._closed:
+                raise RuntimeError(f"El buffer '{self.name}' ya fue cerrado.")
+            # Se despierta al hilo al llegar la primera fila (para iniciar la
+            # cuenta del linger) o al completar un lote.
+            first = not self._rows
+            if first:
+                self._oldest = time.monotonic()
+            self._spans.append((future, len(self._rows), len(rows)))
+            self._rows.extend(rows)
+            PENDING_ROWS.set(len(self._rows), self.name)
+            if first or len(self._rows) >= self.batch_size:
+                self._cond.notify()
+        return future
+
+    def pending(self):
+        with self._cond:
+            return len(self._rows)
+
+    def flush(self):
+        """Envía de inmediato todo lo que haya en el buffer (bloqueante)."""
+        with self._cond:
+            rows, spans = self._take()
+        self._send(rows, spans)
+
+    def close(self):
+        """Detiene el hilo de fondo y vacía el buffer. Se registra con atexit."""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join(timeout=30)
+        self.flush()
+
+    def _take(self):
+        rows, spans = self._rows, self._spans
+        self._rows, self._spans, self._oldest = [], [], None
+        PENDING_ROWS.set(0, self.name)
+        return rows, spans
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._closed:
+                    if len(self._rows) >= self.batch_size:
+                        break
+                    if self._oldest is not None:
+                        remaining = self._oldest + self.max_linger_s - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+                    else:
+                        self._cond.wait()
+                if self._closed:
+                    return
+                rows, spans = self._take()
+            self._send(rows, spans)
+
+    def _send(self, rows, spans):
+        # Se envía en trozos de ~batch_size para no superar los límites de la API
+        # de streaming aunque el buffer haya crecido mientras se insertaba.
+        # Los trozos nunca parten las filas de una misma petición.
+        chunk_start, chunk_spans = 0, []
+        for span in spans:
+            chunk_spans.append(span)
+            end = span[1] + span[2]
+            if end - chunk_start >= self.batch_size:
+                self._send_chunk(rows[chunk_start:end], chunk_spans, chunk_start)
+                chunk_start, chunk_spans = end, []
+        if chunk_spans:
+            self._send_chunk(rows[chunk_start:], chunk_spans, chunk_start)
+
+    def _send_chunk(self, rows, spans, offset):
+        if not rows:
+            return
+        start = time.perf_counter()
+        try:
+            errors = self._insert_fn(rows) or []
+        except Exception as e:
+            FLUSHED_ROWS.inc(self.name, "error", amount=len(rows))
+            log.error("Error al vaciar el buffer.", buffer=self.name, rows=len(rows), error=str(e))
+            for future, _, _ in spans:
+                future.set_exception(e)
+            return
+        finally:
+            FLUSH_SECONDS.observe(time.perf_counter() - start, self.name)
+
+        FLUSHED_ROWS.inc(self.name, "error", amount=len(errors))
+        FLUSHED_ROWS.inc(self.name, "ok", amount=len(rows) - len(errors))
+        if errors:
+            log.error("Errores al vaciar el buffer.", buffer=self.name, errors=errors)
+
+        # Se reparten los errores a cada petición con índices relativos a sus filas.
+        for future, start, count in spans:
+            local_start = start - offset
+            own_errors = []
+            for error in errors:
+                index = error.get("index")
+                if index is not None and local_start <= index < local_start + count:
+                    own_errors.append(dict(error, index=index - local_start))
+            future.set_result(own_errors)
+
+
+_buffers = {}
+_buffers_lock = threading.Lock()
+
+
+def get_buffer(name, insert_fn, **kwargs):
+    """Devuelve el buffer `name` del proceso, creándolo la primera vez."""
+    with _buffers_lock:
+        buffer = _buffers.get(name)
+        if buffer is None:
+            buffer = BatchBuffer(insert_fn, name=name, **kwargs)
+            _buffers[name] = buffer
+        return buffer
+
+
+@atexit.register
+def close_all_buffers():
+    """Vacía todos los buffers al apagar la instancia."""
+    with _buffers_lock:
+        buffers = list(_buffers.values())
+    for buffer in buffers:
+        buffer.close()
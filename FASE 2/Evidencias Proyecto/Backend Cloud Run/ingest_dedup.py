@@ -0,0 +1,111 @@
+"""
+Filtro de lecturas repetidas para la ingesta.
+
+Como sensor_reading_id se deriva de (dispositivo, métrica, timestamp) (ver
+sensor_normalization.reading_id), un reintento del dispositivo o del cliente
+HTTP produce filas con los mismos IDs. El proceso recuerda los IDs insertados
+hace poco en un conjunto acotado (LRU de INGEST_DEDUP_CAPACITY claves, cada una
+válida durante INGEST_DEDUP_WINDOW_S) y descarta esas filas antes del buffer.
+
+El filtro es por proceso y aproximado: lo que se le escapa (otra instancia, una
+clave ya desalojada) lo deduplica BigQuery con los IDs de inserción durante
+aproximadamente un minuto. Con los valores por defecto ocupa unos 20 MB.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from instrumentation import counter, register_stats
+
+# --- Configuración ---
+INGEST_DEDUP_ENABLED = os.environ.get("INGEST_DEDUP_ENABLED", "true").lower() == "true"
+INGEST_DEDUP_CAPACITY = int(os.environ.get("INGEST_DEDUP_CAPACITY", "100000"))
+INGEST_DEDUP_WINDOW_S = float(os.environ.get("INGEST_DEDUP_WINDOW_S", "3600"))
+
+DUPLICATES = counter("growingapp_ingest_duplicates_total", "Lecturas repetidas descartadas antes de insertar.", ("stage",))
+
+
+class RecentKeys:
+    """Conjunto de claves vistas hace poco, acotado por cantidad y por antigüedad."""
+
+    def __init__(self, capacity=INGEST_DEDUP_CAPACITY, window_s=INGEST_DEDUP_WINDOW_S):
+        self.capacity = capacity
+        self.window_s = window_s
+        self._lock = threading.Lock()
+        # clave -> instante (monotónico) en que vence; en orden de inserción.
+        self._keys = OrderedDict()
+        self._evicted = 0
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, keys):
+        expires_at = time.monotonic() + self.window_s
+        with self._lock:
+            for key in keys:
+                self._keys[key] = expires_at
+                self._keys.move_to_end(key)
+            while len(self._keys) > self.capacity:
+                self._keys.popitem(last=False)
+                self._evicted += 1
+
+    def new_indices(self, keys):
+        """
+        Posiciones de las claves que no se vieron hace poco ni se repiten antes en
+        la misma lista (la primera aparición se conserva).
+        """
+        now = time.monotonic()
+        seen = set()
+        fresh = []
+        with self._lock:
+            self._expire(now)
+            for i, key in enumerate(keys):
+                if key in seen or key in self._keys:
+                    continue
+                seen.add(key)
+                fresh.append(i)
+        return fresh
+
+    def _expire(self, now):
+        # Se llama con el lock tomado; las claves vencen en el mismo orden en que entraron.
+        while self._keys:
+            key, expires_at = next(iter(self._keys.items()))
+            if expires_at > now:
+                return
+            del self._keys[key]
+
+    def stats(self):
+        with self._lock:
+            return {"keys": len(self._keys), "evicted": self._evicted}
+
+
+_recent = None
+_recent_lock = threading.Lock()
+
+
+def get_recent_readings():
+    """IDs de lecturas insertadas hace poco por este proceso."""
+    global _recent
+    if _recent is None:
+        with _recent_lock:
+            if _recent is None:
+                _recent = RecentKeys()
+                register_stats("ingest_dedup", "Estado del filtro de lecturas repetidas.", _recent.stats)
+    return _recent
+
+
+def fresh_indices(rows, stage, key="sensor_reading_id"):
+    """Posiciones de las filas que no están repetidas; las repetidas se cuentan en `stage`."""
+    if not INGEST_DEDUP_ENABLED:
+        return list(range(len(rows)))
+    fresh = get_recent_readings().new_indices([row[key] for row in rows])
+    if len(fresh) < len(rows):
+        DUPLICATES.inc(stage, amount=len(rows) - len(fresh))
+    return fresh
+
+
+def remember(rows, key="sensor_reading_id"):
+    """Registra como insertadas las filas ya confirmadas por el almacenamiento."""
+    if INGEST_DEDUP_ENABLED and rows:
+        get_recent_readings().add(row[key] for row in rows)
@@ -0,0 +1,137 @@
+import codecs
+import json
+import os
+import zlib
+
+# --- Configuración ---
+# Tamaño de cada lectura del cuerpo de la petición y tamaño máximo que puede
+# ocupar un solo objeto JSON del sobre (protege frente a cuerpos malformados).
+ENVELOPE_CHUNK_BYTES = 64 * 1024
+ENVELOPE_MAX_OBJECT_BYTES = int(os.environ.get("ENVELOPE_MAX_OBJECT_BYTES", str(1024 * 1024)))
+
+COMPRESSED_ENCODINGS = ("gzip", "x-gzip", "deflate")
+STREAM_CONTENT_TYPES = ("application/x-ndjson", "application/jsonl", "application/json-seq")
+
+
+class EnvelopeError(ValueError):
+    """El cuerpo del sobre no se pudo descomprimir o no es una secuencia JSON válida."""
+
+
+def is_envelope_request(request):
+    """Indica si la petición trae un sobre comprimido o una secuencia NDJSON."""
+    encoding = (request.headers.get("Content-Encoding") or "").strip().lower()
+    content_type = (request.mimetype or "").lower()
+    return encoding in COMPRESSED_ENCODINGS or content_type in STREAM_CONTENT_TYPES
+
+
+class _Inflater:
+    """Descompresor incremental para gzip y deflate (con cabecera zlib o sin ella)."""
+
+    def __init__(self, encoding):
+        self._raw_fallback = encoding == "deflate"
+        wbits = 16 + zlib.MAX_WBITS if encoding in ("gzip", "x-gzip") else zlib.MAX_WBITS
+        self._obj = zlib.decompressobj(wbits)
+        self._started = False
+
+    def feed(self, data):
+        # Se limita la salida de cada paso para que un cuerpo muy comprimido
+        # no se expanda entero en memoria de una sola vez.
+        while data:
+            try:
+                out = self._obj.decompress(data, ENVELOPE_CHUNK_BYTES)
+            except zlib.error as e:
+                if self._raw_fallback and not self._started:
+                    # Algunos clientes envían "deflate" sin la cabecera zlib.
+                    self._raw_fallback = False
+                    self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+                    continue
+                raise EnvelopeError(f"Cuerpo comprimido inválido: {e}") from e
+            self._started = True
+            if out:
+                yield out
+            data = self._obj.unconsumed_tail
+
+    def finish(self):
+        try:
+            out = self._obj.flush()
+        except zlib.error as e:
+            raise EnvelopeError(f"Cuerpo comprimido incompleto: {e}") from e
+        if out:
+            yield out
+
+
+def iter_text_chunks(stream, encoding=None):
+    """Lee `stream` por trozos, lo descomprime si corresponde y lo decodifica como UTF-8."""
+    encoding = (encoding or "").strip().lower()
+    inflater = _Inflater(encoding) if encoding in COMPRESSED_ENCODINGS else None
+    decoder = codecs.getincrementaldecoder("utf-8")()
+
+    while True:
+        data = stream.read(ENVELOPE_CHUNK_BYTES)
+        if not data:
+            break
+        pieces = inflater.feed(data) if inflater else (data,)
+        for piece in pieces:
+            text = decoder.decode(piece)
+            if text:
+                yield text
+
+    if inflater:
+        for piece in inflater.finish():
+            text = decoder.decode(piece)
+            if text:
+                yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def iter_json_objects(chunks):
+    """
+    Decodifica de forma incremental una secuencia de objetos JSON.
+
+    Acepta NDJSON (un objeto por línea), objetos concatenados o un array JSON
+    de nivel superior. Solo se mantiene en memoria el objeto en curso.
+    """
+    decoder = json.JSONDecoder()
+    buf, pos, eof = "", 0, False
+    chunks = iter(chunks)
+
+    while True:
+        # Se saltan separadores entre objetos: espacios, comas y los corchetes
+        # del array de nivel superior.
+        while pos < len(buf) and buf[pos] in " \t\r\n,[]":
+            pos += 1
+
+        if pos < len(buf):
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError as e:
+                if eof:
+                    raise EnvelopeError(f"Objeto JSON inválido en el sobre: {e}") from e
+                if len(buf) - pos > ENVELOPE_MAX_OBJECT_BYTES:
+                    raise EnvelopeError("Un objeto del sobre supera el tamaño máximo permitido.") from e
+            else:
+                # Un número al final del búfer podría estar cortado; se esperan más datos.
+                if end < len(buf) or eof or isinstance(obj, (dict, list)):
+                    yield obj
+                    pos = end
+                    continue
+        elif eof:
+            return
+
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            eof = True
+            continue
+        buf, pos = buf[pos:] + chunk, 0
+
+
+def iter_envelope_objects(request):
+    """Itera los objetos de un sobre leído directamente del cuerpo de la petición."""
+    chunks = iter_text_chunks(request.stream, request.headers.get("Content-Encoding"))
+    for obj in iter_json_objects(chunks):
+        if not isinstance(obj, dict):
+            raise EnvelopeError(f"Se esperaba un objeto JSON en el sobre, se recibió: {type(obj).__name__}")
+        yield obj
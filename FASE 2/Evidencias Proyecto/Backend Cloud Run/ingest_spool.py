@@ -0,0 +1,370 @@
+"""
+Spool en disco para la ingesta (INGEST_SPOOL_ENABLED).
+
+Las filas aceptadas se escriben primero en un segmento de solo anexado mapeado
+en memoria (mmap) y la petición ya no depende de la latencia de BigQuery. Un hilo
+de fondo (el replayer) lee el spool en lotes de hasta INGEST_SPOOL_REPLAY_ROWS
+filas y los entrega a la función de inserción; si falla, reintenta con espera
+exponencial sin perder nada.
+
+Formato: archivos <secuencia>.seg de INGEST_SPOOL_SEGMENT_BYTES preasignados.
+Cada add() es un registro [largo, crc32, filas, instante] + JSON de las filas; el
+encabezado se escribe después del cuerpo, así que un registro a medias (caída
+durante la escritura) queda con encabezado vacío o CRC inválido y se descarta.
+Cuando un registro no cabe se abre el segmento siguiente; los segmentos ya
+reenviados se borran.
+
+El archivo 'checkpoint' guarda (segmento, posición) del siguiente registro por
+reenviar y se actualiza tras cada lote confirmado. Al arrancar se descartan los
+segmentos anteriores al checkpoint, se recorre el resto validando cada registro y
+se sigue escribiendo tras el último válido. Si el checkpoint no alcanzó a
+guardarse, el último lote se reenvía: los IDs deterministas de las lecturas
+(ver ingest_dedup) evitan los duplicados.
+
+Sin INGEST_SPOOL_SYNC los datos sobreviven a la caída del proceso (quedan en la
+caché de páginas del sistema), no a un corte de energía; con él cada add() hace
+msync. En Cloud Run el disco es memoria de la instancia: al apagar se intenta
+vaciar el spool durante INGEST_SPOOL_DRAIN_TIMEOUT_S. Un directorio de spool lo
+usa un solo proceso a la vez (flock); los demás usan el buffer en memoria.
+"""
+import atexit
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import Future
+
+import instrumentation as log
+from instrumentation import counter, register_stats
+
+# --- Configuración ---
+INGEST_SPOOL_ENABLED = os.environ.get("INGEST_SPOOL_ENABLED", "false").lower() == "true"
+INGEST_SPOOL_DIR = os.environ.get("INGEST_SPOOL_DIR", "/tmp/growingapp-spool")
+INGEST_SPOOL_SEGMENT_BYTES = int(os.environ.get("INGEST_SPOOL_SEGMENT_BYTES", str(64 << 20)))
+INGEST_SPOOL_SYNC = os.environ.get("INGEST_SPOOL_SYNC", "false").lower() == "true"
+INGEST_SPOOL_REPLAY_ROWS = int(os.environ.get("INGEST_SPOOL_REPLAY_ROWS", "2000"))
+# Espera máxima entre reintentos cuando el almacenamiento falla.
+INGEST_SPOOL_RETRY_MAX_S = float(os.environ.get("INGEST_SPOOL_RETRY_MAX_S", "60"))
+INGEST_SPOOL_DRAIN_TIMEOUT_S = float(os.environ.get("INGEST_SPOOL_DRAIN_TIMEOUT_S", "8"))
+
+# Largo del cuerpo, crc32 del cuerpo, cantidad de filas, instante de escritura (epoch).
+_HEADER = struct.Struct("<IIId")
+_SEGMENT_SUFFIX = ".seg"
+_CHECKPOINT = "checkpoint"
+
+REPLAYED_ROWS = counter("growingapp_spool_replayed_rows_total", "Filas reenviadas desde el spool, por resultado.", ("spool", "result"))
+REPLAY_FAILURES = counter("growingapp_spool_replay_failures_total", "Lotes del spool que fallaron y se reintentarán.", ("spool",))
+
+
+def _scan(buf, start, limit):
+    """Registros válidos de `buf` entre `start` y `limit`: (inicio, fin, filas, instante, cuerpo)."""
+    pos = start
+    while pos + _HEADER.size <= limit:
+        length, crc, rows, appended_at = _HEADER.unpack_from(buf, pos)
+        end = pos + _HEADER.size + length
+        if length == 0 or end > limit:
+            return
+        payload = buf[pos + _HEADER.size:end]
+        if zlib.crc32(payload) != crc:
+            return
+        yield pos, end, rows, appended_at, payload
+        pos = end
+
+
+class _Segment:
+    """Archivo de tamaño fijo mapeado en memoria; `end` es la posición de escritura."""
+
+    def __init__(self, path, size=None):
+        self.path = path
+        self.seq = int(os.path.basename(path)[:-len(_SEGMENT_SUFFIX)])
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if size is not None:
+                os.ftruncate(fd, size)
+            self.size = os.fstat(fd).st_size
+            self.map = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        self.end = 0
+
+    def write(self, record_header, payload):
+        offset = self.end
+        body_start = offset + _HEADER.size
+        self.map[body_start:body_start + len(payload)] = payload
+        self.map[offset:body_start] = record_header
+        self.end = body_start + len(payload)
+        if INGEST_SPOOL_SYNC:
+            aligned = offset - offset % mmap.PAGESIZE
+            self.map.flush(aligned, self.end - aligned)
+        return offset
+
+    def close(self, remove=False):
+        self.map.flush()
+        self.map.close()
+        if remove:
+            os.remove(self.path)
+
+
+class Spool:
+    """
+    Cola durable con la misma interfaz que ingest_buffer.BatchBuffer: add(rows)
+    devuelve un Future con los errores de inserción de esas filas, que se resuelve
+    cuando el replayer las entrega. `insert_fn(rows)` devuelve errores con el
+    formato de insert_rows_json; si lanza una excepción, el lote se reintenta.
+    """
+
+    def __init__(self, directory, insert_fn, segment_bytes=INGEST_SPOOL_SEGMENT_BYTES,
+                 replay_rows=INGEST_SPOOL_REPLAY_ROWS, name="spool"):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.replay_rows = max(1, replay_rows)
+        self.name = name
+        self._insert_fn = insert_fn
+
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = open(os.path.join(directory, "lock"), "w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock_file.close()
+            raise
+
+        self._cond = threading.Condition()
+        self._segments = []
+        # (segmento, posición) del registro -> Future de quien lo escribió.
+        self._futures = {}
+        self._pending_rows = 0
+        self._checkpoint = (0, 0)
+        self._closed = False
+        self._recover()
+
+        self._thread = threading.Thread(target=self._run, name=f"{name}-replayer", daemon=True)
+        self._thread.start()
+
+    # --- Recuperación ---
+
+    def _recover(self):
+        checkpoint_path = os.path.join(self.directory, _CHECKPOINT)
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path, encoding="utf-8") as f:
+                saved = json.load(f)
+            self._checkpoint = (saved["segment"], saved["offset"])
+
+        recovered_rows, torn = 0, 0
+        for filename in sorted(f for f in os.listdir(self.directory) if f.endswith(_SEGMENT_SUFFIX)):
+            path = os.path.join(self.directory, filename)
+            if not os.path.getsize(path):
+                # Caída justo al crear el segmento: no alcanzó a tener registros.
+                os.remove(path)
+                continue
+            segment = _Segment(path)
+            if segment.seq < self._checkpoint[0]:
+                segment.close(remove=True)
+                continue
+            start = self._checkpoint[1] if segment.seq == self._checkpoint[0] else 0
+            for offset, end, rows, _, _ in _scan(segment.map, 0, segment.size):
+                segment.end = end
+                if offset >= start:
+                    recovered_rows += rows
+            # Lo que sigue al último registro válido (un registro a medias) se limpia.
+            if segment.map[segment.end:segment.end + _HEADER.size].strip(b"\0"):
+                torn += 1
+                segment.map[segment.end:] = bytes(segment.size - segment.end)
+            self._segments.append(segment)
+
+        if not self._segments:
+            self._segments.append(self._new_segment(self.segment_bytes, self._checkpoint[0]))
+            self._checkpoint = (self._segments[0].seq, 0)
+        elif self._checkpoint[0] < self._segments[0].seq:
+            self._checkpoint = (self._segments[0].seq, 0)
+        self._pending_rows = recovered_rows
+        if recovered_rows or torn:
+            log.warning("Spool recuperado tras un reinicio.", spool=self.name,
+                        pending_rows=recovered_rows, torn_segments=torn)
+
+    def _new_segment(self, size, seq=None):
+        if seq is None:
+            seq = self._segments[-1].seq + 1
+        return _Segment(os.path.join(self.directory, f"{seq:012d}{_SEGMENT_SUFFIX}"), size)
+
+    # --- Escritura ---
+
+    def add(self, rows):
+        future = Future()
+        if not rows:
+            future.set_result([])
+            return future
+        payload = json.dumps(rows, separators=(",", ":"), default=str).encode("utf-8")
+        record_header = _HEADER.pack(len(payload), zlib.crc32(payload), len(rows), time.time())
+        with self._cond:
+            if self._closed:
+                raise RuntimeError(f"El spool '{self.name}' ya fue cerrado.")
+            segment = self._segments[-1]
+            needed = _HEADER.size + len(payload)
+            if segment.end + needed > segment.size:
+                segment = self._new_segment(max(self.segment_bytes, needed))
+                self._segments.append(segment)
+            offset = segment.write(record_header, payload)
+            self._futures[(segment.seq, offset)] = future
+            self._pending_rows += len(rows)
+            self._cond.notify()
+        return future
+
+    def pending(self):
+        with self._cond:
+            return self._pending_rows
+
+    # --- Reenvío ---
+
+    def _run(self):
+        failures = 0
+        while True:
+            with self._cond:
+                while not self._pending_rows and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+            batch, rows = self._read_batch()
+            try:
+                errors = self._insert_fn(rows) or []
+            except Exception as e:
+                failures += 1
+                REPLAY_FAILURES.inc(self.name)
+                delay = min(INGEST_SPOOL_RETRY_MAX_S, 0.5 * 2 ** min(failures, 16))
+                log.error("No se pudo reenviar el spool; se reintentará.", spool=self.name,
+                          rows=len(rows), retry_in_s=delay, error=str(e))
+                with self._cond:
+                    self._cond.wait_for(lambda: self._closed, timeout=delay)
+                    if self._closed:
+                        return
+                continue
+            failures = 0
+            self._commit(batch, rows, errors)
+
+    def _read_batch(self):
+        """Registros desde el checkpoint hasta juntar replay_rows filas: ([(seq, inicio, fin, filas)], filas)."""
+        with self._cond:
+            seq, offset = self._checkpoint
+            segments = [(segment, segment.end) for segment in self._segments if segment.seq >= seq]
+        batch, rows = [], []
+        for segment, limit in segments:
+            start = offset if segment.seq == seq else 0
+            for record_start, record_end, _, _, payload in _scan(segment.map, start, limit):
+                records = json.loads(payload)
+                batch.append((segment.seq, record_start, record_end, len(records)))
+                rows.extend(records)
+                if len(rows) >= self.replay_rows:
+                    return batch, rows
+        return batch, rows
+
+    def _commit(self, batch, rows, errors):
+        REPLAYED_ROWS.inc(self.name, "error", amount=len(errors))
+        REPLAYED_ROWS.inc(self.name, "ok", amount=len(rows) - len(errors))
+        if errors:
+            # Los errores que quedan tras los reintentos de storage son de las filas mismas.
+            log.error("Filas del spool rechazadas por el almacenamiento.", spool=self.name, errors=errors)
+
+        with self._cond:
+            record_offset = 0
+            for seq, start, _, count in batch:
+                future = self._futures.pop((seq, start), None)
+                if future is not None:
+                    future.set_result([
+                        dict(error, index=error["index"] - record_offset)
+                        for error in errors
+                        if record_offset <= error["index"] < record_offset + count
+                    ])
+                record_offset += count
+            seq, _, end, _ = batch[-1]
+            self._checkpoint = (seq, end)
+            self._pending_rows -= len(rows)
+            # Los segmentos ya reenviados (todos menos el activo) se borran.
+            while len(self._segments) > 1 and (
+                    self._segments[0].seq < seq or self._checkpoint == (self._segments[0].seq, self._segments[0].end)):
+                self._segments.pop(0).close(remove=True)
+                if self._checkpoint[0] < self._segments[0].seq:
+                    self._checkpoint = (self._segments[0].seq, 0)
+            self._write_checkpoint()
+            self._cond.notify_all()
+
+    def _write_checkpoint(self):
+        path = os.path.join(self.directory, _CHECKPOINT)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"segment": self._checkpoint[0], "offset": self._checkpoint[1]}, f)
+        os.replace(path + ".tmp", path)
+
+    # --- Estado y cierre ---
+
+    def stats(self):
+        """Profundidad (filas y bytes sin reenviar), segmentos y antigüedad del registro más viejo."""
+        with self._cond:
+            seq, offset = self._checkpoint
+            pending_bytes = sum(
+                segment.end - (offset if segment.seq == seq else 0)
+                for segment in self._segments if segment.seq >= seq
+            )
+            oldest = None
+            for segment in self._segments:
+                start = offset if segment.seq == seq else 0
+                if segment.seq >= seq and segment.end > start:
+                    oldest = _HEADER.unpack_from(segment.map, start)[3]
+                    break
+        return {
+            "pending_rows": self._pending_rows,
+            "pending_bytes": pending_bytes,
+            "segments": len(self._segments),
+            "replay_lag_seconds": round(time.time() - oldest, 3) if oldest is not None else 0,
+        }
+
+    def drain(self, timeout):
+        """Espera hasta `timeout` segundos a que el replayer vacíe el spool. Devuelve si quedó vacío."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending_rows, timeout=timeout)
+
+    def close(self, drain_timeout=INGEST_SPOOL_DRAIN_TIMEOUT_S):
+        """Intenta vaciar el spool, detiene el replayer y cierra los segmentos (lo pendiente queda en disco)."""
+        if not self.drain(drain_timeout):
+            log.warning("El spool no se vació antes de cerrar.", spool=self.name, pending_rows=self.pending())
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout=30)
+        for segment in self._segments:
+            segment.close()
+        self._lock_file.close()
+
+
+_spools = {}
+_spools_lock = threading.Lock()
+
+
+def get_spool(name, insert_fn, **kwargs):
+    """
+    Devuelve el spool `name` del proceso (en INGEST_SPOOL_DIR/<name>), creándolo la
+    primera vez, o None si otro proceso ya usa ese directorio.
+    """
+    with _spools_lock:
+        if name not in _spools:
+            try:
+                spool = Spool(os.path.join(INGEST_SPOOL_DIR, name), insert_fn, name=name, **kwargs)
+                register_stats(f"spool_{name}", f"Estado del spool '{name}'.", spool.stats)
+            except BlockingIOError:
+                log.warning("El spool lo usa otro proceso; se usa el buffer en memoria.", spool=name)
+                spool = None
+            _spools[name] = spool
+        return _spools[name]
+
+
+@atexit.register
+def close_all_spools():
+    """Intenta vaciar y cierra los spools al apagar la instancia."""
+    with _spools_lock:
+        spools = [spool for spool in _spools.values() if spool is not None]
+    for spool in spools:
+        spool.close()
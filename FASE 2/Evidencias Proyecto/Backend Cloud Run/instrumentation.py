@@ -0,0 +1,299 @@
+"""
+Instrumentación compartida por los handlers: logs estructurados con nivel y
+muestreo, tiempos por etapa y métricas en formato Prometheus.
+
+Logs: cada registro es una línea JSON en stdout ({"severity", "message", ...campos}),
+que Cloud Logging interpreta como log estructurado. Los registros por debajo de
+LOG_LEVEL no se serializan, y los marcados `sampled=True` (el ruido de cada
+petición) se emiten solo con probabilidad LOG_SAMPLE_RATE y llevan "sample_rate"
+para poder reescalar los conteos. Los errores nunca se muestrean.
+
+Métricas: contadores, histogramas e indicadores por proceso. `instrumented`
+envuelve un handler: cuenta las peticiones por estado, mide su duración y
+responde en METRICS_PATH (/metrics) con todas las métricas del proceso en el
+formato de texto de Prometheus. Dentro del handler, `with stage("parse"):` mide
+cada etapa (parse, normalize, storage, serialize) en el mismo histograma.
+"""
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import random
+import threading
+import time
+
+import flask
+
+# --- Configuración ---
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# Fracción de los registros `sampled=True` que se escriben (1 = todos, 0 = ninguno).
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", "0.1"))
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "true").lower() == "true"
+METRICS_PATH = os.environ.get("METRICS_PATH", "/metrics")
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
+# Límites (segundos) de los histogramas de latencia: de 1 ms a 30 s.
+LATENCY_BUCKETS_S = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_min_level = LEVELS.get(LOG_LEVEL, LEVELS["INFO"])
+_current_handler = contextvars.ContextVar("current_handler", default="-")
+
+
+# --- Métricas ---
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Contador monótono por combinación de etiquetas."""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name, _label_text(self.label_names, values), value) for values, value in items]
+
+
+class Gauge(Counter):
+    """Valor instantáneo (p. ej. profundidad de una cola) por combinación de etiquetas."""
+
+    kind = "gauge"
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram:
+    """Histograma acumulado con límites fijos, como los de Prometheus."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS_S):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # etiquetas -> [conteos por límite (+Inf al final), suma]
+        self._series = {}
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            series[1] += value
+
+    def samples(self):
+        with self._lock:
+            items = [(values, list(series[0]), series[1]) for values, series in self._series.items()]
+        lines = []
+        for values, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append((f"{self.name}_bucket", _label_text(self.label_names, values, [("le", bound)]), cumulative))
+            lines.append((f"{self.name}_sum", _label_text(self.label_names, values), total))
+            lines.append((f"{self.name}_count", _label_text(self.label_names, values), cumulative))
+        return lines
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+_collectors = []
+
+
+def _register(metric_class, name, help_text, label_names, **kwargs):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = metric_class(name, help_text, label_names, **kwargs)
+        return metric
+
+
+def counter(name, help_text, label_names=()):
+    """Devuelve (creándolo la primera vez) el contador `name` del proceso."""
+    return _register(Counter, name, help_text, label_names)
+
+
+def gauge(name, help_text, label_names=()):
+    """Devuelve (creándolo la primera vez) el indicador `name` del proceso."""
+    return _register(Gauge, name, help_text, label_names)
+
+
+def histogram(name, help_text, label_names=(), buckets=LATENCY_BUCKETS_S):
+    """Devuelve (creándolo la primera vez) el histograma `name` del proceso."""
+    return _register(Histogram, name, help_text, label_names, buckets=buckets)
+
+
+def register_stats(prefix, help_text, stats_fn):
+    """
+    Exporta en /metrics los contadores que un componente ya lleva en un dict
+    (p. ej. QueryCache.stats()): cada clave numérica queda como growingapp_<prefix>_<clave>.
+    """
+    with _registry_lock:
+        _collectors.append((prefix, help_text, stats_fn))
+
+
+REQUESTS = counter("growingapp_requests_total", "Peticiones atendidas por handler y código HTTP.", ("handler", "status"))
+REQUEST_SECONDS = histogram("growingapp_request_duration_seconds", "Duración de las peticiones por handler.", ("handler",))
+STAGE_SECONDS = histogram("growingapp_stage_duration_seconds", "Duración de cada etapa de un handler.", ("handler", "stage"))
+LOG_RECORDS = counter("growingapp_log_records_total", "Registros de log por nivel (emitidos o descartados por muestreo).", ("level", "emitted"))
+
+
+def render_metrics():
+    """Todas las métricas del proceso en el formato de texto de Prometheus."""
+    lines = []
+    with _registry_lock:
+        metrics = list(_registry.values())
+        collectors = list(_collectors)
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(f"{name}{labels} {value}" for name, labels, value in metric.samples())
+    for prefix, help_text, stats_fn in collectors:
+        try:
+            stats = stats_fn()
+        except Exception as e:
+            error(f"No se pudieron leer las métricas de '{prefix}': {e}")
+            continue
+        for key, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                name = f"growingapp_{prefix}_{key}"
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} untyped")
+                lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# --- Tiempos por etapa ---
+
+def current_handler():
+    """Nombre del handler en curso ("-" fuera de una petición)."""
+    return _current_handler.get()
+
+
+def observe_stage(stage_name, seconds, handler=None):
+    """Registra la duración de una etapa medida por quien llama."""
+    STAGE_SECONDS.observe(seconds, handler or _current_handler.get(), stage_name)
+
+
+@contextlib.contextmanager
+def stage(stage_name, handler=None):
+    """Mide el bloque como la etapa `stage_name` del handler en curso (o `handler`)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage_name, time.perf_counter() - start, handler)
+
+
+def _status_of(result):
+    status = getattr(result, "status_code", None)
+    if status is not None:
+        return status
+    if isinstance(result, tuple) and len(result) > 1 and isinstance(result[1], int):
+        return result[1]
+    return 200
+
+
+def metrics_response():
+    """Respuesta de METRICS_PATH (también para rutas de Flask propias)."""
+    return (render_metrics(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+def instrumented(handler_name):
+    """
+    Decorador para las funciones HTTP (debajo de @functions_framework.http o
+    @app.route). Mide la petición, deja `handler_name` como handler en curso para
+    stage() y los logs, y responde METRICS_PATH con las métricas del proceso.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            if METRICS_ENABLED and flask.request.path == METRICS_PATH:
+                return metrics_response()
+            token = _current_handler.set(handler_name)
+            start = time.perf_counter()
+            status = 500
+            try:
+                result = handler(*args, **kwargs)
+                status = _status_of(result)
+                return result
+            finally:
+                REQUEST_SECONDS.observe(time.perf_counter() - start, handler_name)
+                REQUESTS.inc(handler_name, str(status))
+                _current_handler.reset(token)
+        return wrapper
+    return decorator
+
+
+# --- Logs ---
+
+def enabled(level):
+    """Indica si los registros de `level` se escriben (para evitar armar mensajes costosos)."""
+    return LEVELS[level] >= _min_level
+
+
+def log(level, message, sampled=False, **fields):
+    """
+    Escribe un registro estructurado si su nivel alcanza LOG_LEVEL. Con `sampled`
+    se escribe solo con probabilidad LOG_SAMPLE_RATE (salvo los errores).
+    """
+    if LEVELS[level] < _min_level:
+        return
+    if sampled and level != "ERROR" and random.random() >= LOG_SAMPLE_RATE:
+        LOG_RECORDS.inc(level, "false")
+        return
+    LOG_RECORDS.inc(level, "true")
+    record = {"severity": level, "message": message, "handler": _current_handler.get()}
+    if sampled and level != "ERROR":
+        record["sample_rate"] = LOG_SAMPLE_RATE
+    record.update(fields)
+    print(json.dumps(record, default=str, ensure_ascii=False))
+
+
+def debug(message, sampled=False, **fields):
+    log("DEBUG", message, sampled, **fields)
+
+
+def info(message, sampled=False, **fields):
+    log("INFO", message, sampled, **fields)
+
+
+def warning(message, sampled=False, **fields):
+    log("WARNING", message, sampled, **fields)
+
+
+def error(message, **fields):
+    log("ERROR", message, **fields)
@@ -1,17 +1,283 @@
+import itertools
+import json
 import os
+import time
 import functions_framework
-from google.cloud import bigquery
-from flask import jsonify
-from datetime import datetime, timedelta
+from flask import Response, jsonify, stream_with_context
+from datetime import datetime, timedelta, timezone
+import instrumentation as log
+from backend_core import load_config, run_query, warm_up
+from backend_core import table_ref as build_table_ref
+from downsampling import bucket_seconds, parse_max_points, parse_resolution
+from instrumentation import instrumented, observe_stage, stage
+from pagination import decode_cursor, encode_cursor, keyset_filter, parse_page_size
+from rollups import SENSOR_RAW_RETENTION_DAYS, choose_level, level_table
+from time_windows import DEFAULT_WINDOW, resolve_window
 
-PROJECT_ID = os.environ.get("BIGQUERY_PROJECT_ID", "iot-growing-app")
-DATASET_ID = os.environ.get("BIGQUERY_DATASET_ID", "sensor_data")
-TABLE_ID = os.environ.get("BIGQUERY_TABLE_ID", "sensor_readings")
+# --- Configuración ---
+# Filas por página de resultados de BigQuery al recorrerlos; en modo stream cada
+# página se envía al cliente apenas llega, así la memoria no depende del rango.
+SENSOR_STREAM_PAGE_ROWS = int(os.environ.get("SENSOR_STREAM_PAGE_ROWS", "500"))
+# Hasta cuántos días atrás busca la ventana 'latest' la última lectura. Acota las
+# particiones diarias que se leen; un dispositivo sin lecturas en ese plazo no tiene datos.
+SENSOR_LATEST_LOOKBACK_DAYS = int(os.environ.get("SENSOR_LATEST_LOOKBACK_DAYS", "30"))
+
+# Formatos por columnas (ver chart_columnar), elegidos con 'format' o la cabecera Accept.
+COLUMNAR_MIMETYPE = 'application/vnd.growingapp.columnar+json'
+ARROW_MIMETYPE = 'application/vnd.apache.arrow.stream'
+_FORMAT_MIMETYPES = {'json': 'application/json', 'columnar': COLUMNAR_MIMETYPE, 'arrow': ARROW_MIMETYPE}
+
+
+def _warm_hot_tier():
+    from hot_tier import warm_hot_tier
+    warm_hot_tier()
+
+
+# La capa caliente (NumPy) se importa y se carga desde BigQuery en segundo plano.
+warm_up("hot_tier", then=_warm_hot_tier)
+
+
+class ReadingsPage:
+    """Recorre las filas de la consulta y recuerda lo necesario para cerrar la respuesta."""
+
+    def __init__(self, page_size):
+        self.page_size = page_size
+        self.count = 0
+        self.last_key = None
+        self.last_timestamp = None
+        self.has_more = False
+
+    def readings(self, pages):
+        """Entrega las lecturas (sin las columnas de cursor) página a página de BigQuery."""
+        for result_page in pages:
+            for row in result_page:
+                if self.page_size is not None and self.count == self.page_size:
+                    self.has_more = True
+                    return
+                reading = dict(row)
+                self.last_key = (reading.pop("cursor_us"), reading.pop("cursor_id"))
+                self.last_timestamp = reading["timestamp"]
+                self.count += 1
+                yield reading
+
+    def tail(self, window):
+        """Campos que dependen de las filas ya recorridas: fecha mostrada y cursor siguiente."""
+        if window.latest:
+            # Fecha (UTC) de la lectura más reciente devuelta, como antes.
+            tail = {"displayDate": self.last_timestamp[:10] if self.last_timestamp else "No hay datos"}
+        else:
+            tail = {"displayDate": window.display_date}
+        if self.page_size is not None:
+            tail["nextCursor"] = encode_cursor(*self.last_key) if self.has_more else None
+        return tail
+
+
+def negotiate_format(request):
+    """
+    Devuelve 'json' (filas), 'columnar' o 'arrow'. El parámetro 'format' manda sobre
+    la cabecera Accept. Lanza ValueError con un mensaje para el cliente.
+    """
+    requested = request.args.get('format')
+    if requested:
+        if requested not in _FORMAT_MIMETYPES:
+            raise ValueError("El parámetro 'format' debe ser 'json', 'columnar' o 'arrow'.")
+        return requested
+    best = request.accept_mimetypes.best_match(list(_FORMAT_MIMETYPES.values()), default='application/json')
+    return next(name for name, mimetype in _FORMAT_MIMETYPES.items() if mimetype == best)
+
+
+def _columnar_response(response_format, head, columns, window, headers):
+    from chart_columnar import arrow_ipc, columnar_json, latest_timestamp
+
+    if window.latest:
+        latest = latest_timestamp(columns)
+        display_date = datetime.fromtimestamp(latest, timezone.utc).strftime('%Y-%m-%d') if latest is not None else "No hay datos"
+    else:
+        display_date = window.display_date
+    head = {"displayDate": display_date, **head}
+    if response_format == 'arrow':
+        body = arrow_ipc(head, columns)
+    else:
+        body = columnar_json(head, columns)
+    return Response(body, 200, headers, mimetype=_FORMAT_MIMETYPES[response_format])
+
+
+def _hot_tier_columns(device_id, window, bucket_s, max_points, force_buckets):
+    """
+    Columnas {sensor, value, cursor_us, cursor_id} de la ventana leídas de la capa
+    caliente (ver hot_tier), con la misma reducción que _raw_query, o None si la
+    capa no está cargada o no cubre la ventana.
+    """
+    import numpy as np
+    from hot_tier import HOT_TIER_ENABLED, downsample, get_hot_tier
+
+    tier = get_hot_tier()
+    if not HOT_TIER_ENABLED or not tier.loaded:
+        return None
+    tier.ensure_fresh()
+    series = tier.points(device_id)
+    if window.latest:
+        if not series:
+            # Sin lecturas recientes: la última puede ser más antigua que la capa.
+            return None
+        end = max(int(times[-1]) for times, _ in series.values()) + 1
+        start = end - 1 - int(DEFAULT_WINDOW.total_seconds())
+    else:
+        start, end = int(window.start.timestamp()), int(window.end.timestamp())
+    if not tier.covers(device_id, start):
+        return None
+
+    parts = []
+    for metric, (times, values) in series.items():
+        in_window = (times >= start) & (times < end)
+        times, values = times[in_window], values[in_window]
+        keep = downsample(times, values, bucket_s, max_points, force_buckets)
+        parts.append((np.full(int(keep.sum()), metric), values[keep], times[keep]))
+    if not parts:
+        return {"sensor": np.array([], dtype=str), "value": np.array([]),
+                "cursor_us": np.array([], dtype=np.int64), "cursor_id": np.array([], dtype=str)}
+    sensors, values, times = (np.concatenate(column) for column in zip(*parts))
+    order = np.lexsort((sensors, times))
+    return {"sensor": sensors[order], "value": values[order], "cursor_us": times[order] * 1_000_000,
+            "cursor_id": sensors[order]}
+
+
+def _rows_from_columns(columns):
+    """Lecturas {sensor, value, timestamp} a partir de columnas (formato por filas)."""
+    return [
+        {"sensor": sensor, "value": value,
+         "timestamp": datetime.fromtimestamp(cursor_us // 1_000_000, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+         "cursor_us": cursor_us, "cursor_id": cursor_id}
+        for sensor, value, cursor_us, cursor_id in zip(
+            columns["sensor"].tolist(), columns["value"].tolist(),
+            columns["cursor_us"].tolist(), columns["cursor_id"].tolist())
+    ]
+
+
+def _stream_payload(head, readings, page, window):
+    """
+    Escribe el JSON por partes: primero la cabecera, luego cada lectura a medida que
+    llegan las páginas de BigQuery y al final displayDate y nextCursor.
+    """
+    yield json.dumps(head)[:-1] + ', "readings": ['
+    try:
+        for i, reading in enumerate(readings):
+            yield ("," if i else "") + json.dumps(reading)
+    except Exception as e:
+        # El estado 200 ya se envió: el error viaja en el propio cuerpo.
+        log.error("Error al leer resultados de BigQuery durante el envío.", error=str(e))
+        yield '], "error": ' + json.dumps("Error en el servidor al consultar datos.") + "}"
+        return
+    yield "], " + json.dumps(page.tail(window))[1:]
+
+
+def _raw_query(table_ref, window_filter, after_cursor=False, paged=False):
+    """
+    Lecturas crudas con reducción min/max por cubeta en la propia consulta: cada métrica
+    devuelve a lo más max_points puntos sin importar el rango, y BigQuery no envía filas
+    crudas de más. Si una métrica ya cabe en max_points (y no se pidió resolución) se devuelve tal cual.
+    Las filas se ordenan por (timestamp, sensor_reading_id), la clave de los cursores.
+    """
+    page_filter = f"AND {keyset_filter('timestamp', 'reading_id')}" if after_cursor else ""
+    limit_clause = "LIMIT @page_limit" if paged else ""
+    return f"""
+        WITH readings AS (
+            SELECT metric_type as sensor, value, timestamp, sensor_reading_id AS reading_id
+            FROM {table_ref}
+            WHERE
+                device_id = @device_id
+                AND metric_type IN ('temperature', 'humidity')
+                AND timestamp >= @scan_start AND timestamp < @scan_end
+        )
+        , windowed AS (
+            SELECT
+                sensor, value, timestamp, reading_id,
+                COUNT(*) OVER (PARTITION BY sensor) AS sensor_points,
+                MAX(timestamp) OVER (PARTITION BY sensor) AS last_timestamp,
+                DIV(UNIX_SECONDS(timestamp), @bucket_s) AS bucket
+            FROM readings
+            WHERE {window_filter}
+        )
+        , ranked AS (
+            SELECT
+                *,
+                ROW_NUMBER() OVER (PARTITION BY sensor, bucket ORDER BY value ASC, timestamp ASC) AS min_rank,
+                ROW_NUMBER() OVER (PARTITION BY sensor, bucket ORDER BY value DESC, timestamp ASC) AS max_rank
+            FROM windowed
+        )
+        SELECT
+            sensor,
+            value,
+            FORMAT_TIMESTAMP('%Y-%m-%dT%H:%M:%SZ', timestamp) as timestamp,
+            UNIX_MICROS(timestamp) AS cursor_us,
+            reading_id AS cursor_id
+        FROM ranked
+        WHERE
+            ((NOT @force_buckets AND sensor_points <= @max_points)
+            OR min_rank = 1 OR max_rank = 1 OR timestamp = last_timestamp)
+            {page_filter}
+        ORDER BY cursor_us, cursor_id
+        {limit_clause}
+    """
+
+
+def _rollup_query(table_ref, window_filter, after_cursor=False, paged=False):
+    """
+    Agregados por minuto u hora reagrupados en cubetas de @bucket_s: un punto por
+    cubeta con el promedio como 'value' y el mínimo y máximo de la cubeta.
+    Las filas parciales de un mismo minuto u hora se suman aquí.
+    Las filas se ordenan por (inicio de cubeta, sensor), la clave de los cursores.
+    """
+    page_filter = f"HAVING {keyset_filter('bucket_start', 'sensor')}" if after_cursor else ""
+    limit_clause = "LIMIT @page_limit" if paged else ""
+    return f"""
+        WITH readings AS (
+            SELECT metric_type as sensor, bucket_start as timestamp, count, sum, min, max
+            FROM {table_ref}
+            WHERE
+                device_id = @device_id
+                AND metric_type IN ('temperature', 'humidity')
+                AND bucket_start >= @scan_start AND bucket_start < @scan_end
+        )
+        , bucketed AS (
+            SELECT
+                sensor,
+                TIMESTAMP_SECONDS(DIV(UNIX_SECONDS(timestamp), @bucket_s) * @bucket_s) AS bucket_start,
+                count, sum, min, max
+            FROM readings
+            WHERE {window_filter}
+        )
+        SELECT
+            sensor,
+            ROUND(SUM(sum) / SUM(count), 1) as value,
+            MIN(min) as min,
+            MAX(max) as max,
+            SUM(count) as count,
+            FORMAT_TIMESTAMP('%Y-%m-%dT%H:%M:%SZ', bucket_start) as timestamp,
+            UNIX_MICROS(bucket_start) AS cursor_us,
+            sensor AS cursor_id
+        FROM bucketed
+        GROUP BY sensor, bucket_start
+        {page_filter}
+        ORDER BY cursor_us, cursor_id
+        {limit_clause}
+    """
 
-client = bigquery.Client(project=PROJECT_ID)
 
 @functions_framework.http
+@instrumented("list_sensor_readings")
 def list_sensor_readings(request):
+    """
+    Lecturas de temperatura y humedad de un dispositivo ('id') en una ventana (ver
+    time_windows.resolve_window), reducidas a 'max_points' por métrica.
+
+    Paginación por cursor: con 'page_size' (o 'cursor') la respuesta trae a lo más
+    page_size lecturas ordenadas por (timestamp, id) y 'nextCursor' para pedir la
+    siguiente página con '?cursor=' y los mismos parámetros (null en la última).
+    Con 'stream=true' las lecturas se envían a medida que llegan de BigQuery.
+    Con 'format=columnar' o 'format=arrow' (o la cabecera Accept equivalente) la
+    respuesta trae arreglos por métrica en lugar de un objeto por punto (ver chart_columnar).
+    """
     headers = { 'Access-Control-Allow-Origin': '*' }
     if request.method == 'OPTIONS':
         headers = {
@@ -23,79 +289,135 @@ def list_sensor_readings(request):
         return ('', 204, headers)
 
     device_id = request.args.get('id')
-    date_str = request.args.get('date')
+    stream = request.args.get('stream', '').lower() in ('1', 'true')
 
     if not device_id:
         return (jsonify({"error": "El parámetro 'id' del dispositivo es requerido."}), 400, headers)
 
-    table_ref = f"`{PROJECT_ID}.{DATASET_ID}.{TABLE_ID}`"
-    timezone = "America/Santiago"
+    # Los límites del día local se calculan aquí (zoneinfo, con los cambios de horario
+    # de Santiago); así cada carga del gráfico cuesta un solo trabajo de BigQuery.
+    try:
+        with stage("parse"):
+            window = resolve_window(request.args)
+            max_points = parse_max_points(request.args.get('max_points'))
+            resolution_s = parse_resolution(request.args.get('resolution'))
+            after = decode_cursor(request.args.get('cursor'))
+            page_size = parse_page_size(request.args.get('page_size'), after)
+            response_format = negotiate_format(request)
+    except ValueError as e:
+        return (jsonify({"error": str(e)}), 400, headers)
+    # La respuesta depende de Accept: los cachés intermedios deben distinguirla.
+    headers['Vary'] = 'Accept'
+    if response_format != 'json' and (page_size is not None or stream):
+        error = "Los formatos por columnas no admiten 'page_size', 'cursor' ni 'stream'."
+        return (jsonify({"error": error}), 400, headers)
+
+    if window.latest:
+        # La ventana 'latest' incluye ambos extremos: un segundo más.
+        range_s = DEFAULT_WINDOW.total_seconds() + 1
+    else:
+        range_s = (window.end - window.start).total_seconds()
+    bucket_s = bucket_seconds(range_s, max_points, resolution_s)
+
+    if page_size is None:
+        # Las últimas 24 h suelen estar en la capa caliente del proceso: sin BigQuery.
+        try:
+            with stage("hot_tier"):
+                columns = _hot_tier_columns(device_id, window, bucket_s, max_points, resolution_s is not None)
+        except Exception as e:
+            log.warning("No se pudo leer la capa caliente.", error=str(e))
+            columns = None
+        if columns is not None:
+            head = {"bucketSeconds": bucket_s, "source": "hot"}
+            with stage("serialize"):
+                if response_format != 'json':
+                    return _columnar_response(response_format, head, columns, window, headers)
+                page = ReadingsPage(None)
+                results = list(page.readings([_rows_from_columns(columns)]))
+                if window.latest and not results:
+                    return (jsonify({"displayDate": "No hay datos", "readings": []}), 200, headers)
+                return (jsonify({**head, **page.tail(window), "readings": results}), 200, headers)
+
+    # Se lee el agregado más grueso que cabe en la cubeta pedida; si el rango empieza
+    # antes de la retención de crudos, los crudos ya no existen y se usa un agregado.
+    now = datetime.now(timezone.utc)
+    raw_horizon = now - timedelta(days=SENSOR_RAW_RETENTION_DAYS)
+    # Para 'latest' el inicio real depende de la última lectura: se toma el del escaneo.
+    window_start = now - timedelta(days=SENSOR_LATEST_LOOKBACK_DAYS) if window.latest else window.start
+    level = choose_level(bucket_s, window_start, needs_rollup=not window.latest and window.start < raw_horizon)
+    if level is not None:
+        # Las cubetas deben ser múltiplo del nivel para no partir un minuto u hora.
+        bucket_s = -(-bucket_s // level.seconds) * level.seconds
+        data_query_for = _rollup_query
+        table_ref = build_table_ref(level_table(level))
+    else:
+        data_query_for = _raw_query
+        table_ref = build_table_ref(load_config().sensors_table)
 
     try:
-        if date_str:
-            display_date_str = date_str
-            start_timestamp_str = f"{date_str} 00:00:00"
-            end_timestamp_str = f"{date_str} 23:59:59"
-
-            start_timestamp_query = "SELECT TIMESTAMP(@start_ts, @timezone) as ts"
-            end_timestamp_query = "SELECT TIMESTAMP(@end_ts, @timezone) as ts"
-
-            job_config_start = bigquery.QueryJobConfig(query_parameters=[
-                bigquery.ScalarQueryParameter("start_ts", "STRING", start_timestamp_str),
-                bigquery.ScalarQueryParameter("timezone", "STRING", timezone)
-            ])
-            job_config_end = bigquery.QueryJobConfig(query_parameters=[
-                bigquery.ScalarQueryParameter("end_ts", "STRING", end_timestamp_str),
-                bigquery.ScalarQueryParameter("timezone", "STRING", timezone)
-            ])
-
-            start_timestamp = list(client.query(start_timestamp_query, job_config=job_config_start))[0].ts
-            end_timestamp = list(client.query(end_timestamp_query, job_config=job_config_end))[0].ts
+        params = [("device_id", "STRING", device_id), ("bucket_s", "INT64", bucket_s)]
+        # @scan_start/@scan_end son constantes de la consulta: BigQuery poda las
+        # particiones por día (un filtro con subconsulta, como el de 'latest', no poda).
+        if window.latest:
+            # Últimas 24 h hasta la lectura más recente, resueltas en la misma consulta.
+            window_filter = "timestamp >= TIMESTAMP_SUB((SELECT MAX(timestamp) FROM readings), INTERVAL @window_s SECOND)"
+            params.append(("window_s", "INT64", int(DEFAULT_WINDOW.total_seconds())))
+            params.append(("scan_start", "TIMESTAMP", window_start))
+            # Un día de margen para relojes de dispositivos adelantados.
+            params.append(("scan_end", "TIMESTAMP", now + timedelta(days=1)))
         else:
-            max_timestamp_query = f"""
-                SELECT MAX(timestamp) as max_ts
-                FROM {table_ref}
-                WHERE device_id = @device_id AND LOWER(metric_type) IN ('temperature', 'humidity')
-            """
-            job_config = bigquery.QueryJobConfig(
-                query_parameters=[bigquery.ScalarQueryParameter("device_id", "STRING", device_id)]
-            )
-            max_ts_result = list(client.query(max_timestamp_query, job_config=job_config))
-
-            if not max_ts_result or not max_ts_result[0].max_ts:
-                return (jsonify({"displayDate": "No hay datos", "readings": []}), 200, headers)
-
-            end_timestamp = max_ts_result[0].max_ts
-            start_timestamp = end_timestamp - timedelta(hours=24)
-            display_date_str = end_timestamp.strftime('%Y-%m-%d')
-
-        data_query = f"""
-            SELECT
-                LOWER(metric_type) as sensor,
-                value,
-                FORMAT_TIMESTAMP('%Y-%m-%dT%H:%M:%SZ', timestamp) as timestamp
-            FROM {table_ref}
-            WHERE
-                device_id = @device_id
-                AND timestamp BETWEEN @start_timestamp AND @end_timestamp
-                AND LOWER(metric_type) IN ('temperature', 'humidity')
-            ORDER BY timestamp ASC
-        """
-        job_config_data = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("device_id", "STRING", device_id),
-                bigquery.ScalarQueryParameter("start_timestamp", "TIMESTAMP", start_timestamp),
-                bigquery.ScalarQueryParameter("end_timestamp", "TIMESTAMP", end_timestamp)
-            ]
-        )
-        
-        query_job = client.query(data_query, job_config=job_config_data)
-        results = [dict(row) for row in query_job]
+            window_filter = "timestamp >= @start_timestamp AND timestamp < @end_timestamp"
+            params.append(("start_timestamp", "TIMESTAMP", window.start))
+            params.append(("end_timestamp", "TIMESTAMP", window.end))
+            params.append(("scan_start", "TIMESTAMP", window.start))
+            params.append(("scan_end", "TIMESTAMP", window.end))
+        if level is None:
+            params.append(("max_points", "INT64", max_points))
+            params.append(("force_buckets", "BOOL", resolution_s is not None))
+        if after is not None:
+            params.append(("after_us", "INT64", after[0]))
+            params.append(("after_id", "STRING", after[1]))
+        if page_size is not None:
+            # Una fila de más indica si hay otra página.
+            params.append(("page_limit", "INT64", page_size + 1))
+
+        query = data_query_for(table_ref, window_filter, after_cursor=after is not None, paged=page_size is not None)
+        # Espera a que termine el trabajo: los errores de la consulta se responden con 500
+        # antes de empezar a enviar el cuerpo.
+        # La etapa 'storage' incluye la descarga de las filas (salvo en modo stream,
+        # donde las páginas siguientes se leen mientras se envía el cuerpo).
+        storage_started = time.perf_counter()
+        rows = run_query(query, params).result(page_size=SENSOR_STREAM_PAGE_ROWS)
+        head = {"bucketSeconds": bucket_s, "source": level.name if level is not None else "raw"}
+        if response_format != 'json':
+            # NumPy (y pyarrow, si está) solo se importan cuando el cliente pide un formato por columnas.
+            from chart_columnar import fetch_columns
+            columns = fetch_columns(rows)
+            observe_stage("storage", time.perf_counter() - storage_started)
+            with stage("serialize"):
+                return _columnar_response(response_format, head, columns, window, headers)
+
+        pages = rows.pages
+        first_page = next(pages, None)
+        if first_page is not None:
+            pages = itertools.chain([first_page], pages)
+        page = ReadingsPage(page_size)
+
+        if window.latest and after is None and (first_page is None or not first_page.num_items):
+            observe_stage("storage", time.perf_counter() - storage_started)
+            return (jsonify({"displayDate": "No hay datos", "readings": []}), 200, headers)
+
+        if stream:
+            observe_stage("storage", time.perf_counter() - storage_started)
+            return Response(stream_with_context(_stream_payload(head, page.readings(pages), page, window)),
+                            200, headers, mimetype='application/json')
 
-        response_payload = {"displayDate": display_date_str, "readings": results}
-        return (jsonify(response_payload), 200, headers)
+        results = list(page.readings(pages))
+        observe_stage("storage", time.perf_counter() - storage_started)
+        with stage("serialize"):
+            return (jsonify({**head, **page.tail(window), "readings": results}), 200, headers)
 
     except Exception as e:
-        print(f"Error al consultar BigQuery: {e}")
+        log.error("Error al consultar BigQuery.", error=str(e))
         error_payload = { "error": "Error en el servidor al consultar datos.", "details": str(e) }
-        return (jsonify(error_payload), 500, headers)
\ No newline at end of file
+        return (jsonify(error_payload), 500, headers)
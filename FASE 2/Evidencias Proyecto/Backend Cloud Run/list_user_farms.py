@@ -1,19 +1,18 @@
 import functions_framework
 import json
-from google.cloud import bigquery
-import os
-import uuid
-try:
-    bq_client = bigquery.Client()
-    PROJECT_ID = os.environ.get('BIGQUERY_PROJECT_ID')
-    DATASET_ID = os.environ.get('BIGQUERY_DATASET_ID')
-except Exception as e:
-    print(f"CRITICAL: Error inicializando BigQuery Client: {e}")
-    bq_client = None
+import instrumentation as log
+from backend_core import load_config, table_ref, warm_up
+from instrumentation import instrumented, stage
+from storage import get_storage
+from query_cache import cached_query, wants_fresh
+
+warm_up()
+
 def format_bigquery_rows(rows):
     return [dict(row) for row in rows]
 
 @functions_framework.http
+@instrumented("get_user_farms_http")
 def get_user_farms_http(request):
     headers = {
         'Access-Control-Allow-Origin': '*',
@@ -25,7 +24,10 @@ def get_user_farms_http(request):
     if request.method == 'OPTIONS':
         return ('', 204, headers)
 
-    if not bq_client or not PROJECT_ID or not DATASET_ID:
+    try:
+        get_storage().warm_up()
+    except Exception as e:
+        log.error("Error inicializando el backend de almacenamiento.", error=str(e))
         return (json.dumps({"error": "Configuración de backend incompleta..."}), 500, headers)
 
 
@@ -37,17 +39,21 @@ def get_user_farms_http(request):
 
     query = f"""
         SELECT farm_id, farm_name, IFNULL(image_url, 'assets/images/farm_default.png') as imageUrl
-        FROM `{PROJECT_ID}.{DATASET_ID}.farms`
+        FROM {table_ref(load_config().farms_table)}
         WHERE user_uid = @user_uid ORDER BY farm_name;
     """
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[bigquery.ScalarQueryParameter("user_uid", "STRING", user_uid_to_query)]
-    )
-
     try:
-        query_job = bq_client.query(query, job_config=job_config)
-        results = query_job.result()
+        with stage("storage"):
+            results, cache_hit = cached_query(
+                query,
+                [("user_uid", "STRING", user_uid_to_query)],
+                tags=[("farms", user_uid_to_query)],
+                refresh=wants_fresh(request),
+            )
         farms_data = format_bigquery_rows(results)
-        return (json.dumps(farms_data), 200, headers)
+        headers['X-Cache'] = 'HIT' if cache_hit else 'MISS'
+        with stage("serialize"):
+            return (json.dumps(farms_data), 200, headers)
     except Exception as e:
+        log.error("Error al consultar las granjas.", user_uid=user_uid_to_query, error=str(e))
         return (json.dumps({"error": "Error interno...", "details": str(e)}), 500, headers)
\ No newline at end of file
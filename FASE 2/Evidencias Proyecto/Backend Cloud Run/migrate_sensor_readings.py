@@ -0,0 +1,172 @@
+"""
+Migración de sensor_readings al esquema particionado de bd.sql.
+
+En BigQuery reconstruye la tabla particionada por DATE(timestamp) y agrupada por
+(device_id, metric_type), con metric_type normalizado como lo guarda la ingesta
+(sensor_normalization.normalize_metric_name):
+
+1. CREATE TABLE ... AS SELECT en una tabla nueva (<tabla>_partitioned).
+2. Pone al día la tabla nueva con las filas que llegaron mientras se copiaba.
+3. Renombra la tabla original a <tabla>_backup_<fecha> y la nueva al nombre original.
+4. Vuelve a copiar desde el respaldo lo que llegó entre el paso 2 y el renombre.
+5. Normaliza metric_type en las tablas de agregados.
+
+BigQuery no permite renombrar una tabla con filas en el búfer de streaming: hay
+que detener la ingesta (get_arduino_data) y esperar a que el búfer se vacíe (hasta
+~90 minutos); la migración se detiene si la tabla aún lo tiene. El respaldo no se
+borra: se elimina a mano una vez verificada la tabla nueva.
+
+En SQLite solo normaliza metric_type; el índice (device_id, metric_type, timestamp)
+lo crea sqlite_schema.sql al abrir la base.
+
+Uso:
+    python migrate_sensor_readings.py --dry-run     # estima los bytes de la copia
+    python migrate_sensor_readings.py
+"""
+import argparse
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+import instrumentation as log
+from backend_core import get_bq_client, load_config, run_query, table_id, table_ref
+from rollups import ROLLUP_LEVELS, level_table
+from sensor_normalization import METRIC_NAME_MAP
+from storage import get_storage
+
+# --- Configuración ---
+# Horas hacia atrás (por timestamp de la lectura) que se revisan al poner al día la
+# tabla nueva; cubre lecturas que llegan con retraso desde el dispositivo.
+MIGRATION_CATCHUP_HOURS = int(os.environ.get("MIGRATION_CATCHUP_HOURS", "48"))
+
+
+def normalized_metric_sql(column="metric_type"):
+    """Expresión SQL equivalente a normalize_metric_name sobre `column`."""
+    cases = " ".join(f"WHEN '{name}' THEN '{metric}'" for name, metric in METRIC_NAME_MAP.items())
+    return f"CASE {column} {cases} ELSE LOWER(TRIM({column})) END"
+
+
+def _select_normalized(source_ref):
+    return f"""
+        SELECT sensor_reading_id, {normalized_metric_sql()} AS metric_type, value, timestamp, device_id
+        FROM {source_ref}"""
+
+
+def build_copy_statement(source_ref, target_ref):
+    return f"""
+        CREATE TABLE {target_ref}
+        PARTITION BY DATE(timestamp)
+        CLUSTER BY device_id, metric_type
+        AS {_select_normalized(source_ref)}"""
+
+
+def build_catchup_statement(source_ref, target_ref):
+    """Copia de `source` las filas recientes (>= @since) que aún no están en `target`."""
+    return f"""
+        INSERT INTO {target_ref} (sensor_reading_id, metric_type, value, timestamp, device_id)
+        {_select_normalized(source_ref)} s
+        WHERE s.timestamp >= @since
+            AND NOT EXISTS (
+                SELECT 1 FROM {target_ref} t
+                WHERE t.timestamp >= @since AND t.sensor_reading_id = s.sensor_reading_id
+            )"""
+
+
+def build_rollup_statement(rollup_ref):
+    return f"""
+        UPDATE {rollup_ref}
+        SET metric_type = {normalized_metric_sql()}
+        WHERE metric_type != {normalized_metric_sql()}"""
+
+
+def _bytes(job):
+    return job.total_bytes_processed or 0
+
+
+def migrate_bigquery(dry_run=False, now=None):
+    now = now or datetime.now(timezone.utc)
+    client = get_bq_client()
+    table_name = load_config().sensors_table
+    new_name = f"{table_name}_partitioned"
+    backup_name = f"{table_name}_backup_{now:%Y%m%d}"
+    source_ref, new_ref, backup_ref = table_ref(table_name), table_ref(new_name), table_ref(backup_name)
+    summary = {"table": table_id(table_name), "backup": table_id(backup_name)}
+
+    table = client.get_table(table_id(table_name))
+    if table.time_partitioning is not None:
+        summary["status"] = "already_partitioned"
+        return summary
+
+    if dry_run:
+        summary["estimated_bytes"] = get_storage().estimate_bytes(_select_normalized(source_ref))
+        summary["status"] = "dry_run"
+        return summary
+
+    if table.streaming_buffer is not None:
+        raise RuntimeError(
+            "La tabla tiene filas en el búfer de streaming: detener la ingesta y reintentar "
+            f"cuando se vacíe (más antigua: {table.streaming_buffer.oldest_entry_time}).")
+
+    since = now - timedelta(hours=MIGRATION_CATCHUP_HOURS)
+    # Las copias leen la tabla completa: sin presupuesto de bytes.
+    job = run_query(build_copy_statement(source_ref, new_ref), bytes_budget=0)
+    job.result()
+    summary["copy_bytes"] = _bytes(job)
+    log.info("Copia particionada creada.", table=table_id(new_name), bytes_processed=summary["copy_bytes"])
+
+    job = run_query(build_catchup_statement(source_ref, new_ref), [("since", "TIMESTAMP", since)], bytes_budget=0)
+    job.result()
+    summary["caught_up_rows"] = job.num_dml_affected_rows or 0
+
+    run_query(f"ALTER TABLE {source_ref} RENAME TO `{backup_name}`").result()
+    run_query(f"ALTER TABLE {new_ref} RENAME TO `{table_name}`").result()
+    log.info("Tablas intercambiadas.", table=summary["table"], backup=summary["backup"])
+
+    job = run_query(build_catchup_statement(backup_ref, source_ref), [("since", "TIMESTAMP", since)], bytes_budget=0)
+    job.result()
+    summary["caught_up_rows"] += job.num_dml_affected_rows or 0
+
+    summary["rollup_rows_normalized"] = _normalize_rollups()
+    summary["status"] = "migrated"
+    return summary
+
+
+def _normalize_rollups():
+    updated = 0
+    for level in ROLLUP_LEVELS:
+        job = run_query(build_rollup_statement(table_ref(level_table(level))), bytes_budget=0)
+        job.result()
+        updated += job.num_dml_affected_rows or 0
+    return updated
+
+
+def migrate_sqlite(dry_run=False):
+    table_name = load_config().sensors_table
+    where = f"WHERE metric_type != {normalized_metric_sql()}"
+    if dry_run:
+        rows = list(run_query(f"SELECT COUNT(*) AS pending FROM {table_ref(table_name)} {where}"))
+        return {"table": table_name, "pending_rows": rows[0].pending, "status": "dry_run"}
+    job = run_query(f"UPDATE {table_ref(table_name)} SET metric_type = {normalized_metric_sql()} {where}")
+    return {
+        "table": table_name,
+        "rows_normalized": job.num_dml_affected_rows or 0,
+        "rollup_rows_normalized": _normalize_rollups(),
+        "status": "migrated",
+    }
+
+
+def run_migration(dry_run=False):
+    """Migra sensor_readings en el backend configurado y devuelve un resumen."""
+    if get_storage().dialect == "bigquery":
+        summary = migrate_bigquery(dry_run=dry_run)
+    else:
+        summary = migrate_sqlite(dry_run=dry_run)
+    log.info("Migración de sensor_readings terminada.", **summary)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true", help="solo estima, sin modificar nada")
+    args = parser.parse_args()
+    print(json.dumps(run_migration(dry_run=args.dry_run), indent=2, default=str))
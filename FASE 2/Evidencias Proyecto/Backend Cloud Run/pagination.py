@@ -0,0 +1,55 @@
+import base64
+import json
+import os
+
+# --- Configuración ---
+# Tamaño de página por defecto (cuando llega un cursor sin 'page_size') y tope que puede pedir el cliente.
+DEFAULT_PAGE_SIZE = int(os.environ.get("SENSOR_PAGE_SIZE", "1000"))
+MAX_PAGE_SIZE = int(os.environ.get("SENSOR_PAGE_SIZE_LIMIT", "5000"))
+
+
+def parse_page_size(value, cursor=None):
+    """
+    Valida el parámetro 'page_size'. Devuelve None (sin paginar) si no se pidió página
+    ni se envió cursor. Lanza ValueError con un mensaje para el cliente.
+    """
+    if value in (None, ''):
+        return DEFAULT_PAGE_SIZE if cursor is not None else None
+    try:
+        page_size = int(value)
+    except ValueError:
+        raise ValueError("El parámetro 'page_size' debe ser un entero.")
+    if not 1 <= page_size <= MAX_PAGE_SIZE:
+        raise ValueError(f"El parámetro 'page_size' debe estar entre 1 y {MAX_PAGE_SIZE}.")
+    return page_size
+
+
+def encode_cursor(timestamp_us, row_id):
+    """Cursor opaco para el cliente a partir de la clave (timestamp en microsegundos, id) de la última fila."""
+    raw = json.dumps([timestamp_us, row_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(value):
+    """
+    Devuelve (timestamp_us, id) de un cursor de encode_cursor, o None si no hay cursor.
+    Lanza ValueError con un mensaje para el cliente.
+    """
+    if value in (None, ''):
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+        timestamp_us, row_id = json.loads(raw)
+        if not isinstance(timestamp_us, int) or not isinstance(row_id, str):
+            raise TypeError
+    except (ValueError, TypeError):
+        raise ValueError("El parámetro 'cursor' no es válido.")
+    return timestamp_us, row_id
+
+
+def keyset_filter(timestamp_expr, id_expr):
+    """Condición SQL para las filas posteriores al cursor (@after_us, @after_id) en el orden (timestamp, id)."""
+    return (
+        f"(UNIX_MICROS({timestamp_expr}) > @after_us"
+        f" OR (UNIX_MICROS({timestamp_expr}) = @after_us AND {id_expr} > @after_id))"
+    )
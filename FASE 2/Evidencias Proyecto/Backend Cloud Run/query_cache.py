@@ -0,0 +1,194 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import instrumentation as log
+from backend_core import run_query
+from instrumentation import register_stats
+
+# --- Configuración ---
+# TTL por defecto (segundos) y cantidad máxima de resultados guardados por instancia.
+QUERY_CACHE_TTL_S = float(os.environ.get("QUERY_CACHE_TTL_S", "60"))
+QUERY_CACHE_MAX_ENTRIES = int(os.environ.get("QUERY_CACHE_MAX_ENTRIES", "1024"))
+# Cada cuántas consultas se escriben los contadores de la caché en el log (0 = nunca).
+QUERY_CACHE_LOG_EVERY = int(os.environ.get("QUERY_CACHE_LOG_EVERY", "100"))
+
+
+class QueryCache:
+    """
+    Caché en memoria de lectura a través (read-through) con TTL y desalojo LRU.
+
+    Las claves son (consulta, parámetros). Varias peticiones que piden la misma
+    clave mientras se está cargando comparten una sola consulta (single-flight).
+    Cada entrada puede llevar etiquetas, p. ej. ("farms", user_uid), para que las
+    escrituras invaliden exactamente las claves afectadas.
+
+    La caché es por proceso: una invalidación solo afecta a la instancia que la
+    hace. En las demás instancias y en las demás funciones (create_farm se
+    despliega aparte de list_user_farms) la entrada caduca por TTL; tras una
+    escritura, el cliente que necesite verla al instante pide ?fresh=true.
+    """
+
+    def __init__(self, max_entries=QUERY_CACHE_MAX_ENTRIES, default_ttl_s=QUERY_CACHE_TTL_S):
+        self.max_entries = max(1, max_entries)
+        self.default_ttl_s = default_ttl_s
+        self._lock = threading.Lock()
+        # clave -> (expira_en, valor, etiquetas)
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._inflight = {}
+        # Contador de invalidaciones: una carga iniciada antes de invalidar una
+        # de sus etiquetas (o de vaciar la caché) no se guarda al terminar.
+        self._generation = 0
+        self._tag_generations = {}
+        self._cleared_generation = 0
+        self._counters = {
+            "hits": 0, "misses": 0, "coalesced": 0, "evictions": 0,
+            "expirations": 0, "invalidations": 0, "load_errors": 0,
+        }
+
+    def get_or_load(self, key, loader, ttl_s=None, tags=(), refresh=False):
+        """
+        Devuelve (valor, hit). Si la clave no está (o expiró, o `refresh`), llama a
+        `loader()` una sola vez aunque haya peticiones concurrentes.
+        """
+        ttl_s = self.default_ttl_s if ttl_s is None else ttl_s
+        with self._lock:
+            if not refresh:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    if entry[0] > time.monotonic():
+                        self._entries.move_to_end(key)
+                        self._counters["hits"] += 1
+                        return entry[1], True
+                    self._remove(key)
+                    self._counters["expirations"] += 1
+
+            future = self._inflight.get(key)
+            if future is not None:
+                self._counters["coalesced"] += 1
+                owner = False
+            else:
+                future = Future()
+                self._inflight[key] = future
+                self._counters["misses"] += 1
+                owner = True
+                generation = self._generation
+
+        if not owner:
+            return future.result(), False
+
+        try:
+            value = loader()
+        except Exception as e:
+            with self._lock:
+                self._inflight.pop(key, None)
+                self._counters["load_errors"] += 1
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self._inflight.pop(key, None)
+            if not self._invalidated_since(tags, generation):
+                self._store(key, value, ttl_s, tags)
+            if not self._inflight:
+                # Sin cargas en curso ya no hace falta recordar invalidaciones.
+                self._tag_generations.clear()
+        future.set_result(value)
+        return value, False
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+                self._counters["invalidations"] += 1
+
+    def invalidate_tag(self, tag):
+        """Elimina todas las entradas marcadas con `tag`."""
+        with self._lock:
+            self._generation += 1
+            if self._inflight:
+                self._tag_generations[tag] = self._generation
+            for key in list(self._tags.get(tag, ())):
+                self._remove(key)
+                self._counters["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._cleared_generation = self._generation
+            self._entries.clear()
+            self._tags.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counters, size=len(self._entries))
+        lookups = stats["hits"] + stats["misses"] + stats["coalesced"]
+        stats["hit_ratio"] = round((stats["hits"] + stats["coalesced"]) / lookups, 4) if lookups else 0.0
+        return stats
+
+    # --- Internos (se llaman con el lock tomado) ---
+
+    def _invalidated_since(self, tags, generation):
+        if self._cleared_generation > generation:
+            return True
+        return any(self._tag_generations.get(tag, 0) > generation for tag in tags)
+
+    def _store(self, key, value, ttl_s, tags):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + ttl_s, value, tuple(tags))
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self._counters["evictions"] += 1
+
+    def _remove(self, key):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+_cache = QueryCache()
+_lookups = 0
+register_stats("query_cache", "Contadores de la caché de consultas (ver QueryCache.stats).", _cache.stats)
+
+
+def get_query_cache():
+    """Caché de consultas compartida por todo el proceso."""
+    return _cache
+
+
+def cached_query(sql, params=None, tags=(), ttl_s=None, refresh=False):
+    """
+    Ejecuta `sql` a través de la caché y devuelve (filas, hit).
+    Las filas se materializan en una lista para poder reutilizarlas entre peticiones.
+    """
+    global _lookups
+    key = (sql, tuple(tuple(p) for p in params or ()))
+    result = _cache.get_or_load(key, lambda: list(run_query(sql, params).result()), ttl_s=ttl_s, tags=tags, refresh=refresh)
+
+    _lookups += 1
+    if QUERY_CACHE_LOG_EVERY and _lookups % QUERY_CACHE_LOG_EVERY == 0:
+        log.info("Estadísticas de la caché de consultas.", **_cache.stats())
+    return result
+
+
+def invalidate(*tags):
+    """Invalida las entradas con alguna de las etiquetas, p. ej. invalidate(("farms", user_uid))."""
+    for tag in tags:
+        _cache.invalidate_tag(tag)
+
+
+def wants_fresh(request):
+    """El cliente puede saltarse la caché con 'Cache-Control: no-cache' o ?fresh=true."""
+    cache_control = (request.headers.get("Cache-Control") or "").lower()
+    return "no-cache" in cache_control or request.args.get("fresh", "").lower() in ("true", "1")
@@ -0,0 +1,185 @@
+import hashlib
+import os
+from collections import namedtuple
+from datetime import datetime, timezone
+
+import instrumentation as log
+from backend_core import insert_rows, load_config, table_ref
+
+# --- Configuración ---
+# Si es falso no se escriben agregados al ingerir ni se leen al graficar (p. ej. sin tablas creadas).
+SENSOR_ROLLUPS_ENABLED = os.environ.get("SENSOR_ROLLUPS_ENABLED", "true").lower() == "true"
+# Días que se conservan las lecturas crudas; lo anterior solo queda en los agregados.
+SENSOR_RAW_RETENTION_DAYS = int(os.environ.get("SENSOR_RAW_RETENTION_DAYS", "30"))
+# Cada cuántos segundos se vuelve a leer la cobertura de los agregados (cambia
+# solo cuando corre compact_sensor_readings).
+SENSOR_ROLLUP_COVERAGE_TTL_S = float(os.environ.get("SENSOR_ROLLUP_COVERAGE_TTL_S", "300"))
+
+# Nivel de agregación: nombre, segundos por cubeta y campo de BackendConfig con su tabla.
+RollupLevel = namedtuple("RollupLevel", ["name", "seconds", "config_field"])
+
+# De más fino a más grueso.
+ROLLUP_LEVELS = (
+    RollupLevel("minute", 60, "rollup_minute_table"),
+    RollupLevel("hour", 3600, "rollup_hour_table"),
+)
+
+
+def level_table(level):
+    return getattr(load_config(), level.config_field)
+
+
+def choose_level(bucket_s, window_start, needs_rollup=False):
+    """
+    Devuelve el nivel más grueso cuyas cubetas caben en `bucket_s`, o None para leer
+    las lecturas crudas. Un nivel solo se usa si su cobertura (ver coverage_start)
+    incluye `window_start`: recién desplegado, el agregado solo tiene lo ingerido
+    desde entonces. Si `needs_rollup` (el rango empieza antes de la retención de
+    crudos) se usa al menos el nivel más fino, cubierto o no: los crudos ya no están.
+    """
+    if not SENSOR_ROLLUPS_ENABLED:
+        return None
+    chosen = None
+    for level in ROLLUP_LEVELS:
+        if level.seconds <= bucket_s:
+            chosen = level
+    if chosen is None and needs_rollup:
+        chosen = ROLLUP_LEVELS[0]
+    if chosen is None or needs_rollup:
+        return chosen
+    try:
+        covered_from = coverage_start(chosen)
+    except Exception as e:
+        log.warning("No se pudo leer la cobertura de los agregados.", rollup_level=chosen.name, error=str(e))
+        return None
+    if covered_from is None or window_start < covered_from:
+        return None
+    return chosen
+
+
+def _coverage_query():
+    return f"""
+        SELECT MIN(covered_from) AS covered_from
+        FROM {table_ref(load_config().rollup_coverage_table)}
+        WHERE level = @level
+    """
+
+
+def coverage_start(level, fresh=False):
+    """
+    Instante desde el que `level` está completo, o None si sus agregados nunca se
+    reconstruyeron desde los crudos (solo tienen lo ingerido desde el despliegue).
+    """
+    from query_cache import cached_query
+    rows, _ = cached_query(_coverage_query(), [("level", "STRING", level.name)],
+                           ttl_s=SENSOR_ROLLUP_COVERAGE_TTL_S, refresh=fresh)
+    return rows[0].covered_from if rows else None
+
+
+def record_coverage(rebuilt_from, rebuilt_to):
+    """
+    Registra que los agregados de [rebuilt_from, rebuilt_to) se reconstruyeron
+    desde los crudos. Desde rebuilt_to los agregados vienen de la ingesta, así que
+    la cobertura solo se extiende si el rango empalma con la ya registrada; la
+    primera vez se supone que la ingesta ya escribía agregados en rebuilt_to.
+    Devuelve {nivel: inicio de la cobertura}.
+    """
+    coverage = {}
+    rows = []
+    recorded_at = datetime.now(timezone.utc)
+    for level in ROLLUP_LEVELS:
+        covered_from = coverage_start(level, fresh=True)
+        if covered_from is None or (rebuilt_to >= covered_from and rebuilt_from < covered_from):
+            rows.append({
+                "level": level.name,
+                "covered_from": rebuilt_from.isoformat(),
+                "recorded_at": recorded_at.isoformat(),
+            })
+            covered_from = rebuilt_from
+        coverage[level.name] = covered_from.isoformat()
+    if rows:
+        errors = insert_rows(load_config().rollup_coverage_table, rows)
+        if errors:
+            raise RuntimeError(f"No se pudo registrar la cobertura de los agregados: {errors}")
+    return coverage
+
+
+def _bucket_start(timestamp_str, seconds):
+    dt = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
+    epoch = int(dt.timestamp())
+    return datetime.fromtimestamp(epoch - epoch % seconds, tz=timezone.utc)
+
+
+def aggregate_rows(rows, seconds):
+    """
+    Agregados parciales (count, sum, min, max) por dispositivo, métrica y cubeta
+    de `seconds` segundos para un lote de filas de sensor_readings. Devuelve pares
+    (fila parcial, IDs de las lecturas que la forman).
+    """
+    buckets = {}
+    for row in rows:
+        key = (row["device_id"], row["metric_type"], _bucket_start(row["timestamp"], seconds))
+        value = row["value"]
+        agg = buckets.get(key)
+        if agg is None:
+            buckets[key] = [1, value, value, value, [row["sensor_reading_id"]]]
+        else:
+            agg[0] += 1
+            agg[1] += value
+            agg[2] = min(agg[2], value)
+            agg[3] = max(agg[3], value)
+            agg[4].append(row["sensor_reading_id"])
+    return [
+        ({
+            "device_id": device_id,
+            "metric_type": metric_type,
+            "bucket_start": bucket_start.isoformat(),
+            "count": count,
+            "sum": total,
+            "min": minimum,
+            "max": maximum,
+        }, reading_ids)
+        for (device_id, metric_type, bucket_start), (count, total, minimum, maximum, reading_ids) in buckets.items()
+    ]
+
+
+def partial_id(level, row, reading_ids):
+    """
+    ID de inserción de una fila parcial: nivel, dispositivo, métrica, cubeta y las
+    lecturas que la forman. Reenviar el mismo lote (reintento del almacenamiento o
+    reenvío del spool tras una caída) produce los mismos IDs y BigQuery lo descarta.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{level.name}\x1f{row['device_id']}\x1f{row['metric_type']}\x1f{row['bucket_start']}".encode("utf-8"))
+    for reading_id in sorted(reading_ids):
+        digest.update(b"\x1f" + reading_id.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def record_rollups(rows):
+    """
+    Inserta los agregados parciales de un lote recién guardado en cada nivel.
+
+    Un mismo minuto u hora puede quedar repartido en varias filas parciales (una por
+    lote); las consultas las suman y el trabajo de compactación las reescribe
+    desde los crudos. Por eso un fallo aquí solo se registra: los crudos siguen
+    siendo la fuente y la compactación corrige los agregados. Cada fila parcial
+    lleva un ID de inserción determinista (partial_id) para no sumarse dos veces
+    y su hora de inserción (inserted_at), para que la compactación no intente
+    modificarla mientras siga en el buffer de streaming.
+    """
+    if not SENSOR_ROLLUPS_ENABLED or not rows:
+        return
+    inserted_at = datetime.now(timezone.utc).isoformat()
+    for level in ROLLUP_LEVELS:
+        try:
+            partials = aggregate_rows(rows, level.seconds)
+            errors = insert_rows(
+                level_table(level),
+                [dict(row, inserted_at=inserted_at) for row, _ in partials],
+                row_ids=[partial_id(level, row, reading_ids) for row, reading_ids in partials],
+            )
+            if errors:
+                log.warning("Errores al insertar agregados.", rollup_level=level.name, errors=errors)
+        except Exception as e:
+            log.warning("No se pudieron insertar los agregados.", rollup_level=level.name, error=str(e))
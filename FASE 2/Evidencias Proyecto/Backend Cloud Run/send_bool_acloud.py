@@ -1,56 +1,53 @@
-import os
-import requests
 import json
 import functions_framework
+import instrumentation as log
+from actuation import log_actuator_actions
+from arduino_client import get_arduino_client
+from backend_core import load_config, run_query, table_ref, warm_up
+from device_state_store import get_device_state_store
+from instrumentation import instrumented, stage
 
-ARDUINO_CLIENT_ID = os.environ.get('ARDUINO_CLIENT_ID', 'xD2qyoOLqut2tRG8tuwOIYdeVJb3uJsS')
-ARDUINO_CLIENT_SECRET = os.environ.get('ARDUINO_CLIENT_SECRET', 'l7tvmbeBBjHYrusPpCUf6sa3RKlaauWoSmpW4HofGlvO4E5gx2OORfIWE83BEHuO')
-ARDUINO_THING_ID = os.environ.get('ARDUINO_THING_ID', '5be76a70-5435-4f31-94c4-62a8d73c75f2')
-ARDUINO_PROPERTY_ID = os.environ.get('ARDUINO_PROPERTY_ID', 'relay_Control')
+_config = load_config()
+ARDUINO_CLIENT_ID = _config.arduino_client_id
+ARDUINO_CLIENT_SECRET = _config.arduino_client_secret
+ARDUINO_THING_ID = _config.arduino_thing_id
+ARDUINO_PROPERTY_ID = _config.arduino_property_id
 
-ARDUINO_TOKEN_URL = "https://api2.arduino.cc/iot/v1/clients/token"
-ARDUINO_API_BASE_URL = "https://api2.arduino.cc/iot/v2/things"
+# requests se importa en el primer uso; warm_up lo precarga en segundo plano
+# junto con el cliente de BigQuery (para guardar el estado del relé).
+warm_up("requests")
 
 def get_arduino_access_token():
-    """Obtiene un token de acceso OAuth2 para la API de Arduino Cloud."""
-    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-    data = {
-        'grant_type': 'client_credentials',
-        'client_id': ARDUINO_CLIENT_ID,
-        'client_secret': ARDUINO_CLIENT_SECRET,
-        'audience': 'https://api2.arduino.cc/iot'
-    }
-    try:
-        response = requests.post(ARDUINO_TOKEN_URL, headers=headers, data=data)
-        response.raise_for_status()
-        return response.json().get('access_token')
-    except requests.exceptions.RequestException as e:
-        print(f"Error al obtener el token de Arduino Cloud: {e}")
-        return None
+    """Obtiene un token de acceso OAuth2 para la API de Arduino Cloud (cacheado hasta su vencimiento)."""
+    return get_arduino_client().get_token()
 
 def update_arduino_thing_property(access_token, thing_id, property_id, new_value):
     """Actualiza una propiedad (variable) de un Thing en Arduino Cloud."""
-    if not access_token:
-        return False, "No se pudo obtener el token de acceso."
-
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
-    payload = {"value": new_value}
-    url = f"{ARDUINO_API_BASE_URL}/{thing_id}/properties/{property_id}/publish"
+    return get_arduino_client().publish_property(thing_id, property_id, new_value, access_token=access_token)
 
-    try:
-        response = requests.put(url, headers=headers, json=payload)
-        response.raise_for_status()
-        print(f"Propiedad '{property_id}' actualizada a {new_value} en Thing '{thing_id}'")
-        return True, "Propiedad actualizada exitosamente."
-    except requests.exceptions.RequestException as e:
-        print(f"Error de API al actualizar la propiedad: {e.response.status_code} - {e.response.text if e.response else 'No response'}")
-        return False, f"Error en API Arduino ({e.response.status_code if e.response else 'N/A'}): {e.response.text if e.response else str(e)}"
+def resolve_relay_target(device_id):
+    """
+    (thing_id, property_id) del relé de un dispositivo, o None si no existe. Los
+    dispositivos sin Thing o propiedad propios usan los de la configuración.
+    """
+    query = f"""
+        SELECT
+            IFNULL(arduino_thing_id, @default_thing_id) AS thing_id,
+            IFNULL(arduino_property_id, @default_property_id) AS property_id
+        FROM {table_ref(_config.devices_table)}
+        WHERE device_id = @device_id
+        LIMIT 1
+    """
+    rows = list(run_query(query, [
+        ("device_id", "STRING", device_id),
+        ("default_thing_id", "STRING", ARDUINO_THING_ID),
+        ("default_property_id", "STRING", ARDUINO_PROPERTY_ID),
+    ]))
+    return (rows[0].thing_id, rows[0].property_id) if rows else None
 
 
 @functions_framework.http
+@instrumented("send_bool_to_arduino")
 def send_bool_to_arduino(request):
 
     if request.method == 'OPTIONS':
@@ -75,21 +72,54 @@ def send_bool_to_arduino(request):
     if not isinstance(relay_state, bool):
         return (json.dumps({'status': 'error', 'message': 'El valor de "state" debe ser un booleano (true/false).'}), 400, headers)
 
-    print(f"Recibido estado para el relé: {relay_state}")
+    # Opcional: dispositivo cuyo estado se guarda en BigQuery y en el almacén de estados,
+    # o 'device_ids' si varios dispositivos comparten el mismo relé.
+    device_id = request_json.get('device_id')
+    device_ids = request_json.get('device_ids') or ([device_id] if device_id else [])
+    if not isinstance(device_ids, list) or not all(isinstance(d, str) and d for d in device_ids):
+        return (json.dumps({'status': 'error', 'message': 'El valor de "device_ids" debe ser una lista de IDs.'}), 400, headers)
+
+    # El relé se elige por 'thing_id'/'property_id' o, si no vienen, por el dispositivo;
+    # sin ninguno de los dos se usa el de la configuración.
+    thing_id = request_json.get('thing_id')
+    property_id = request_json.get('property_id')
+    if device_ids and not (thing_id and property_id):
+        with stage("resolve"):
+            target = resolve_relay_target(device_ids[0])
+        if target is None:
+            return (json.dumps({'status': 'error', 'message': f'No existe el dispositivo {device_ids[0]}.'}), 404, headers)
+        thing_id, property_id = thing_id or target[0], property_id or target[1]
+    thing_id = thing_id or ARDUINO_THING_ID
+    property_id = property_id or ARDUINO_PROPERTY_ID
+
+    log.info("Recibido estado para el relé.", sampled=True, relay_state=relay_state, device_ids=device_ids, thing_id=thing_id)
 
-    access_token = get_arduino_access_token()
-    if not access_token:
-        return (json.dumps({'status': 'error', 'message': 'Error interno: No se pudo obtener el token de Arduino.'}), 500, headers)
+    with stage("arduino"):
+        access_token = get_arduino_access_token()
+        if not access_token:
+            return (json.dumps({'status': 'error', 'message': 'Error interno: No se pudo obtener el token de Arduino.'}), 500, headers)
 
-    success, message = update_arduino_thing_property(
-        access_token,
-        ARDUINO_THING_ID,
-        ARDUINO_PROPERTY_ID,
-        relay_state
-    )
+        success, message = update_arduino_thing_property(
+            access_token,
+            thing_id,
+            property_id,
+            relay_state
+        )
 
     if success:
         response_payload = {"status": "success", "message": message, "new_relay_state": relay_state}
+        if device_ids:
+            # El relé ya cambió: si falla el guardado se informa, pero la respuesta sigue siendo 200.
+            with stage("storage"):
+                try:
+                    log_actuator_actions([(d, relay_state) for d in device_ids])
+                    device_states = get_device_state_store().set_relay_states({d: relay_state for d in device_ids})
+                    response_payload["state_persisted"] = all(s is not None for s in device_states.values())
+                    if device_id and device_states.get(device_id) is not None:
+                        response_payload["version"] = device_states[device_id].version
+                except Exception as e:
+                    log.error("Error al guardar el estado del relé.", device_ids=device_ids, error=str(e))
+                    response_payload["state_persisted"] = False
         return (json.dumps(response_payload), 200, headers)
     else:
         response_payload = {"status": "error", "message": message}
@@ -0,0 +1,177 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import functions_framework
+import instrumentation as log
+from actuation import log_actuator_actions
+from arduino_client import get_arduino_client
+from backend_core import load_config, run_query, table_ref, warm_up
+from device_state_store import get_device_state_store
+from instrumentation import instrumented, stage
+
+# --- Configuración ---
+# Comandos publicados en paralelo por petición (el limitador de arduino_client
+# sigue acotando la tasa total del proceso) y tope de comandos por petición.
+BULK_MAX_WORKERS = int(os.environ.get("BULK_MAX_WORKERS", "8"))
+BULK_MAX_COMMANDS = int(os.environ.get("BULK_MAX_COMMANDS", "500"))
+
+warm_up("requests")
+
+
+def resolve_crop_commands(crop_id, value):
+    """
+    Un comando por dispositivo del cultivo. Los dispositivos sin Thing o propiedad
+    propios usan los de la configuración (ARDUINO_THING_ID / ARDUINO_PROPERTY_ID).
+    """
+    config = load_config()
+    devices_query = f"""
+        SELECT
+            device_id,
+            IFNULL(arduino_thing_id, @default_thing_id) AS thing_id,
+            IFNULL(arduino_property_id, @default_property_id) AS property_id
+        FROM {table_ref(config.devices_table)}
+        WHERE crop_id = @crop_id
+    """
+    rows = run_query(devices_query, [
+        ("crop_id", "STRING", crop_id),
+        ("default_thing_id", "STRING", config.arduino_thing_id),
+        ("default_property_id", "STRING", config.arduino_property_id),
+    ])
+    return [
+        {"device_id": row.device_id, "thing_id": row.thing_id, "property_id": row.property_id, "value": value}
+        for row in rows
+    ]
+
+
+def parse_commands(request_json):
+    """Devuelve (comandos, error). Cada comando es {thing_id, property_id, value, device_id?}."""
+    commands = request_json.get('commands')
+    if not isinstance(commands, list) or not commands:
+        return None, 'Se requiere "commands" (lista no vacía) o "crop_id" con "value".'
+    if len(commands) > BULK_MAX_COMMANDS:
+        return None, f'Se permiten a lo más {BULK_MAX_COMMANDS} comandos por petición.'
+
+    config = load_config()
+    parsed = []
+    for i, command in enumerate(commands):
+        if not isinstance(command, dict) or 'value' not in command:
+            return None, f'El comando {i} debe ser un objeto con la clave "value".'
+        parsed.append({
+            "device_id": command.get('device_id'),
+            "thing_id": command.get('thing_id') or config.arduino_thing_id,
+            "property_id": command.get('property_id') or config.arduino_property_id,
+            "value": command['value'],
+        })
+    return parsed, None
+
+
+def _publish(client, access_token, command):
+    success, message = client.publish_property(
+        command["thing_id"], command["property_id"], command["value"], access_token=access_token
+    )
+    return dict(command, status='success' if success else 'error', message=message)
+
+
+def publish_commands(commands):
+    """Publica los comandos en paralelo (acotado) y devuelve un resultado por comando, en orden."""
+    client = get_arduino_client()
+    access_token = client.get_token()
+    if not access_token:
+        return None
+
+    # Dos comandos iguales para el mismo Thing y propiedad se publican una sola vez.
+    unique = {}
+    for command in commands:
+        unique.setdefault((command["thing_id"], command["property_id"], json.dumps(command["value"])), command)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(BULK_MAX_WORKERS, len(unique)))) as executor:
+        published = dict(zip(unique, executor.map(lambda c: _publish(client, access_token, c), unique.values())))
+
+    results = []
+    for command in commands:
+        outcome = published[(command["thing_id"], command["property_id"], json.dumps(command["value"]))]
+        results.append(dict(command, status=outcome["status"], message=outcome["message"]))
+    return results
+
+
+@functions_framework.http
+@instrumented("send_bulk_relay_commands")
+def send_bulk_relay_commands(request):
+    """
+    Función HTTP que publica varios comandos en Arduino Cloud en una sola petición.
+    Cuerpo: {"commands": [{"thing_id", "property_id", "value", "device_id"?}, ...]}
+    o {"crop_id": "...", "value": true} para todos los dispositivos del cultivo.
+    Responde un resultado por comando; 207 si solo algunos fallaron.
+    """
+    if request.method == 'OPTIONS':
+        headers = {
+            'Access-Control-Allow-Origin': '*',
+            'Access-Control-Allow-Methods': 'POST, OPTIONS',
+            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Max-Age': '3600'
+        }
+        return ('', 204, headers)
+    headers = {
+        'Access-Control-Allow-Origin': '*'
+    }
+    if request.method != 'POST':
+        return ('Solo se permiten solicitudes POST', 405, headers)
+
+    request_json = request.get_json(silent=True)
+    if not isinstance(request_json, dict):
+        return (json.dumps({'status': 'error', 'message': 'Falta el cuerpo JSON.'}), 400, headers)
+
+    try:
+        if request_json.get('crop_id'):
+            if 'value' not in request_json:
+                return (json.dumps({'status': 'error', 'message': 'Falta la clave "value".'}), 400, headers)
+            with stage("resolve"):
+                commands = resolve_crop_commands(request_json['crop_id'], request_json['value'])
+            if not commands:
+                return (json.dumps({'status': 'error', 'message': 'El cultivo no tiene dispositivos.'}), 404, headers)
+        else:
+            commands, error = parse_commands(request_json)
+            if error:
+                return (json.dumps({'status': 'error', 'message': error}), 400, headers)
+
+        log.info("Publicando comandos en Arduino Cloud.", commands=len(commands))
+        with stage("arduino"):
+            results = publish_commands(commands)
+        if results is None:
+            return (json.dumps({'status': 'error', 'message': 'Error interno: No se pudo obtener el token de Arduino.'}), 500, headers)
+
+        # Estado del relé de los dispositivos que sí cambiaron, en un solo lote.
+        relay_states = {r["device_id"]: r["value"] for r in results
+                        if r["status"] == 'success' and r["device_id"] and isinstance(r["value"], bool)}
+        state_persisted = None
+        if relay_states:
+            with stage("storage"):
+                try:
+                    log_actuator_actions(relay_states.items())
+                    get_device_state_store().set_relay_states(relay_states)
+                    state_persisted = True
+                except Exception as e:
+                    log.error("Error al guardar el estado de los relés.", devices=len(relay_states), error=str(e))
+                    state_persisted = False
+
+        succeeded = sum(1 for r in results if r["status"] == 'success')
+        if succeeded == len(results):
+            status, code = 'success', 200
+        elif succeeded:
+            status, code = 'partial', 207
+        else:
+            status, code = 'error', 500
+        response_payload = {
+            "status": status,
+            "succeeded": succeeded,
+            "failed": len(results) - succeeded,
+            "results": results,
+        }
+        if state_persisted is not None:
+            response_payload["state_persisted"] = state_persisted
+        return (json.dumps(response_payload), code, headers)
+
+    except Exception as e:
+        log.error("Error inesperado.", error=str(e))
+        return (json.dumps({'status': 'error', 'message': 'Error interno del servidor.'}), 500, headers)
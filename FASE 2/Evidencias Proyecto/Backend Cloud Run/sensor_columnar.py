@@ -0,0 +1,264 @@
+"""
+Camino por columnas de la normalización de lecturas (NumPy). Vive en su propio
+módulo para que el arranque de las funciones no pague la importación de NumPy.
+"""
+from datetime import datetime
+
+import numpy as np
+
+import instrumentation as log
+from sensor_normalization import SANTIAGO_TZ, extract_items, normalize_metric_name, reading_id
+
+_EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
+
+def _transition_table(tz):
+    """Instantes UTC (segundos epoch) de cada cambio de huso de `tz` y su desfase en segundos."""
+    times = np.array(
+        [(dt.toordinal() - _EPOCH_ORDINAL) * 86400 + dt.hour * 3600 + dt.minute * 60 + dt.second
+         for dt in tz._utc_transition_times],
+        dtype=np.int64,
+    )
+    offsets = np.array([int(info[0].total_seconds()) for info in tz._transition_info], dtype=np.int64)
+    return times, offsets
+
+
+_TRANSITION_TIMES, _TRANSITION_OFFSETS = _transition_table(SANTIAGO_TZ)
+
+_DIGIT_POSITIONS = np.array([0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18])
+_DAYS_IN_MONTH = np.array([0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31], dtype=np.int64)
+
+
+def _days_from_civil(y, m, d):
+    # Algoritmo de H. Hinnant: días desde 1970-01-01 para fechas del calendario gregoriano.
+    y = y - (m <= 2)
+    era = np.floor_divide(y, 400)
+    yoe = y - era * 400
+    doy = (153 * (m + np.where(m > 2, -3, 9)) + 2) // 5 + d - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def _civil_from_days(z):
+    z = z + 719468
+    era = np.floor_divide(z, 146097)
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    d = doy - (153 * mp + 2) // 5 + 1
+    m = mp + np.where(mp < 10, 3, -9)
+    y = yoe + era * 400 + (m <= 2)
+    return y, m, d
+
+
+def _digits(matrix, start, count):
+    value = np.zeros(matrix.shape[0], dtype=np.int64)
+    for i in range(start, start + count):
+        value = value * 10 + (matrix[:, i].astype(np.int64) - 48)
+    return value
+
+
+def _offset_suffix(offset):
+    sign = "+" if offset >= 0 else "-"
+    hh, rest = divmod(abs(int(offset)), 3600)
+    mm, ss = divmod(rest, 60)
+    return f"{sign}{hh:02d}:{mm:02d}" + (f":{ss:02d}" if ss else "")
+
+
+def _parse_fast_timestamps(strings):
+    """
+    Convierte a segundos epoch UTC los timestamps con forma 'YYYY-MM-DDTHH:MM:SSZ'
+    o 'YYYY-MM-DDTHH:MM:SS±HH:MM'. Devuelve (epoch, ok); las posiciones con ok=False
+    deben resolverse con datetime.fromisoformat.
+    """
+    n = len(strings)
+    raw = np.array([s.encode("ascii") if len(s) in (20, 25) and s.isascii() else b"" for s in strings], dtype="S25")
+    m = raw.view(np.uint8).reshape(n, 25)
+    lengths = np.char.str_len(raw)
+
+    digit_cols = m[:, _DIGIT_POSITIONS]
+    ok = np.all((digit_cols >= 48) & (digit_cols <= 57), axis=1)
+    ok &= (m[:, 4] == ord("-")) & (m[:, 7] == ord("-")) & (m[:, 10] == ord("T"))
+    ok &= (m[:, 13] == ord(":")) & (m[:, 16] == ord(":"))
+
+    zulu = ok & (lengths == 20) & (m[:, 19] == ord("Z"))
+    tz_digits = m[:, [20, 21, 23, 24]]
+    with_offset = ok & (lengths == 25) & ((m[:, 19] == ord("+")) | (m[:, 19] == ord("-"))) & (m[:, 22] == ord(":"))
+    with_offset &= np.all((tz_digits >= 48) & (tz_digits <= 57), axis=1)
+    ok = zulu | with_offset
+
+    year, month, day = _digits(m, 0, 4), _digits(m, 5, 2), _digits(m, 8, 2)
+    hour, minute, second = _digits(m, 11, 2), _digits(m, 14, 2), _digits(m, 17, 2)
+    off_h, off_m = _digits(m, 20, 2), _digits(m, 23, 2)
+
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    month_days = _DAYS_IN_MONTH[np.clip(month, 0, 12)] + ((month == 2) & leap)
+    # Años extremos se dejan al camino por item (pueden salir de rango al cambiar de huso).
+    ok &= (year > 1) & (year < 9999) & (month >= 1) & (month <= 12) & (day >= 1) & (day <= month_days)
+    ok &= (hour < 24) & (minute < 60) & (second < 60) & (off_h < 24) & (off_m < 60)
+
+    offset = np.where(with_offset, (off_h * 3600 + off_m * 60) * np.where(m[:, 19] == ord("-"), -1, 1), 0)
+    epoch = _days_from_civil(year, month, day) * 86400 + hour * 3600 + minute * 60 + second - offset
+    return epoch, ok
+
+
+def _format_local(epoch):
+    """Formatea segundos epoch UTC como isoformat() en hora de Santiago (igual que pytz)."""
+    idx = np.maximum(np.searchsorted(_TRANSITION_TIMES, epoch, side="right") - 1, 0)
+    offsets = _TRANSITION_OFFSETS[idx]
+    local = epoch + offsets
+
+    days, secs = np.divmod(local, 86400)
+    year, month, day = _civil_from_days(days)
+    fields = [(year, 4), (month, 2), (day, 2), (secs // 3600, 2), (secs // 60 % 60, 2), (secs % 60, 2)]
+
+    out = np.empty((len(epoch), 19), dtype=np.uint8)
+    out[:, [4, 7]] = ord("-")
+    out[:, 10] = ord("T")
+    out[:, [13, 16]] = ord(":")
+    col = 0
+    for value, width in fields:
+        for i in range(width):
+            out[:, col + width - 1 - i] = 48 + (value // 10 ** i) % 10
+        col += width + 1
+    base = out.view("S19").ravel().astype("U19")
+
+    unique_offsets, inverse = np.unique(offsets, return_inverse=True)
+    suffixes = np.array([_offset_suffix(o) for o in unique_offsets])
+    return np.char.add(base, suffixes[inverse])
+
+
+def _round_1(values):
+    """round(v, 1) de Python sobre un array, corrigiendo los casos cercanos a .x5."""
+    scaled = values * 10.0
+    rounded = np.rint(scaled) / 10.0
+    frac = np.abs(scaled - np.floor(scaled) - 0.5)
+    # Cerca del empate el producto por 10 puede cambiar el sentido del redondeo,
+    # así que esos valores (y los no finitos o muy grandes) se redondean con Python.
+    slow = ~np.isfinite(scaled) | (np.abs(scaled) > 1e9) | (frac < 1e-6)
+    for i in np.flatnonzero(slow):
+        rounded[i] = round(float(values[i]), 1)
+    return rounded
+
+
+class ReadingColumns:
+    """
+    Acumula items de uno o varios documentos en columnas y los normaliza de una
+    sola vez con NumPy. Produce exactamente las mismas filas que `normalize_items`
+    (salvo la hora actual usada cuando falta el timestamp, y el ID que se deriva de ella).
+    """
+
+    def __init__(self, default_device_id=None):
+        self.default_device_id = default_device_id
+        self.device_ids = []
+        self.names = []
+        self.values = []
+        self.timestamps = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def add_items(self, device_id, items, event_timestamp_str):
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            self.device_ids.append(device_id)
+            self.names.append(item.get("name"))
+            self.values.append(item.get("value"))
+            self.timestamps.append(item.get("updated_at") or event_timestamp_str)
+
+    def add_document(self, data):
+        """Agrega los items de un documento; devuelve False si el formato no es reconocido."""
+        extracted = extract_items(data, self.default_device_id)
+        if extracted is None:
+            return False
+        self.add_items(*extracted)
+        return True
+
+    def clear(self):
+        self.device_ids, self.names, self.values, self.timestamps = [], [], [], []
+
+    def normalize(self):
+        """Devuelve las filas válidas, en el mismo orden en que se agregaron los items."""
+        n = len(self.names)
+        if n == 0:
+            return []
+
+        valid = np.fromiter(
+            (name is not None and value is not None and isinstance(value, (int, float))
+             for name, value in zip(self.names, self.values)),
+            dtype=bool, count=n,
+        )
+        skipped = n - int(valid.sum())
+        if skipped:
+            log.warning("Items incompletos o inválidos omitidos.", sampled=True, skipped=skipped)
+        keep = np.flatnonzero(valid)
+        if keep.size == 0:
+            return []
+
+        values = np.array([float(self.values[i]) for i in keep], dtype=np.float64)
+        rounded = _round_1(values).tolist()
+
+        metric_types = [normalize_metric_name(self.names[i]) for i in keep]
+
+        timestamps = self._normalize_timestamps([self.timestamps[i] for i in keep])
+        device_ids = [self.device_ids[i] for i in keep]
+        row_ids = [reading_id(*key) for key in zip(device_ids, metric_types, timestamps)]
+
+        return [
+            {
+                "sensor_reading_id": row_id,
+                "device_id": device_id,
+                "timestamp": timestamp,
+                "metric_type": metric_type,
+                "value": value,
+            }
+            for row_id, device_id, timestamp, metric_type, value
+            in zip(row_ids, device_ids, timestamps, metric_types, rounded)
+        ]
+
+    def _normalize_timestamps(self, raw):
+        n = len(raw)
+        result = [None] * n
+        present = [i for i, s in enumerate(raw) if s]
+        missing = n - len(present)
+
+        fast_ok = np.zeros(0, dtype=bool)
+        if present:
+            strings = [raw[i] if isinstance(raw[i], str) else "" for i in present]
+            epoch, fast_ok = _parse_fast_timestamps(strings)
+            fast_idx = np.flatnonzero(fast_ok)
+            if fast_idx.size:
+                formatted = _format_local(epoch[fast_idx]).tolist()
+                for j, value in zip(fast_idx.tolist(), formatted):
+                    result[present[j]] = value
+
+        now = None
+        invalid = 0
+        slow = [present[j] for j in np.flatnonzero(~fast_ok).tolist()]
+        for i in slow:
+            try:
+                dt_utc = datetime.fromisoformat(raw[i].replace('Z', '+00:00'))
+                result[i] = dt_utc.astimezone(SANTIAGO_TZ).isoformat()
+            except ValueError:
+                invalid += 1
+
+        if invalid or missing:
+            now = datetime.now(SANTIAGO_TZ).isoformat()
+            log.warning("Timestamps inválidos o ausentes. Usando tiempo actual de Santiago.", sampled=True, invalid=invalid, missing=missing)
+            result = [now if value is None else value for value in result]
+        return result
+
+
+def normalize_documents(documents, default_device_id=None):
+    """
+    Normaliza por columnas todos los items de una lista de documentos.
+    Devuelve (filas, documentos_omitidos).
+    """
+    columns = ReadingColumns(default_device_id)
+    skipped = 0
+    for data in documents:
+        if not columns.add_document(data):
+            skipped += 1
+    return columns.normalize(), skipped
@@ -0,0 +1,119 @@
+import hashlib
+import os
+from datetime import datetime
+
+from pytz import timezone as pytz_timezone
+
+import instrumentation as log
+
+SANTIAGO_TZ = pytz_timezone('America/Santiago')
+
+# Nombres de las variables del firmware y su nombre en la tabla sensor_readings.
+METRIC_NAME_MAP = {
+    "dht22_temperatura": "temperature",
+    "dht22_humedad": "humidity",
+}
+
+
+
+def normalize_metric_name(name):
+    """
+    Nombre de métrica tal como se guarda: el de la tabla si es una variable del
+    firmware y siempre en minúsculas, así las consultas filtran metric_type sin
+    LOWER() y BigQuery puede podar por el clustering (device_id, metric_type).
+    """
+    if not isinstance(name, str):
+        return name
+    return METRIC_NAME_MAP.get(name, name).strip().lower()
+
+
+def reading_id(device_id, metric_type, timestamp):
+    """
+    ID de una lectura derivado de (dispositivo, métrica, timestamp normalizado):
+    si el dispositivo o el cliente HTTP reintentan el envío, la lectura repetida
+    tiene el mismo ID y se descarta (ingest_dedup y los IDs de inserción de BigQuery).
+    """
+    key = f"{device_id}\x1f{metric_type}\x1f{timestamp}".encode("utf-8")
+    return hashlib.blake2b(key, digest_size=16).hexdigest()
+
+
+# A partir de este número de items un documento se normaliza por columnas
+# (sensor_columnar, que importa NumPy solo cuando hace falta).
+VECTORIZE_MIN_ITEMS = int(os.environ.get("VECTORIZE_MIN_ITEMS", "256"))
+
+
+def extract_items(data, default_device_id=None):
+    """
+    Devuelve (device_id, items, event_timestamp_str) para un documento de un dispositivo.
+
+    Acepta el formato con array `values` ({device_id, values: [{name, value, updated_at}]})
+    y la lectura plana que envía el firmware ({device_id, metric_type, value, timestamp}).
+    Devuelve None si el documento no tiene ninguno de los dos formatos.
+    """
+    device_id = data.get("device_id") or data.get("thing_id", default_device_id)
+    event_timestamp_str = data.get("timestamp") or data.get("event_timestamp")
+
+    if "values" in data and isinstance(data["values"], list):
+        items = data["values"]
+    elif "metric_type" in data:
+        items = [{"name": data.get("metric_type"), "value": data.get("value")}]
+    else:
+        return None
+    return device_id, items, event_timestamp_str
+
+
+# --- Camino por item ---
+
+def normalize_item(device_id, item, event_timestamp_str):
+    """Convierte un item {name, value, updated_at} en una fila de sensor_readings, o None si es inválido."""
+    metric_type = item.get("name")
+    metric_value = item.get("value")
+
+    item_timestamp_str = item.get("updated_at") or event_timestamp_str
+
+    final_timestamp_for_bq = None
+    if item_timestamp_str:
+        try:
+            dt_utc = datetime.fromisoformat(item_timestamp_str.replace('Z', '+00:00'))
+
+            dt_santiago = dt_utc.astimezone(SANTIAGO_TZ)
+
+            final_timestamp_for_bq = dt_santiago.isoformat()
+
+        except ValueError:
+            log.warning("Timestamp no es ISO 8601 válido. Usando tiempo actual de Santiago.", sampled=True, timestamp=item_timestamp_str)
+            final_timestamp_for_bq = datetime.now(SANTIAGO_TZ).isoformat()
+    else:
+        log.warning("No se encontró timestamp en el payload. Usando tiempo actual de Santiago.", sampled=True)
+        final_timestamp_for_bq = datetime.now(SANTIAGO_TZ).isoformat()
+
+    log.debug("Procesando item.", name=metric_type, value=metric_value, timestamp=final_timestamp_for_bq)
+
+    if metric_type is None or metric_value is None or not isinstance(metric_value, (int, float)):
+        log.warning("Item incompleto o inválido, omitiendo.", sampled=True, item=item)
+        return None
+
+    bq_metric_type = normalize_metric_name(metric_type)
+
+    formatted_value = round(float(metric_value), 1)
+
+    return {
+        "sensor_reading_id": reading_id(device_id, bq_metric_type, final_timestamp_for_bq),
+        "device_id": device_id,
+        "timestamp": final_timestamp_for_bq, # Usar el timestamp de Santiago
+        "metric_type": bq_metric_type,
+        "value": formatted_value
+    }
+
+
+def normalize_items(device_id, items, event_timestamp_str):
+    """Normaliza los items de un documento uno a uno (camino original)."""
+    rows = []
+    for item in items:
+        if not isinstance(item, dict):
+            log.warning("Item incompleto o inválido, omitiendo.", sampled=True, item=item)
+            continue
+        row = normalize_item(device_id, item, event_timestamp_str)
+        if row is not None:
+            rows.append(row)
+    return rows
@@ -1,22 +1,27 @@
-import os
 import json
-from google.cloud import bigquery
+import os
 import functions_framework
+import instrumentation as log
+# El cliente de BigQuery y la configuración se comparten entre funciones (backend_core).
+from backend_core import warm_up
+from device_state_store import get_device_state_store
+from instrumentation import instrumented, stage
 
-# --- Configuración ---
-# El project ID se obtiene automáticamente del entorno de ejecución de GCP.
-PROJECT_ID = os.environ.get("GCP_PROJECT", "iot-growing-app")
-DATASET_ID = os.environ.get("GCP_DATASET", "growing-app-bd")
-DEVICES_TABLE_ID = "devices"
+CONTROL_MODES = ('AUTOMATICO', 'MANUAL')
+# Tope de dispositivos por petición masiva.
+BULK_MAX_DEVICES = int(os.environ.get("BULK_MAX_DEVICES", "500"))
 
-# Se inicializa el cliente de BigQuery una sola vez de forma global.
-client = bigquery.Client()
+# Se prepara el cliente en segundo plano para no retrasar la primera solicitud.
+warm_up()
 
 @functions_framework.http
+@instrumented("set_control_mode")
 def set_control_mode(request):
     """
     Función HTTP de Cloud Functions para actualizar el modo de control de un dispositivo.
     Responde a solicitudes POST con un cuerpo JSON.
+    También acepta varios dispositivos a la vez ("device_ids" o "devices", ver parse_bulk_modes);
+    responde un resultado por dispositivo y 207 si algunos no existen.
     """
     # --- Manejo de CORS (Cross-Origin Resource Sharing) ---
     # Estas cabeceras son necesarias para permitir que tu app Flutter (que se ejecuta
@@ -43,6 +48,8 @@ def set_control_mode(request):
 
     try:
         data = request.get_json(silent=True)
+        if isinstance(data, dict) and ('device_ids' in data or 'devices' in data):
+            return _set_control_modes(data, headers)
         if not data or 'device_id' not in data or 'control_mode' not in data:
             response_data = {'status': 'error', 'message': 'Faltan "device_id" o "control_mode" en el cuerpo de la solicitud.'}
             return (json.dumps(response_data), 400, headers)
@@ -50,37 +57,81 @@ def set_control_mode(request):
         device_id = data['device_id']
         mode = data['control_mode']
 
-        if mode not in ['AUTOMATICO', 'MANUAL']:
+        if mode not in CONTROL_MODES:
             response_data = {'status': 'error', 'message': 'El valor de "control_mode" debe ser "AUTOMATICO" o "MANUAL".'}
             return (json.dumps(response_data), 400, headers)
 
-        print(f"Actualizando modo para el dispositivo {device_id} a '{mode}'")
-
-        # Se construye y ejecuta la consulta para actualizar el modo en BigQuery.
-        update_query = f"""
-            UPDATE `{PROJECT_ID}.{DATASET_ID}.{DEVICES_TABLE_ID}`
-            SET control_mode = @mode
-            WHERE device_id = @device_id
-        """
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[
-                bigquery.ScalarQueryParameter("mode", "STRING", mode),
-                bigquery.ScalarQueryParameter("device_id", "STRING", device_id),
-            ]
-        )
-        query_job = client.query(update_query, job_config=job_config)
-        query_job.result()  # Se espera a que la consulta termine.
-
-        if query_job.num_dml_affected_rows > 0:
-            print(f"Éxito: {query_job.num_dml_affected_rows} fila(s) actualizada(s).")
-            response_data = {'status': 'success', 'message': f'Modo actualizado a {mode}'}
+        # Se registra el cambio en DEVICE_STATE_LOG y en el almacén de estados.
+        with stage("storage"):
+            device_state = get_device_state_store().set_control_mode(device_id, mode)
+
+        if device_state is not None:
+            log.info("Modo del dispositivo actualizado.", device_id=device_id, control_mode=mode, version=device_state.version)
+            response_data = {'status': 'success', 'message': f'Modo actualizado a {mode}', 'version': device_state.version}
+            headers['ETag'] = device_state.etag
             return (json.dumps(response_data), 200, headers)
         else:
-            print(f"Advertencia: No se encontró ningún dispositivo con el ID {device_id} para actualizar.")
+            log.warning("No se encontró el dispositivo a actualizar.", device_id=device_id)
             response_data = {'status': 'error', 'message': 'Dispositivo no encontrado.'}
             return (json.dumps(response_data), 404, headers)
 
     except Exception as e:
-        print(f"Error inesperado: {e}")
+        log.error("Error inesperado.", error=str(e))
         response_data = {'status': 'error', 'message': 'Error interno del servidor.'}
-        return (json.dumps(response_data), 500, headers)
\ No newline at end of file
+        return (json.dumps(response_data), 500, headers)
+
+
+def parse_bulk_modes(data):
+    """
+    Devuelve ({device_id: modo}, error) para el cuerpo masivo:
+    {"device_ids": [...], "control_mode": "..."} o {"devices": [{"device_id", "control_mode"}, ...]}.
+    """
+    if 'device_ids' in data:
+        device_ids = data['device_ids']
+        if not isinstance(device_ids, list) or not device_ids or 'control_mode' not in data:
+            return None, 'Se requiere "device_ids" (lista no vacía) y "control_mode".'
+        entries = [{'device_id': device_id, 'control_mode': data['control_mode']} for device_id in device_ids]
+    else:
+        entries = data['devices']
+        if not isinstance(entries, list) or not entries:
+            return None, 'Se requiere "devices" (lista no vacía).'
+    if len(entries) > BULK_MAX_DEVICES:
+        return None, f'Se permiten a lo más {BULK_MAX_DEVICES} dispositivos por petición.'
+
+    modes = {}
+    for i, entry in enumerate(entries):
+        if not isinstance(entry, dict) or not entry.get('device_id'):
+            return None, f'El elemento {i} debe tener "device_id".'
+        if entry.get('control_mode') not in CONTROL_MODES:
+            return None, 'El valor de "control_mode" debe ser "AUTOMATICO" o "MANUAL".'
+        modes[entry['device_id']] = entry['control_mode']
+    return modes, None
+
+
+def _set_control_modes(data, headers):
+    modes, error = parse_bulk_modes(data)
+    if error:
+        return (json.dumps({'status': 'error', 'message': error}), 400, headers)
+
+    log.info("Actualizando el modo de varios dispositivos.", devices=len(modes))
+    # Todos los cambios van en un solo lote del registro.
+    with stage("storage"):
+        states = get_device_state_store().set_control_modes(modes)
+
+    results = []
+    for device_id, mode in modes.items():
+        state = states[device_id]
+        if state is None:
+            results.append({'device_id': device_id, 'status': 'error', 'message': 'Dispositivo no encontrado.'})
+        else:
+            results.append({'device_id': device_id, 'status': 'success', 'control_mode': mode, 'version': state.version})
+
+    updated = sum(1 for r in results if r['status'] == 'success')
+    if updated == len(results):
+        status, code = 'success', 200
+    elif updated:
+        status, code = 'partial', 207
+    else:
+        status, code = 'error', 404
+    response_data = {'status': status, 'updated': updated, 'not_found': len(results) - updated, 'results': results}
+    return (json.dumps(response_data), code, headers)
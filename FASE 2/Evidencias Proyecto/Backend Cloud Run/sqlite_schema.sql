@@ -0,0 +1,146 @@
+-- Esquema SQLite del backend embebido (STORAGE_BACKEND=sqlite, ver storage.py).
+-- Refleja "BD Bigquery/bd.sql" con los nombres de tabla por defecto de backend_core
+-- y las columnas que ya leen los handlers. Equivalencias de tipos:
+--   STRING/GEOGRAPHY -> TEXT, INT64 -> INTEGER, FLOAT64 -> REAL,
+--   STRUCT -> TEXT (JSON), BOOLEAN -> BOOLEAN (0/1),
+--   TIMESTAMP -> TIMESTAMP (texto UTC 'YYYY-MM-DDTHH:MM:SS.ffffffZ', comparable como texto).
+-- Las claves foráneas se declaran como en BigQuery, donde no se hacen cumplir
+-- (storage.py deja PRAGMA foreign_keys desactivado).
+
+CREATE TABLE IF NOT EXISTS users (
+  user_id TEXT NOT NULL PRIMARY KEY,
+  name TEXT,
+  email TEXT,
+  sensor_assigned TEXT,
+  phone TEXT,
+  farm_assigned TEXT,
+  is_active BOOLEAN
+);
+
+CREATE TABLE IF NOT EXISTS farms (
+  farm_id TEXT NOT NULL PRIMARY KEY,
+  name TEXT,
+  location TEXT,
+  user_id TEXT REFERENCES users (user_id),
+  -- Columnas que usan create_farm y list_user_farms.
+  user_uid TEXT,
+  farm_name TEXT,
+  image_url TEXT,
+  description TEXT,
+  status BOOLEAN
+);
+
+CREATE TABLE IF NOT EXISTS crops (
+  crop_id TEXT NOT NULL PRIMARY KEY,
+  name TEXT,
+  map_px INTEGER,
+  map_py INTEGER,
+  climate_zone TEXT,
+  optimal_temp_min REAL,
+  optimal_temp_max REAL,
+  optimal_hum_min REAL,
+  optimal_hum_max REAL,
+  critical_temp_min REAL,
+  critical_temp_max REAL,
+  critical_hum_min REAL,
+  critical_hum_max REAL,
+  farm_id TEXT REFERENCES farms (farm_id),
+  -- Columnas que usa get_farm_crops.
+  crop_name TEXT,
+  image_url TEXT,
+  status BOOLEAN
+);
+
+CREATE TABLE IF NOT EXISTS devices (
+  device_id TEXT NOT NULL PRIMARY KEY,
+  crop_id TEXT REFERENCES crops (crop_id),
+  arduino_thing_id TEXT,
+  arduino_property_id TEXT,
+  state BOOLEAN,
+  control_mode TEXT,
+  -- Columna que usa get_device_crops.
+  device_name TEXT
+);
+
+CREATE TABLE IF NOT EXISTS sensor_readings (
+  sensor_reading_id TEXT NOT NULL PRIMARY KEY,
+  metric_type TEXT,
+  value REAL,
+  timestamp TIMESTAMP,
+  device_id TEXT REFERENCES devices (device_id)
+);
+CREATE INDEX IF NOT EXISTS idx_sensor_readings_device_ts ON sensor_readings (device_id, timestamp);
+-- Equivalente al clustering (device_id, metric_type) de BigQuery.
+CREATE INDEX IF NOT EXISTS idx_sensor_readings_device_metric_ts ON sensor_readings (device_id, metric_type, timestamp);
+
+CREATE TABLE IF NOT EXISTS sensor_readings_1m (
+  device_id TEXT NOT NULL,
+  metric_type TEXT NOT NULL,
+  bucket_start TIMESTAMP NOT NULL,
+  count INTEGER,
+  sum REAL,
+  min REAL,
+  max REAL,
+  inserted_at TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_sensor_readings_1m_device_ts ON sensor_readings_1m (device_id, bucket_start);
+
+CREATE TABLE IF NOT EXISTS sensor_readings_1h (
+  device_id TEXT NOT NULL,
+  metric_type TEXT NOT NULL,
+  bucket_start TIMESTAMP NOT NULL,
+  count INTEGER,
+  sum REAL,
+  min REAL,
+  max REAL,
+  inserted_at TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_sensor_readings_1h_device_ts ON sensor_readings_1h (device_id, bucket_start);
+
+CREATE TABLE IF NOT EXISTS sensor_rollup_coverage (
+  level TEXT NOT NULL,
+  covered_from TIMESTAMP NOT NULL,
+  recorded_at TIMESTAMP NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS actuator_actions (
+  actuator_action_id TEXT NOT NULL PRIMARY KEY,
+  action BOOLEAN,
+  timestamp TIMESTAMP,
+  device_id TEXT REFERENCES devices (device_id)
+);
+CREATE INDEX IF NOT EXISTS idx_actuator_actions_device_ts ON actuator_actions (device_id, timestamp);
+
+CREATE TABLE IF NOT EXISTS device_state_log (
+  change_id TEXT NOT NULL PRIMARY KEY,
+  device_id TEXT NOT NULL REFERENCES devices (device_id),
+  relay_state BOOLEAN,
+  control_mode TEXT,
+  changed_at TIMESTAMP NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_device_state_log_device_ts ON device_state_log (device_id, changed_at);
+
+CREATE TABLE IF NOT EXISTS ai_recommendations (
+  ai_recommendation_id TEXT NOT NULL PRIMARY KEY,
+  recommendation TEXT,
+  timestamp TIMESTAMP,
+  climate_zone TEXT,
+  crop_id TEXT REFERENCES crops (crop_id)
+);
+
+CREATE TABLE IF NOT EXISTS alerts (
+  alert_id TEXT NOT NULL PRIMARY KEY,
+  created_at TIMESTAMP,
+  activation_time TIMESTAMP,
+  description TEXT,
+  crop_id TEXT REFERENCES crops (crop_id)
+);
+
+CREATE TABLE IF NOT EXISTS scheduled_actions (
+  scheduled_id TEXT NOT NULL PRIMARY KEY,
+  created_at TIMESTAMP,
+  activation_time TIMESTAMP,
+  device_id TEXT REFERENCES devices (device_id),
+  action BOOLEAN,
+  crop_id TEXT REFERENCES crops (crop_id)
+);
@@ -0,0 +1,93 @@
+"""
+Perfil de arranque de las funciones: mide cuánto tarda en importarse cada
+handler (en un proceso nuevo, como en un arranque en frío) y qué módulos pesan más.
+
+Uso:
+    python startup_profile.py                       # todas las funciones
+    python startup_profile.py get_device_state --top 20
+    python startup_profile.py --budget-ms           # sale con código 1 si alguna supera IMPORT_BUDGET_MS
+    python startup_profile.py --budget-ms 400
+
+El modo --budget-ms sirve como control de regresión en CI: falla si algún
+handler vuelve a importar algo pesado (p. ej. google.cloud.bigquery) al arrancar.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+HANDLER_MODULES = [
+    "compact_device_state_log",
+    "compact_sensor_readings",
+    "create_farm",
+    "get_dashboard",
+    "get_arduino_data",
+    "get_device_crops",
+    "get_device_state",
+    "get_farm_crops",
+    "get_latest_readings",
+    "list_sensor_readings",
+    "list_user_farms",
+    "send_bool_acloud",
+    "send_bulk_relay_commands",
+    "set_control_mode",
+    "temperature_controller",
+    "watch_device_state",
+]
+
+IMPORT_BUDGET_MS = float(os.environ.get("IMPORT_BUDGET_MS", "450"))
+
+
+def profile_import(module):
+    """
+    Importa `module` en un subproceso con -X importtime.
+    Devuelve (total_ms, [(nombre, propio_ms, acumulado_ms), ...]).
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, WARMUP_ON_IMPORT="false", PYTHONDONTWRITEBYTECODE="1")
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=here, env=env, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"No se pudo importar {module}:\n{proc.stderr[-2000:]}")
+
+    entries = []
+    total_ms = None
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        name_stripped = name.strip()
+        entries.append((name_stripped, int(self_us) / 1000.0, int(cumulative_us) / 1000.0))
+        if name_stripped == module and not name[1:].startswith(" "):
+            total_ms = int(cumulative_us) / 1000.0
+    return total_ms, entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("modules", nargs="*", default=HANDLER_MODULES, help="Handlers a medir (por defecto, todos).")
+    parser.add_argument("--top", type=int, default=10, help="Cantidad de módulos más pesados a mostrar por handler.")
+    parser.add_argument("--budget-ms", type=float, nargs="?", const=IMPORT_BUDGET_MS, default=None,
+                        help=f"Falla si algún handler supera este tiempo de importación (sin valor: IMPORT_BUDGET_MS={IMPORT_BUDGET_MS:.0f}).")
+    args = parser.parse_args()
+
+    over_budget = []
+    for module in args.modules:
+        total_ms, entries = profile_import(module)
+        print(f"\n{module}: {total_ms:.1f} ms")
+        for name, self_ms, cumulative_ms in sorted(entries, key=lambda e: e[1], reverse=True)[:args.top]:
+            print(f"  {self_ms:8.1f} ms propio  {cumulative_ms:8.1f} ms acumulado  {name}")
+        if args.budget_ms is not None and total_ms > args.budget_ms:
+            over_budget.append((module, total_ms))
+
+    if over_budget:
+        print(f"\nHandlers sobre el presupuesto de {args.budget_ms:.0f} ms:")
+        for module, total_ms in over_budget:
+            print(f"  {module}: {total_ms:.1f} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
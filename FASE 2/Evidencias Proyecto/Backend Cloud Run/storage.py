@@ -0,0 +1,575 @@
+"""
+Capa de almacenamiento bajo los handlers, elegida con STORAGE_BACKEND:
+
+- "bigquery" (por defecto): Cloud Run con BigQuery.
+- "sqlite": base embebida en disco para gateways en terreno, con enlace
+  intermitente. Modo WAL, índices por (device_id, timestamp) y cada lote de
+  filas en una sola transacción. El esquema está en sqlite_schema.sql.
+
+Los handlers siguen escribiendo SQL de BigQuery a través de backend_core.run_query,
+table_ref e insert_rows; SQLiteStorage traduce el subconjunto que usa este
+repositorio (parámetros @nombre, IN UNNEST, INTERVAL, ARRAY_AGG de la última fila,
+IF) y registra como funciones de SQLite las de fecha de BigQuery (UNIX_SECONDS,
+TIMESTAMP_SUB, FORMAT_TIMESTAMP, ...). Las consultas que no tienen traducción
+(MERGE, scripts) consultan `get_storage().dialect` y usan su propia variante.
+
+Costo en BigQuery: cada trabajo lleva maximum_bytes_billed = QUERY_BYTES_BUDGET
+(BigQuery lo rechaza sin cobrar si lo supera) y, al leer su resultado, se suman
+sus bytes procesados y facturados y su tiempo de slots a las métricas del
+handler en curso. Con QUERY_DRY_RUN_CHECK cada consulta se estima antes en seco
+y se rechaza con QueryBudgetExceeded si excede el presupuesto.
+
+Inserciones con IDs (insert_rows con `row_ids`): en BigQuery son los IDs de
+inserción, que descartan las filas repetidas por unos minutos; en SQLite la
+clave primaria cumple ese papel (INSERT OR IGNORE). Como reenviar es seguro, los
+errores transitorios se reintentan con espera exponencial.
+"""
+import functools
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import instrumentation as log
+from backend_core import bigquery_module, get_bq_client, load_config
+
+# --- Configuración ---
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "bigquery").lower()
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "growing_app.db")
+SQLITE_SCHEMA_PATH = os.environ.get(
+    "SQLITE_SCHEMA_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "sqlite_schema.sql")
+)
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+# Filas por página al recorrer un resultado de SQLite (como las páginas de BigQuery).
+SQLITE_PAGE_ROWS = int(os.environ.get("SQLITE_PAGE_ROWS", "1000"))
+# Bytes facturados como máximo por consulta de BigQuery (0 = sin límite). 1 GiB por defecto.
+QUERY_BYTES_BUDGET = int(os.environ.get("QUERY_BYTES_BUDGET", str(1 << 30)))
+# Estimar cada consulta con un dry run antes de lanzarla; la estimación de cada
+# (SQL, parámetros) se reutiliza durante QUERY_DRY_RUN_TTL_S.
+QUERY_DRY_RUN_CHECK = os.environ.get("QUERY_DRY_RUN_CHECK", "false").lower() == "true"
+QUERY_DRY_RUN_TTL_S = float(os.environ.get("QUERY_DRY_RUN_TTL_S", "300"))
+
+# Intentos de una inserción con IDs ante errores transitorios y espera entre ellos
+# (exponencial desde INSERT_RETRY_BASE_S, con variación aleatoria, hasta INSERT_RETRY_MAX_S).
+INSERT_MAX_ATTEMPTS = int(os.environ.get("INSERT_MAX_ATTEMPTS", "5"))
+INSERT_RETRY_BASE_S = float(os.environ.get("INSERT_RETRY_BASE_S", "0.2"))
+INSERT_RETRY_MAX_S = float(os.environ.get("INSERT_RETRY_MAX_S", "5"))
+# Motivos de error por fila de insert_rows_json que se pueden reintentar
+# ('stopped': la fila no se insertó porque otra del mismo lote era inválida).
+TRANSIENT_ROW_REASONS = {"backendError", "internalError", "rateLimitExceeded", "timeout", "stopped"}
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+INSERT_RETRIES = log.counter(
+    "growingapp_insert_retries_total", "Filas reenviadas tras un error transitorio, por tabla.", ("table",))
+QUERY_BYTES = log.counter(
+    "growingapp_bigquery_bytes_processed_total", "Bytes procesados por las consultas de BigQuery.", ("handler",))
+QUERY_BYTES_BILLED = log.counter(
+    "growingapp_bigquery_bytes_billed_total", "Bytes facturados por las consultas de BigQuery.", ("handler",))
+QUERY_SLOT_MS = log.counter(
+    "growingapp_bigquery_slot_ms_total", "Tiempo de slots (ms) de las consultas de BigQuery.", ("handler",))
+QUERY_JOBS = log.counter(
+    "growingapp_bigquery_jobs_total", "Consultas de BigQuery por resultado (ok, rejected).", ("handler", "outcome"))
+
+
+class QueryBudgetExceeded(Exception):
+    """La estimación en seco de una consulta supera el presupuesto de bytes."""
+
+    def __init__(self, estimated_bytes, budget):
+        super().__init__(f"La consulta procesaría {estimated_bytes} bytes (presupuesto: {budget}).")
+        self.estimated_bytes = estimated_bytes
+        self.budget = budget
+
+
+def _budget_of(bytes_budget):
+    # None = presupuesto por defecto; 0 = sin límite.
+    return QUERY_BYTES_BUDGET if bytes_budget is None else bytes_budget
+
+
+class _TrackedJob:
+    """
+    QueryJob de BigQuery que, la primera vez que se lee su resultado, registra
+    sus bytes y su tiempo de slots para el handler que lanzó la consulta.
+    El resto de atributos son los del trabajo original.
+    """
+
+    def __init__(self, job, handler):
+        self._job = job
+        self._handler = handler
+        self._recorded = False
+
+    def result(self, *args, **kwargs):
+        result = self._job.result(*args, **kwargs)
+        self._record()
+        return result
+
+    def __iter__(self):
+        return iter(self.result())
+
+    def __getattr__(self, name):
+        return getattr(self._job, name)
+
+    def _record(self):
+        if self._recorded:
+            return
+        self._recorded = True
+        job = self._job
+        processed = job.total_bytes_processed or 0
+        billed = job.total_bytes_billed or 0
+        slot_ms = job.slot_millis or 0
+        QUERY_BYTES.inc(self._handler, amount=processed)
+        QUERY_BYTES_BILLED.inc(self._handler, amount=billed)
+        QUERY_SLOT_MS.inc(self._handler, amount=slot_ms)
+        QUERY_JOBS.inc(self._handler, "ok")
+        log.info("Consulta de BigQuery terminada.", sampled=True, job_id=job.job_id,
+                 bytes_processed=processed, bytes_billed=billed, slot_ms=slot_ms,
+                 cache_hit=job.cache_hit)
+
+
+class BigQueryStorage:
+    """Backend de BigQuery (cliente compartido de backend_core)."""
+
+    dialect = "bigquery"
+
+    def table_id(self, table_name):
+        config = load_config()
+        return f"{config.project_id}.{config.dataset_id}.{table_name}"
+
+    def table_ref(self, table_name):
+        return f"`{self.table_id(table_name)}`"
+
+    def __init__(self):
+        self._estimates = {}
+        self._estimates_lock = threading.Lock()
+
+    def _job_config(self, params, **kwargs):
+        bigquery = bigquery_module()
+        query_parameters = []
+        for name, type_, value in params or []:
+            if isinstance(value, (list, tuple)):
+                query_parameters.append(bigquery.ArrayQueryParameter(name, type_, list(value)))
+            else:
+                query_parameters.append(bigquery.ScalarQueryParameter(name, type_, value))
+        return bigquery.QueryJobConfig(query_parameters=query_parameters, **kwargs)
+
+    def query(self, sql, params=None, bytes_budget=None):
+        budget = _budget_of(bytes_budget)
+        handler = log.current_handler()
+        if QUERY_DRY_RUN_CHECK and budget:
+            estimated = self.estimate_bytes(sql, params)
+            if estimated > budget:
+                QUERY_JOBS.inc(handler, "rejected")
+                log.warning("Consulta rechazada por presupuesto de bytes.",
+                            estimated_bytes=estimated, budget=budget)
+                raise QueryBudgetExceeded(estimated, budget)
+        job_config = self._job_config(params, **({"maximum_bytes_billed": budget} if budget else {}))
+        return _TrackedJob(get_bq_client().query(sql, job_config=job_config), handler)
+
+    def estimate_bytes(self, sql, params=None):
+        """
+        Bytes que procesaría la consulta, según un dry run (no se cobra). Se guarda
+        por (SQL, parámetros) durante QUERY_DRY_RUN_TTL_S.
+        """
+        key = (sql, repr(params))
+        now = time.monotonic()
+        with self._estimates_lock:
+            cached = self._estimates.get(key)
+            if cached is not None and cached[1] > now:
+                return cached[0]
+        job_config = self._job_config(params, dry_run=True, use_query_cache=False)
+        estimated = get_bq_client().query(sql, job_config=job_config).total_bytes_processed or 0
+        with self._estimates_lock:
+            if len(self._estimates) > 1024:
+                self._estimates = {k: v for k, v in self._estimates.items() if v[1] > now}
+            self._estimates[key] = (estimated, now + QUERY_DRY_RUN_TTL_S)
+        return estimated
+
+    def insert_rows(self, table_name, rows, row_ids=None):
+        # Sin row_ids el cliente genera un ID aleatorio por fila.
+        return get_bq_client().insert_rows_json(self.table_id(table_name), rows, row_ids=row_ids)
+
+    def warm_up(self):
+        get_bq_client()
+
+
+# --- SQLite ---
+
+_TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
+_TIMESTAMP_RE = re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d{6}Z$")
+_INTERVAL_UNITS = {"SECOND": "seconds", "MINUTE": "minutes", "HOUR": "hours", "DAY": "days"}
+
+# (patrón, reemplazo) que llevan el SQL de BigQuery de los handlers a SQLite, en orden.
+_TRANSLATIONS = [
+    (re.compile(r"IN\s+UNNEST\(\s*@(\w+)\s*\)"), r"IN (SELECT value FROM json_each(@\1))"),
+    (re.compile(r"ARRAY_AGG\((.+?)(?:\s+IGNORE NULLS)?\s+ORDER BY\s+([\w.]+)\s+DESC\s+LIMIT 1\)\[(?:SAFE_)?OFFSET\(0\)\]"),
+     r"LATEST_BY(\1, \2)"),
+    (re.compile(r"\bIF\("), "IIF("),
+    (re.compile(r"INTERVAL\s+(@?\w+)\s+(SECOND|MINUTE|HOUR|DAY)\b"), r"\1, '\2'"),
+    (re.compile(r"CURRENT_TIMESTAMP\(\)"), "BQ_CURRENT_TIMESTAMP()"),
+    (re.compile(r"@(\w+)"), r":\1"),
+]
+
+
+@functools.lru_cache(maxsize=256)
+def translate_sql(sql):
+    """SQL de BigQuery (el subconjunto usado en este repositorio) a SQLite."""
+    for pattern, replacement in _TRANSLATIONS:
+        sql = pattern.sub(replacement, sql)
+    return sql
+
+
+def _parse_timestamp(value):
+    if isinstance(value, datetime):
+        dt = value
+    else:
+        dt = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+def _format_timestamp(dt):
+    return dt.strftime(_TIMESTAMP_FORMAT)
+
+
+def _to_sqlite(value, is_timestamp=False):
+    if value is None:
+        return None
+    if is_timestamp or isinstance(value, datetime):
+        return _format_timestamp(_parse_timestamp(value))
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+
+def _from_sqlite(value):
+    if isinstance(value, str) and _TIMESTAMP_RE.match(value):
+        return datetime.strptime(value, _TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc)
+    return value
+
+
+class Row(dict):
+    """Fila con acceso por clave y por atributo, como bigquery.Row."""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def _row_factory(cursor, values):
+    return Row((column[0], _from_sqlite(value)) for column, value in zip(cursor.description, values))
+
+
+class _Page(list):
+    @property
+    def num_items(self):
+        return len(self)
+
+
+class SQLiteRowIterator:
+    """Resultado recorrido por páginas (`pages`), como el RowIterator de BigQuery."""
+
+    def __init__(self, cursor, page_size=None):
+        self._cursor = cursor
+        self._page_size = page_size or SQLITE_PAGE_ROWS
+
+    @property
+    def pages(self):
+        if self._cursor.description is None:
+            return
+        while True:
+            page = self._cursor.fetchmany(self._page_size)
+            if not page:
+                return
+            yield _Page(page)
+
+    def __iter__(self):
+        for page in self.pages:
+            yield from page
+
+    def to_arrow(self, create_bqstorage_client=True):
+        import pyarrow
+        return pyarrow.Table.from_pylist([dict(row) for row in self])
+
+
+class SQLiteQueryJob:
+    """Lo que los handlers usan de bigquery.QueryJob."""
+
+    total_bytes_processed = None
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.num_dml_affected_rows = cursor.rowcount if cursor.rowcount >= 0 else None
+
+    def result(self, page_size=None, timeout=None):
+        return SQLiteRowIterator(self._cursor, page_size)
+
+    def __iter__(self):
+        return iter(self.result())
+
+
+class _LatestBy:
+    """Agregado LATEST_BY(valor, orden): el valor no nulo con el mayor `orden`."""
+
+    def __init__(self):
+        self.value = None
+        self.key = None
+
+    def step(self, value, key):
+        if value is not None and key is not None and (self.key is None or key > self.key):
+            self.value, self.key = value, key
+
+    def finalize(self):
+        return self.value
+
+
+def _timestamp_sub(value, amount, unit):
+    if value is None or amount is None:
+        return None
+    return _format_timestamp(_parse_timestamp(value) - timedelta(**{_INTERVAL_UNITS[unit]: amount}))
+
+
+def _unix_seconds(value):
+    return None if value is None else int(_parse_timestamp(value).timestamp())
+
+
+def _unix_micros(value):
+    if value is None:
+        return None
+    dt = _parse_timestamp(value)
+    return int(dt.replace(microsecond=0).timestamp()) * 1_000_000 + dt.microsecond
+
+
+def _timestamp_seconds(value):
+    return None if value is None else _format_timestamp(datetime.fromtimestamp(value, timezone.utc))
+
+
+def _format_timestamp_sql(fmt, value):
+    return None if value is None else _parse_timestamp(value).strftime(fmt)
+
+
+def _div(a, b):
+    return None if a is None or b is None else int(a) // int(b)
+
+
+def _now():
+    return _format_timestamp(datetime.now(timezone.utc))
+
+
+class SQLiteStorage:
+    """Backend SQLite embebido: una conexión por hilo sobre el mismo archivo (WAL)."""
+
+    dialect = "sqlite"
+
+    def __init__(self, path=SQLITE_PATH, schema_path=SQLITE_SCHEMA_PATH):
+        self.path = path
+        self.schema_path = schema_path
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+        self._timestamp_columns = {}
+
+    def table_id(self, table_name):
+        return table_name
+
+    def table_ref(self, table_name):
+        return f'"{table_name}"'
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+            conn.create_function("TIMESTAMP_SUB", 3, _timestamp_sub, deterministic=True)
+            conn.create_function("TIMESTAMP_ADD", 3, lambda v, a, u: _timestamp_sub(v, -a, u), deterministic=True)
+            conn.create_function("UNIX_SECONDS", 1, _unix_seconds, deterministic=True)
+            conn.create_function("UNIX_MICROS", 1, _unix_micros, deterministic=True)
+            conn.create_function("TIMESTAMP_SECONDS", 1, _timestamp_seconds, deterministic=True)
+            conn.create_function("FORMAT_TIMESTAMP", 2, _format_timestamp_sql, deterministic=True)
+            conn.create_function("DIV", 2, _div, deterministic=True)
+            conn.create_function("BQ_CURRENT_TIMESTAMP", 0, _now)
+            conn.create_aggregate("LATEST_BY", 2, _LatestBy)
+            conn.row_factory = _row_factory
+            self._ensure_schema(conn)
+            self._local.conn = conn
+        return conn
+
+    def _ensure_schema(self, conn):
+        with self._schema_lock:
+            if not self._schema_ready:
+                with open(self.schema_path, encoding="utf-8") as f:
+                    conn.executescript(f.read())
+                self._schema_ready = True
+                log.info("Base SQLite lista.", path=self.path)
+
+    def query(self, sql, params=None, bytes_budget=None):
+        # SQLite no cobra por bytes leídos: el presupuesto no aplica.
+        values = {}
+        for name, type_, value in params or []:
+            if isinstance(value, (list, tuple)):
+                values[name] = json.dumps([_to_sqlite(v, type_ == "TIMESTAMP") for v in value])
+            else:
+                values[name] = _to_sqlite(value, type_ == "TIMESTAMP")
+        return SQLiteQueryJob(self.connection().execute(translate_sql(sql), values))
+
+    def insert_rows(self, table_name, rows, row_ids=None):
+        """
+        Inserta el lote en una sola transacción. Si falla por los datos (una
+        restricción, un tipo), se reintenta fila por fila (también en una
+        transacción) y se devuelven los errores con el formato de insert_rows_json:
+        [{"index": i, "errors": [...]}]. Los errores transitorios (base bloqueada u
+        ocupada) se propagan para que quien llama reintente el lote completo. Con
+        `row_ids` las filas cuya clave primaria ya existe se ignoran, como las
+        repetidas en BigQuery.
+        """
+        if not rows:
+            return []
+        conn = self.connection()
+        timestamp_columns = self._timestamp_columns_of(conn, table_name)
+        columns = sorted({column for row in rows for column in row})
+        verb = "INSERT OR IGNORE" if row_ids is not None else "INSERT"
+        sql = (f'{verb} INTO "{table_name}" ({", ".join(columns)}) '
+               f'VALUES ({", ".join("?" for _ in columns)})')
+        values = [tuple(_to_sqlite(row.get(c), c in timestamp_columns) for c in columns) for row in rows]
+
+        try:
+            conn.execute("BEGIN")
+            conn.executemany(sql, values)
+            conn.execute("COMMIT")
+            return []
+        except sqlite3.Error as e:
+            self._rollback(conn)
+            if is_transient_error(e):
+                raise
+
+        errors = []
+        try:
+            conn.execute("BEGIN")
+            for i, row_values in enumerate(values):
+                try:
+                    conn.execute(sql, row_values)
+                except sqlite3.Error as e:
+                    if is_transient_error(e):
+                        raise
+                    errors.append({"index": i, "errors": [{"reason": "invalid", "message": str(e)}]})
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            self._rollback(conn)
+            raise
+        return errors
+
+    @staticmethod
+    def _rollback(conn):
+        # Si BEGIN mismo falló no hay transacción abierta: ROLLBACK ocultaría el error.
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+
+    def _timestamp_columns_of(self, conn, table_name):
+        columns = self._timestamp_columns.get(table_name)
+        if columns is None:
+            columns = {
+                row["name"] for row in conn.execute(f'PRAGMA table_info("{table_name}")')
+                if row["type"].upper() == "TIMESTAMP"
+            }
+            self._timestamp_columns[table_name] = columns
+        return columns
+
+    def warm_up(self):
+        self.connection()
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    """Backend de almacenamiento del proceso, según STORAGE_BACKEND."""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                if STORAGE_BACKEND == "bigquery":
+                    _storage = BigQueryStorage()
+                elif STORAGE_BACKEND == "sqlite":
+                    _storage = SQLiteStorage()
+                else:
+                    raise ValueError(f"STORAGE_BACKEND desconocido: {STORAGE_BACKEND!r} (usar 'bigquery' o 'sqlite').")
+    return _storage
+
+
+def _network_errors():
+    # Las fallas de red de BigQuery llegan como excepciones de requests (transporte
+    # de AuthorizedSession), que no heredan de ConnectionError ni de TimeoutError.
+    try:
+        import requests
+    except ImportError:
+        return (ConnectionError, TimeoutError)
+    return (ConnectionError, TimeoutError, requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+
+def is_transient_error(error):
+    """Indica si una excepción del backend es transitoria (vale la pena reintentar)."""
+    if isinstance(error, sqlite3.OperationalError):
+        return "locked" in str(error) or "busy" in str(error)
+    return isinstance(error, _network_errors()) or getattr(error, "code", None) in TRANSIENT_STATUS_CODES
+
+
+def _is_transient_row_error(error):
+    reasons = {detail.get("reason") for detail in error.get("errors", [])}
+    return bool(reasons) and reasons <= TRANSIENT_ROW_REASONS
+
+
+def _retry_delay(attempt):
+    # Espera exponencial con variación aleatoria ("full jitter").
+    return random.uniform(0, min(INSERT_RETRY_MAX_S, INSERT_RETRY_BASE_S * 2 ** attempt))
+
+
+def insert_rows(table_name, rows, row_ids=None):
+    """
+    Inserta filas en el backend del proceso. Con `row_ids` (un ID estable por fila)
+    reenviar no duplica, así que las excepciones transitorias y las filas con errores
+    transitorios se reintentan hasta INSERT_MAX_ATTEMPTS veces. Devuelve los errores
+    restantes con índices relativos a `rows`.
+    """
+    storage = get_storage()
+    if row_ids is None:
+        return storage.insert_rows(table_name, rows)
+    pending = list(range(len(rows)))
+    errors = []
+    for attempt in range(INSERT_MAX_ATTEMPTS):
+        last = attempt == INSERT_MAX_ATTEMPTS - 1
+        try:
+            batch_errors = storage.insert_rows(
+                table_name, [rows[i] for i in pending], row_ids=[row_ids[i] for i in pending])
+        except Exception as e:
+            if last or not is_transient_error(e):
+                raise
+            retry = pending
+            log.warning("Error transitorio al insertar; se reintenta.", table=table_name,
+                        rows=len(retry), attempt=attempt + 1, error=str(e))
+        else:
+            retry = []
+            for error in batch_errors:
+                index = pending[error["index"]]
+                if not last and _is_transient_row_error(error):
+                    retry.append(index)
+                else:
+                    errors.append(dict(error, index=index))
+            if retry:
+                log.warning("Filas con errores transitorios; se reintentan.", sampled=True,
+                            table=table_name, rows=len(retry), attempt=attempt + 1)
+        if not retry:
+            break
+        INSERT_RETRIES.inc(table_name, amount=len(retry))
+        time.sleep(_retry_delay(attempt))
+        pending = retry
+    return sorted(errors, key=lambda error: error["index"])
@@ -1,75 +1,288 @@
 import os
-from google.cloud import bigquery
-import requests
+import time
 import json
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request
+import instrumentation as log
+from actuation import ActuationStateMachine
+from backend_core import load_config, run_query, table_ref, warm_up
+from device_state_store import current_devices_sql
+from instrumentation import METRICS_ENABLED, METRICS_PATH, instrumented, metrics_response, stage
 
 app = Flask(__name__)
 
-PROJECT_ID = "iot-growing-app"
-DATASET_ID = "growing_app_bd"
-SENSORS_TABLE_ID = "sensor_readings"
-DEVICES_TABLE_ID = "devices"
-CROPS_TABLE_ID = "crops"
-RELAY_CONTROL_URL = "https://send-bool-acloud-712174296076.europe-west1.run.app"
+config = load_config()
+SENSORS_TABLE = table_ref(config.sensors_table)
+CROPS_TABLE = table_ref(config.crops_table)
+ACTIONS_TABLE = table_ref(config.actuator_actions_table)
+RELAY_CONTROL_URL = config.relay_control_url
+ARDUINO_THING_ID = config.arduino_thing_id
+ARDUINO_PROPERTY_ID = config.arduino_property_id
 
-client = bigquery.Client(project=PROJECT_ID)
+# --- Configuración del motor de reglas ---
+# Solo se evalúan dispositivos con lecturas más nuevas que esto (dispositivos activos).
+RULE_MAX_READING_AGE_S = int(os.environ.get("RULE_MAX_READING_AGE_S", "900"))
+# Bandas de histéresis: un relé encendido solo se apaga cuando la lectura vuelve
+# a estar esta distancia dentro del rango crítico, para no oscilar en el borde.
+RULE_TEMP_HYSTERESIS = float(os.environ.get("RULE_TEMP_HYSTERESIS", "0.5"))
+RULE_HUM_HYSTERESIS = float(os.environ.get("RULE_HUM_HYSTERESIS", "2.0"))
+# Comandos al relé enviados en paralelo por disparo.
+RULE_ACTION_WORKERS = int(os.environ.get("RULE_ACTION_WORKERS", "16"))
+
+# Métrica, columnas de umbral del cultivo y banda de histéresis.
+MetricRule = namedtuple("MetricRule", ["metric", "min_field", "max_field", "hysteresis"])
+METRIC_RULES = (
+    MetricRule("temperature", "critical_temp_min", "critical_temp_max", RULE_TEMP_HYSTERESIS),
+    MetricRule("humidity", "critical_hum_min", "critical_hum_max", RULE_HUM_HYSTERESIS),
+)
+
+# Último estado ordenado por dispositivo y tiempo mínimo entre cambios.
+actuation = ActuationStateMachine()
+
+
+# Fila de la flota armada con las lecturas de la capa caliente (mismos campos que la consulta).
+FleetDevice = namedtuple("FleetDevice", [
+    "device_id", "thing_id", "property_id", "relay_state", "last_action_at", "temperature", "humidity",
+    "critical_temp_min", "critical_temp_max", "critical_hum_min", "critical_hum_max",
+])
+
+
+def _warm_hot_tier():
+    from hot_tier import warm_hot_tier
+    warm_hot_tier()
+
+
+# La capa caliente (NumPy) se importa y se carga desde BigQuery en segundo plano;
+# requests se importa en el primer comando y el warm-up también lo precarga.
+warm_up("hot_tier", "requests", then=_warm_hot_tier)
 
-@app.route('/', methods=['POST'])
-def check_temperature_trigger():
-    print("--- V5 --- Evento recibido, iniciando lógica de encendido/apagado ---")
 
+def _fleet_query(with_readings=True):
+    """
+    Consulta de la flota en modo AUTOMATICO: estado de relé (incluidos los cambios aún
+    no fusionados desde DEVICE_STATE_LOG), hora de la última acción reciente en
+    ACTUATOR_ACTIONS, Thing y propiedad de su relé (los de la configuración si no
+    tiene propios), umbrales críticos del cultivo y, si `with_readings`, la última
+    temperatura y humedad recientes (los dispositivos sin lecturas recientes no aparecen).
+    """
+    latest_cte = f"""
+        latest AS (
+            SELECT
+                device_id,
+                ARRAY_AGG(IF(metric_type = 'temperature', value, NULL) IGNORE NULLS ORDER BY timestamp DESC LIMIT 1)[SAFE_OFFSET(0)] AS temperature,
+                ARRAY_AGG(IF(metric_type = 'humidity', value, NULL) IGNORE NULLS ORDER BY timestamp DESC LIMIT 1)[SAFE_OFFSET(0)] AS humidity
+            FROM {SENSORS_TABLE}
+            WHERE
+                timestamp >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL @max_age_s SECOND)
+                AND metric_type IN ('temperature', 'humidity')
+            GROUP BY device_id
+        ),""" if with_readings else ""
+    return f"""
+        WITH{latest_cte}
+        recent_actions AS (
+            SELECT device_id, MAX(timestamp) AS last_action_at
+            FROM {ACTIONS_TABLE}
+            WHERE timestamp >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL @dwell_s SECOND)
+            GROUP BY device_id
+        )
+        SELECT
+            d.device_id,
+            IFNULL(d.arduino_thing_id, @default_thing_id) AS thing_id,
+            IFNULL(d.arduino_property_id, @default_property_id) AS property_id,
+            IFNULL(d.state, FALSE) AS relay_state,
+            a.last_action_at,
+            {"l.temperature, l.humidity," if with_readings else ""}
+            c.critical_temp_min,
+            c.critical_temp_max,
+            c.critical_hum_min,
+            c.critical_hum_max
+        FROM {current_devices_sql()} d
+        JOIN {CROPS_TABLE} c ON d.crop_id = c.crop_id
+        {"JOIN latest l ON l.device_id = d.device_id" if with_readings else ""}
+        LEFT JOIN recent_actions a ON a.device_id = d.device_id
+        WHERE d.control_mode = 'AUTOMATICO'
+    """
+
+
+def _fleet_params(**extra):
+    params = [
+        ("dwell_s", "INT64", int(actuation.min_dwell_s)),
+        ("default_thing_id", "STRING", ARDUINO_THING_ID),
+        ("default_property_id", "STRING", ARDUINO_PROPERTY_ID),
+    ]
+    return params + [(name, "INT64", value) for name, value in extra.items()]
+
+
+def _fleet_from_hot_tier():
+    """
+    Flota con las últimas lecturas tomadas de la capa caliente, o None si la capa no
+    está cargada o no cubre los últimos RULE_MAX_READING_AGE_S de algún dispositivo.
+    """
+    from hot_tier import HOT_TIER_ENABLED, get_hot_tier
+
+    tier = get_hot_tier()
+    if not HOT_TIER_ENABLED or not tier.loaded:
+        return None
+    tier.ensure_fresh()
+    devices = list(run_query(_fleet_query(with_readings=False), _fleet_params()))
+    oldest = int(time.time()) - RULE_MAX_READING_AGE_S
+    fleet = []
+    for device in devices:
+        if not tier.covers(device.device_id, oldest):
+            return None
+        latest = {metric: value for metric, (ts, value) in tier.latest(device.device_id).items() if ts >= oldest}
+        if not latest:
+            continue
+        fleet.append(FleetDevice(
+            device.device_id, device.thing_id, device.property_id, device.relay_state, device.last_action_at,
+            latest.get("temperature"), latest.get("humidity"),
+            device.critical_temp_min, device.critical_temp_max,
+            device.critical_hum_min, device.critical_hum_max,
+        ))
+    return fleet
+
+
+def load_fleet_snapshot():
+    """
+    Por cada dispositivo en modo AUTOMATICO con lecturas recientes: su estado de relé,
+    la hora de su última acción reciente, los umbrales críticos de su cultivo y su
+    última temperatura y humedad. Las lecturas salen de la capa caliente del proceso
+    cuando la cubre (ver hot_tier); si no, todo sale de una sola consulta a BigQuery.
+    """
     try:
-        last_reading_query = f"""
-            SELECT device_id, value
-            FROM `{PROJECT_ID}.{DATASET_ID}.{SENSORS_TABLE_ID}`
-            WHERE metric_type = 'temperature'
-            ORDER BY timestamp DESC
-            LIMIT 1
-        """
-        query_job = client.query(last_reading_query)
-        last_reading = list(query_job)
-
-        if not last_reading:
-            print("No se encontraron lecturas de temperatura en la tabla.")
-            return "Sin datos que procesar.", 200
+        fleet = _fleet_from_hot_tier()
+    except Exception as e:
+        log.warning("No se pudo usar la capa caliente.", error=str(e))
+        fleet = None
+    if fleet is not None:
+        return fleet
+    return list(run_query(_fleet_query(), _fleet_params(max_age_s=RULE_MAX_READING_AGE_S)))
 
-        latest_data = last_reading[0]
-        device_id = latest_data.device_id
-        current_temp = float(latest_data.value)
 
-        print(f"Última lectura encontrada: {current_temp}°C para el dispositivo {device_id}")
+def evaluate_device(device, relay_state=None, rules=METRIC_RULES):
+    """
+    Devuelve el estado deseado del relé para un dispositivo (fila de load_fleet_snapshot).
+    `relay_state` es el estado actual del relé; por defecto, el guardado en devices.
 
-        crop_query = f"""
-            SELECT c.critical_temp_min FROM `{PROJECT_ID}.{DATASET_ID}.{DEVICES_TABLE_ID}` d
-            JOIN `{PROJECT_ID}.{DATASET_ID}.{CROPS_TABLE_ID}` c ON d.crop_id = c.crop_id
-            WHERE d.device_id = @device_id
-        """
-        job_config = bigquery.QueryJobConfig(
-            query_parameters=[bigquery.ScalarQueryParameter("device_id", "STRING", device_id)]
+    Apagado: se enciende si alguna métrica sale de su rango crítico [min, max].
+    Encendido: sigue encendido hasta que todas las métricas vuelven a estar dentro
+    del rango reducido por su histéresis. Métricas o umbrales nulos no se evalúan.
+    """
+    relay_state = device.relay_state if relay_state is None else relay_state
+    for rule in rules:
+        value = getattr(device, rule.metric)
+        if value is None:
+            continue
+        band = rule.hysteresis if relay_state else 0.0
+        low = getattr(device, rule.min_field)
+        high = getattr(device, rule.max_field)
+        if low is not None and value < low + band:
+            return True
+        if high is not None and value > high - band:
+            return True
+    return False
+
+
+def send_relay_command(thing_id, property_id, device_ids, state):
+    """
+    Pide a send_bool_acloud cambiar un relé (Thing y propiedad) y guardar el nuevo
+    estado de los dispositivos que lo comparten.
+    """
+    import requests
+    response = requests.post(RELAY_CONTROL_URL, json={
+        "state": state,
+        "device_ids": device_ids,
+        "thing_id": thing_id,
+        "property_id": property_id,
+    }, timeout=10)
+    response.raise_for_status()
+    log.info("Solicitud al relé enviada.", thing_id=thing_id, device_ids=device_ids, state=state)
+
+
+def _send_and_record(target, device_ids, state):
+    send_relay_command(*target, device_ids, state)
+    for device_id in device_ids:
+        actuation.record(device_id, state)
+
+
+def plan_actions(fleet):
+    """
+    Devuelve ({(thing_id, property_id): (device_ids, estado)}, retenidos).
+
+    Los dispositivos que comparten un relé se deciden juntos: el relé se enciende
+    si alguno lo necesita, y no se cambia mientras alguno no cumpla el tiempo
+    mínimo. Así cada relé recibe a lo más un comando por pasada.
+    """
+    by_target = {}
+    for device in fleet:
+        by_target.setdefault((device.thing_id, device.property_id), []).append(device)
+
+    actions = {}
+    held = 0
+    for target, devices in by_target.items():
+        desired = any(
+            evaluate_device(d, actuation.current(d.device_id, d.relay_state, d.last_action_at)[0])
+            for d in devices
         )
-        crop_result = list(client.query(crop_query, job_config=job_config))
-
-        if crop_result and crop_result[0].critical_temp_min is not None:
-            critical_temp = float(crop_result[0].critical_temp_min)
-            print(f"DEBUG: Temp Actual: {current_temp}°C, Temp Crítica: {critical_temp}°C")
-
-            if current_temp > critical_temp:
-                print(f"¡ALERTA! Temperatura supera el umbral. Activando relé.")
-                response = requests.post(RELAY_CONTROL_URL, json={"state": True}, timeout=10)
-                response.raise_for_status()
-                print("Solicitud para ACTIVAR el relé enviada con éxito.")
-            else:
-                print("Temperatura dentro de los límites. Apagando relé.")
-                print("Solicitud para APAGAR el relé enviada con éxito.")
-        else:
-            print(f"No se encontró temperatura crítica para el dispositivo {device_id}.")
+        decisions = {
+            d.device_id: actuation.decide(d.device_id, desired, d.relay_state, d.last_action_at)
+            for d in devices
+        }
+        if "hold" in decisions.values():
+            held += 1
+        elif "send" in decisions.values():
+            actions[target] = (sorted(d for d, decision in decisions.items() if decision == "send"), desired)
+    return actions, held
+
+
+def run_rules():
+    """
+    Evalúa toda la flota en una pasada y envía solo las transiciones reales
+    (encendido y apagado) que ya cumplieron el tiempo mínimo en su estado,
+    con un comando por relé.
+    """
+    with stage("storage"):
+        fleet = load_fleet_snapshot()
+    actions, held = plan_actions(fleet)
+
+    failed = []
+    if actions:
+        with stage("actuate"), ThreadPoolExecutor(max_workers=min(RULE_ACTION_WORKERS, len(actions))) as executor:
+            futures = {
+                executor.submit(_send_and_record, target, device_ids, state): target
+                for target, (device_ids, state) in actions.items()
+            }
+            for future, target in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    log.error("Error al enviar el comando al relé.", thing_id=target[0], property_id=target[1], error=str(e))
+                    failed.append(target)
+
+    summary = {"evaluated": len(fleet), "actions": len(actions), "held": held, "failed": len(failed)}
+    log.info("Reglas evaluadas.", **summary)
+    return summary
+
+
+@app.route('/', methods=['POST'])
+@instrumented("check_temperature_trigger")
+def check_temperature_trigger():
+    try:
+        summary = run_rules()
+        if not summary["evaluated"]:
+            log.info("No hay dispositivos en modo AUTOMATICO con lecturas recientes.")
+            return "Sin datos que procesar.", 200
 
     except Exception as e:
-        print(f"Error inesperado durante el procesamiento: {e}")
+        log.error("Error inesperado durante el procesamiento.", error=str(e))
         return "Error interno en el servidor.", 500
 
-    return "Procesamiento completado con éxito.", 200
+    return json.dumps({"message": "Procesamiento completado con éxito.", **summary}), 200
+
+
+if METRICS_ENABLED:
+    app.add_url_rule(METRICS_PATH, "metrics", metrics_response, methods=['GET'])
 
 if __name__ == "__main__":
-    app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
\ No newline at end of file
+    app.run(debug=True, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
@@ -0,0 +1,89 @@
+from collections import namedtuple
+from datetime import date, datetime, time, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+# Zona horaria de los usuarios: las fechas sin zona se interpretan en hora de Santiago.
+LOCAL_TZ = ZoneInfo("America/Santiago")
+DEFAULT_WINDOW = timedelta(hours=24)
+
+
+# Ventana [start, end) en UTC. Si `latest` es True la ventana se resuelve en
+# BigQuery: las últimas DEFAULT_WINDOW horas hasta la lectura más reciente.
+TimeWindow = namedtuple("TimeWindow", ["start", "end", "display_date", "latest"], defaults=(None, None, None, False))
+
+
+def local_midnight_utc(day):
+    """
+    Primer instante del día local `day`, en UTC.
+    En el cambio a horario de verano de Santiago la medianoche no existe
+    (se salta de 00:00 a 01:00); con fold=0 zoneinfo devuelve el instante en que empieza el día.
+    """
+    return datetime.combine(day, time(0), LOCAL_TZ).astimezone(timezone.utc)
+
+
+def local_day_bounds(day):
+    """Devuelve (inicio, fin) en UTC del día local `day`; el día puede durar 23, 24 o 25 horas."""
+    return local_midnight_utc(day), local_midnight_utc(day + timedelta(days=1))
+
+
+def parse_instant(value):
+    """
+    Convierte un texto ISO 8601 en un datetime UTC.
+    Acepta fechas ('2024-09-08', inicio del día local), fechas con hora sin zona
+    (hora de Santiago) y fechas con zona o 'Z'. Lanza ValueError si no es válido.
+    """
+    value = value.strip()
+    if len(value) == 10:
+        return local_midnight_utc(date.fromisoformat(value))
+    dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=LOCAL_TZ)
+    return dt.astimezone(timezone.utc)
+
+
+def _local_date_str(instant):
+    return instant.astimezone(LOCAL_TZ).strftime('%Y-%m-%d')
+
+
+def resolve_window(args, now=None):
+    """
+    Resuelve la ventana pedida con los parámetros 'date', 'from' y 'to'.
+    - date=YYYY-MM-DD: el día local completo.
+    - from/to: rango arbitrario; un 'to' que es solo fecha incluye ese día entero.
+      Sin 'to' se usa el instante actual; sin 'from', DEFAULT_WINDOW antes de 'to'.
+    - sin parámetros: ventana 'latest' que se resuelve en la misma consulta de datos.
+    Lanza ValueError con un mensaje para el cliente si los parámetros no son válidos.
+    """
+    date_str = args.get('date')
+    from_str = args.get('from')
+    to_str = args.get('to')
+
+    if date_str:
+        if from_str or to_str:
+            raise ValueError("Use 'date' o 'from'/'to', no ambos.")
+        try:
+            day = date.fromisoformat(date_str)
+        except ValueError:
+            raise ValueError("El parámetro 'date' debe tener formato YYYY-MM-DD.")
+        start, end = local_day_bounds(day)
+        return TimeWindow(start, end, display_date=date_str)
+
+    if from_str or to_str:
+        try:
+            if to_str and len(to_str.strip()) == 10:
+                end = local_day_bounds(date.fromisoformat(to_str.strip()))[1]
+            elif to_str:
+                end = parse_instant(to_str)
+            else:
+                end = now or datetime.now(timezone.utc)
+            start = parse_instant(from_str) if from_str else end - DEFAULT_WINDOW
+        except ValueError:
+            raise ValueError("Los parámetros 'from' y 'to' deben ser fechas u horas ISO 8601.")
+        if start >= end:
+            raise ValueError("El parámetro 'from' debe ser anterior a 'to'.")
+        first_day = _local_date_str(start)
+        last_day = _local_date_str(end - timedelta(microseconds=1))
+        display_date = first_day if first_day == last_day else f"{first_day} - {last_day}"
+        return TimeWindow(start, end, display_date=display_date)
+
+    return TimeWindow(latest=True)
@@ -0,0 +1,127 @@
+import json
+import os
+import time
+
+import functions_framework
+import instrumentation as log
+from backend_core import warm_up
+from device_state_store import get_device_state_store
+from instrumentation import instrumented
+
+# --- Configuración ---
+# Tiempo máximo que se mantiene abierta una petición long-poll y tope que puede pedir el cliente.
+WATCH_DEFAULT_TIMEOUT_S = float(os.environ.get("WATCH_DEFAULT_TIMEOUT_S", "25"))
+WATCH_MAX_TIMEOUT_S = float(os.environ.get("WATCH_MAX_TIMEOUT_S", "55"))
+# Duración máxima de un flujo SSE y cada cuánto se envía un comentario para mantenerlo vivo.
+WATCH_SSE_MAX_S = float(os.environ.get("WATCH_SSE_MAX_S", "300"))
+WATCH_SSE_HEARTBEAT_S = float(os.environ.get("WATCH_SSE_HEARTBEAT_S", "15"))
+
+# Cada conexión en espera se bloquea en un threading.Event (sin consultas ni sondeo
+# propio). Se despliega con el worker gevent de gunicorn_watch.conf.py: así cada
+# espera es una greenlet y no un hilo del sistema.
+warm_up(then=get_device_state_store().ensure_loaded)
+
+
+def _parse_timeout(value, default, maximum):
+    try:
+        timeout_s = float(value) if value else default
+    except ValueError:
+        timeout_s = default
+    return max(0.0, min(timeout_s, maximum))
+
+
+def _state_payload(device_id, device_state):
+    payload = {'status': 'success', 'device_id': device_id}
+    payload.update(device_state.to_dict())
+    return payload
+
+
+def _sse_stream(device_id, since_version, since_etag, duration_s):
+    """Genera eventos SSE con cada cambio de estado hasta `duration_s`."""
+    store = get_device_state_store()
+    deadline = time.monotonic() + duration_s
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        device_state, changed = store.wait_for_change(
+            device_id, since_version, since_etag, timeout_s=min(WATCH_SSE_HEARTBEAT_S, remaining)
+        )
+        if device_state is None:
+            yield "event: error\ndata: {\"message\": \"Dispositivo no encontrado.\"}\n\n"
+            return
+        if changed:
+            since_version, since_etag = device_state.version, device_state.etag
+            data = json.dumps(_state_payload(device_id, device_state))
+            yield f"event: state\nid: {device_state.etag}\ndata: {data}\n\n"
+        else:
+            yield ": keepalive\n\n"
+
+
+@functions_framework.http
+@instrumented("watch_device_state")
+def watch_device_state(request):
+    """
+    Función HTTP de long-poll sobre el estado (relay y modo) de un dispositivo.
+    Recibe 'device_id' y lo último que vio el cliente: el ETag (If-None-Match o
+    ?etag=) o la versión (?version=). Responde en cuanto set_control_mode o
+    send_bool_acloud cambian el dispositivo, o 304 al cumplirse ?timeout= segundos.
+    Con 'Accept: text/event-stream' responde un flujo SSE con un evento por cambio.
+    """
+    # --- Manejo de CORS ---
+    headers = {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, OPTIONS',
+        'Access-Control-Allow-Headers': 'Content-Type, If-None-Match, Last-Event-ID',
+        'Access-Control-Expose-Headers': 'ETag',
+    }
+    if request.method == 'OPTIONS':
+        return ('', 204, headers)
+
+    # --- Lógica principal ---
+    device_id = request.args.get('device_id')
+    if not device_id:
+        response_data = {'status': 'error', 'message': 'El parámetro "device_id" es requerido en la URL.'}
+        return (json.dumps(response_data), 400, headers)
+
+    # El ETag depende solo del contenido, así sirve aunque la petición llegue a otra instancia;
+    # la versión es un contador local de cada instancia.
+    since_etag = (request.args.get('etag') or request.headers.get('If-None-Match')
+                  or request.headers.get('Last-Event-ID') or '').strip() or None
+    since_version = request.args.get('version')
+    try:
+        since_version = int(since_version) if since_version not in (None, '') else None
+    except ValueError:
+        response_data = {'status': 'error', 'message': 'El parámetro "version" debe ser un entero.'}
+        return (json.dumps(response_data), 400, headers)
+
+    try:
+        if 'text/event-stream' in (request.headers.get('Accept') or ''):
+            from flask import Response, stream_with_context
+
+            duration_s = _parse_timeout(request.args.get('timeout'), WATCH_SSE_MAX_S, WATCH_SSE_MAX_S)
+            headers['Cache-Control'] = 'no-cache'
+            headers['X-Accel-Buffering'] = 'no'
+            return Response(
+                stream_with_context(_sse_stream(device_id, since_version, since_etag, duration_s)),
+                status=200, headers=headers, mimetype='text/event-stream',
+            )
+
+        timeout_s = _parse_timeout(request.args.get('timeout'), WATCH_DEFAULT_TIMEOUT_S, WATCH_MAX_TIMEOUT_S)
+        device_state, changed = get_device_state_store().wait_for_change(
+            device_id, since_version, since_etag, timeout_s=timeout_s
+        )
+
+        if device_state is None:
+            response_data = {'status': 'error', 'message': 'Dispositivo no encontrado.'}
+            return (json.dumps(response_data), 404, headers)
+
+        headers['ETag'] = device_state.etag
+        if not changed:
+            return ('', 304, headers)
+        return (json.dumps(_state_payload(device_id, device_state)), 200, headers)
+
+    except Exception as e:
+        log.error("Error inesperado.", error=str(e))
+        response_data = {'status': 'error', 'message': 'Error interno del servidor.'}
+        return (json.dumps(response_data), 500, headers)